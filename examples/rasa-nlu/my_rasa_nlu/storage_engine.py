@@ -5,6 +5,7 @@ import shutil
 import tempfile
 import random
 import string
+import hashlib
 
 def dir_path(string):
     if os.path.isdir(string):
@@ -39,6 +40,19 @@ class StorageEngine(base.StorageEngine):
             raise ValueError("Does Not exist:", final_path)
 
     
+    def get_artifact_key(self, model_parameters) -> str:
+        final_path = os.path.join(self.base_dir, model_parameters["path"])
+        digest = hashlib.sha256()
+        with open(final_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024*1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def fetch_artifact(self, model_parameters, target_dir: str) -> dict:
+        final_path = os.path.join(self.base_dir, model_parameters["path"])
+        shutil.unpack_archive(final_path, target_dir)
+        return {"local_path": target_dir}
+
     def fetch_model(self, model_parameters) -> dict:
         final_path = os.path.join(self.base_dir, model_parameters["path"])
         temp_dir = os.path.join(self.temp_dir, get_temp_dir_name())
@@ -43,4 +43,12 @@ def predict(model, text):
     with torch.no_grad():
         text = torch.tensor(text_pipeline(text))
         output = model(text, torch.tensor([0]))
-        return output.argmax(1).item() + 1
\ No newline at end of file
+        return output.argmax(1).item() + 1
+
+def predict_batch(model, texts):
+    with torch.no_grad():
+        token_lists = [text_pipeline(text) for text in texts]
+        offsets = torch.tensor([0] + [len(x) for x in token_lists[:-1]]).cumsum(dim=0)
+        text = torch.tensor([token for x in token_lists for token in x], dtype=torch.int64)
+        output = model(text, offsets)
+        return [x + 1 for x in output.argmax(1).tolist()]
@@ -4,7 +4,8 @@ import configargparse
 from .models import (TextClassificationModel,
 ag_news_label,
 text_pipeline,
-predict
+predict,
+predict_batch
 )
 import os
 import json
@@ -40,3 +41,8 @@ class ServingEngine(base.ServingEngine):
         model = worker_serving_context["torch_model"]
         result = ag_news_label.get(predict(model, query))
         return {"label": result}
+
+    def infer_batch(self, model_parameters:dict, storage_context:dict, serving_context: dict, worker_serving_context:dict, data_list: list) -> list:
+        queries = [data.get("query") or "" for data in data_list]
+        model = worker_serving_context["torch_model"]
+        return [{"label": ag_news_label.get(x)} for x in predict_batch(model, queries)]
@@ -1,9 +1,12 @@
 from .worker import Worker
 from .cluster import Cluster
+from . import models
 import configargparse
 import aioredis
 import asyncio
 import logging
+import os
+import tempfile
 
 async def main(options):
     redis = await aioredis.from_url(
@@ -16,7 +19,10 @@ async def main(options):
         name=options.cluster_name)
 
     if command == "bootstrap_cluster":
-        await cluster.bootstrap()
+        await cluster.bootstrap(scheduler_shards=options.scheduler_shards)
+    elif command == "rebuild_indexes":
+        await cluster.sync()
+        await models.rebuild_indexes(cluster)
     elif command == "worker":
         await cluster.sync()
         logging.info("Joinning Cluster: name=%s version=%s", cluster.name, cluster.version)
@@ -33,10 +39,11 @@ def execute_from_command_line(argv=None):
     default_options_map = {
         "host": "0.0.0.0",
         "management-port": "9500",
-        "serving-port": "9510"
+        "serving-port": "9510",
+        "artifact-peer-port": "9520"
         }
     p = configargparse.ArgParser()
-    p.add('command', choices=["bootstrap_cluster", "worker"], help='command')
+    p.add('command', choices=["bootstrap_cluster", "rebuild_indexes", "worker"], help='command')
     p.add('--cluster-name', required=True, help='name of the cluster')
     p.add('--redis-url', required=True, help='redis url')
     p.add('--redis-key-prefix', default="inferout", help='key prefix used for redis keys')
@@ -46,6 +53,37 @@ def execute_from_command_line(argv=None):
     p.add('--serving-host', default=default_options_map["host"], help='listen host for serving API')
     p.add('--serving-port', default=default_options_map["serving-port"], help='listen port for serving API', type=int)
 
+    p.add('--routing-connection-limit', default=256, type=int, help='max open connections for routing requests to remote workers, 0 for no limit')
+    p.add('--routing-connection-limit-per-host', default=32, type=int, help='max open connections to a single remote worker, 0 for no limit')
+    p.add('--routing-keepalive-timeout', default=30, type=float, help='seconds to keep idle connections to remote workers open')
+    p.add('--routing-connect-timeout', default=2, type=float, help='timeout in seconds for connecting to a remote worker')
+    p.add('--routing-request-timeout', default=60, type=float, help='total timeout in seconds for a request routed to a remote worker')
+
+    p.add('--routing-policy', default="power_of_two_choices", choices=["power_of_two_choices", "least_outstanding", "random"], help='how to pick a replica on a remote worker')
+    p.add('--routing-rack-overload-threshold', default=32, type=int, help='load (in flight and queued requests) above which a worker in the same rack is skipped in favour of other racks')
+    p.add('--serving-processes', default=0, type=int, help='number of child processes hosting model instances, 0 to host them in the worker process')
+
+    p.add('--max-concurrent-model-loads', default=2, type=int, help='max model instances fetched and loaded at the same time')
+    p.add('--model-load-threads', default=4, type=int, help='threads fetching, loading and unloading models, kept apart from inference')
+    p.add('--inference-threads', default=0, type=int, help='threads running inference in the worker process, 0 for the python default')
+
+    p.add('--shutdown-drain-timeout', default=120, type=float, help='seconds a shutting down worker keeps serving while its model instances are replaced elsewhere, 0 to exit right away, keep it below the grace period of the process manager (terminationGracePeriodSeconds on kubernetes)')
+
+    p.add('--on-demand-memory-ratio', default=0.5, type=float, help='share of memory on demand model instances may use, least recently used ones are evicted above it')
+
+    p.add('--scheduler-shards', default=16, type=int, help='number of shards scheduling work is split into, each led by one worker, only used by bootstrap_cluster')
+
+    p.add('--artifact-cache-dir', default=os.path.join(tempfile.gettempdir(), "inferout_artifact_cache"), help='directory of the cache of model artifacts shared across model instances')
+    p.add('--artifact-cache-max-bytes', default=10*1024**3, type=int, help='disk budget of the artifact cache, least recently used artifacts not in use are evicted above it, 0 to disable the cache')
+
+    p.add('--artifact-peer-max-uploads', default=0, type=int, help='max peers copying cached artifacts from this worker at the same time, 0 to neither serve nor fetch artifacts from peers, use along with --artifact-peer-token')
+    p.add('--artifact-peer-upload-rate', default=100*1024**2, type=int, help='bytes per second an artifact is served to a peer at, 0 for no limit')
+    p.add('--artifact-peer-host', default=default_options_map["host"], help='listen host for the artifact API peers copy cached artifacts from, keep it off public networks')
+    p.add('--artifact-peer-port', default=default_options_map["artifact-peer-port"], help='listen port for the artifact API peers copy cached artifacts from', type=int)
+    p.add('--artifact-peer-token', default="", help='token shared by the workers of the cluster, peers copying artifacts have to send it when set')
+
+    p.add('--resources-disk-path', default=tempfile.gettempdir(), help='path whose filesystem free space is reported as worker disk capacity')
+
     p.add('--plugins', nargs='+', default=[])
 
     p.add('--storage-engines', nargs='+', default=['inferout.storage_engines.local_files'])
@@ -0,0 +1,63 @@
+import asyncio
+import hmac
+import os
+from aiohttp import web
+import contextvars
+
+from .artifact_peers import ARTIFACT_PEER_PATH, ARTIFACT_PEER_TOKEN_HEADER, ARTIFACT_PEER_WORKER_HEADER
+
+context_worker = contextvars.ContextVar('worker')
+
+
+@web.middleware
+async def token_middleware(request, handler):
+    #only peers knowing the cluster shared token may copy artifacts, when one is set
+    worker = context_worker.get()
+    token = worker.artifact_peers.token if worker.artifact_peers is not None else ""
+    if token and not hmac.compare_digest(request.headers.get(ARTIFACT_PEER_TOKEN_HEADER, ""), token):
+        raise web.HTTPForbidden
+    return await handler(request)
+
+
+async def handle_artifact_manifest(request):
+    worker = context_worker.get()
+    if worker.artifact_peers is None:
+        raise web.HTTPNotFound
+    loop = asyncio.get_event_loop()
+    manifest = await loop.run_in_executor(worker.load_executor,
+        worker.artifact_cache.get_manifest, request.match_info["entry_id"])
+    if manifest is None:
+        raise web.HTTPNotFound
+    return web.json_response(manifest)
+
+async def handle_artifact_file(request):
+    worker = context_worker.get()
+    if worker.artifact_peers is None:
+        raise web.HTTPNotFound
+    loop = asyncio.get_event_loop()
+    path = await loop.run_in_executor(worker.load_executor, worker.artifact_cache.get_file_path,
+        request.match_info["entry_id"], request.match_info["path"])
+    if path is None:
+        raise web.HTTPNotFound
+    #peers fetch the files of an artifact one after another, they hold their slot in between
+    peer = request.headers.get(ARTIFACT_PEER_WORKER_HEADER) or request.remote
+    if not worker.artifact_peers.start_upload(peer):
+        #the peer tries another one or the origin store
+        raise web.HTTPTooManyRequests
+    try:
+        response = web.StreamResponse(headers={
+            "Content-Type": "application/octet-stream",
+            "Content-Length": str(os.path.getsize(path))
+            })
+        await response.prepare(request)
+        await worker.artifact_peers.upload_file(response, path)
+        await response.write_eof()
+        return response
+    finally:
+        worker.artifact_peers.end_upload(peer)
+
+app = web.Application(middlewares=[token_middleware])
+app.add_routes([
+    web.get(ARTIFACT_PEER_PATH + '/{entry_id}', handle_artifact_manifest),
+    web.get(ARTIFACT_PEER_PATH + '/{entry_id}/files/{path:.+}', handle_artifact_file),
+    ])
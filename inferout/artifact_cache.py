@@ -0,0 +1,218 @@
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+
+ARTIFACT_METADATA_FILE = "artifact.json"
+ARTIFACT_DATA_DIR = "data"
+ARTIFACT_DIR_PLACEHOLDER = "@artifact_dir" # stands for the data dir in storage contexts sent to peers
+ENTRY_ID_REGEX = re.compile("^[0-9a-f]{64}$")
+
+
+def get_dir_size(path: str) -> int:
+    size = 0
+    for dir_path, _dir_names, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.lstat(os.path.join(dir_path, file_name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def get_dir_files(path: str) -> list:
+    """Relative path, size and sha256 of every file under path, for peers to check their copies against."""
+    files = []
+    for dir_path, _dir_names, file_names in os.walk(path):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            sha256 = hashlib.sha256()
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024*1024), b""):
+                    sha256.update(chunk)
+            files.append({
+                "path": os.path.relpath(file_path, path),
+                "size": os.path.getsize(file_path),
+                "sha256": sha256.hexdigest()
+                })
+    return files
+
+
+class ArtifactCache(object):
+    """Worker level cache of fetched model artifacts, keyed by content.
+
+    Storage engines opt in by returning a content key (hash, ETag...) from
+    get_artifact_key and fetching into a given directory with
+    fetch_artifact. Artifacts are shared by all the model instances using
+    them, survive restarts, and the least recently used ones nobody uses
+    are evicted once the cache grows over max_bytes.
+
+    Methods block, they are meant to be called from the load executor.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int, on_evict=None) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict#called with the key of every evicted artifact
+        self.entries = OrderedDict()#entry_id -> entry, least recently used first
+        self.fetching = {}#entry_id -> threading.Event
+        self.lock = threading.Lock()
+
+    def get_entry_id(self, key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_entry_path(self, entry_id: str) -> str:
+        return os.path.join(self.cache_dir, entry_id)
+
+    def get_data_dir(self, entry_id: str) -> str:
+        return os.path.join(self.get_entry_path(entry_id), ARTIFACT_DATA_DIR)
+
+    def get_keys(self) -> list:
+        with self.lock:
+            return [x["key"] for x in self.entries.values()]
+
+    def get_manifest(self, entry_id: str) -> dict:
+        """What a peer needs to copy the artifact, None if it isn't cached."""
+        with self.lock:
+            entry = self.entries.get(entry_id)
+        if entry is None:
+            return None
+        data_dir = self.get_data_dir(entry_id)
+        if "files" not in entry:#cached before files were recorded
+            entry["files"] = get_dir_files(data_dir)
+        storage_context = {}
+        for k, v in entry["storage_context"].items():
+            if isinstance(v, str) and (v == data_dir or v.startswith(data_dir + os.sep)):
+                v = ARTIFACT_DIR_PLACEHOLDER + v[len(data_dir):]
+            storage_context[k] = v
+        return {"key": entry["key"], "storage_context": storage_context, "files": entry["files"]}
+
+    def get_file_path(self, entry_id: str, relative_path: str) -> str:
+        """Path of a file of a cached artifact, None if it isn't one."""
+        if not ENTRY_ID_REGEX.match(entry_id):
+            return None
+        data_dir = os.path.realpath(self.get_data_dir(entry_id))
+        path = os.path.realpath(os.path.join(data_dir, relative_path))
+        if not path.startswith(data_dir + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def load(self):
+        """Picks up artifacts left by earlier runs, incomplete ones are removed."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        found = []
+        for entry_id in os.listdir(self.cache_dir):
+            metadata_path = os.path.join(self.get_entry_path(entry_id), ARTIFACT_METADATA_FILE)
+            try:
+                with open(metadata_path) as f:
+                    metadata = json.load(f)
+                found.append((os.path.getmtime(metadata_path), entry_id, metadata))
+            except (OSError, ValueError):
+                shutil.rmtree(self.get_entry_path(entry_id), ignore_errors=True)
+        for _last_used_at, entry_id, metadata in sorted(found):
+            self.entries[entry_id] = dict(metadata, refs=0)
+        logging.info("artifact cache: %d artifacts, %d bytes", len(self.entries),
+            sum(x["size"] for x in self.entries.values()))
+        self.evict()
+
+    def acquire(self, key: str, fetch) -> dict:
+        """Returns the storage context of the artifact, calling fetch(target_dir=...) unless it's cached.
+
+        Every acquire must be followed by a release once the artifact isn't used anymore.
+        """
+        entry_id = self.get_entry_id(key)
+        while True:
+            with self.lock:
+                entry = self.entries.get(entry_id)
+                if entry is not None:
+                    entry["refs"] += 1
+                    self.entries.move_to_end(entry_id)
+                    break
+                fetching = self.fetching.get(entry_id)
+                if fetching is None:
+                    fetching = self.fetching[entry_id] = threading.Event()
+                    entry = None
+                    break
+            #fetched by someone else meanwhile, or failed and left to us
+            fetching.wait()
+
+        if entry is not None:
+            logging.debug("artifact cache hit %s", key)
+            try:
+                os.utime(os.path.join(self.get_entry_path(entry_id), ARTIFACT_METADATA_FILE))
+            except OSError:
+                pass
+            return dict(entry["storage_context"], artifact_key=key)
+
+        logging.debug("artifact cache miss %s", key)
+        try:
+            metadata = self.fetch_entry(entry_id, key, fetch)
+            with self.lock:
+                self.entries[entry_id] = dict(metadata, refs=1)
+        finally:
+            with self.lock:
+                del self.fetching[entry_id]
+            fetching.set()
+        self.evict()
+        return dict(metadata["storage_context"], artifact_key=key)
+
+    def fetch_entry(self, entry_id: str, key: str, fetch) -> dict:
+        entry_path = self.get_entry_path(entry_id)
+        shutil.rmtree(entry_path, ignore_errors=True)
+        data_dir = os.path.join(entry_path, ARTIFACT_DATA_DIR)
+        os.makedirs(data_dir)
+        try:
+            storage_context = fetch(target_dir=data_dir)
+        except Exception:
+            shutil.rmtree(entry_path, ignore_errors=True)
+            raise
+        metadata = {
+            "key": key,
+            "storage_context": storage_context,
+            "size": get_dir_size(data_dir),
+            "files": get_dir_files(data_dir)
+            }
+        #written last, an entry without it is incomplete
+        metadata_path = os.path.join(entry_path, ARTIFACT_METADATA_FILE)
+        with open(metadata_path + ".tmp", "w") as f:
+            json.dump(metadata, f)
+        os.replace(metadata_path + ".tmp", metadata_path)
+        return metadata
+
+    def release(self, key: str):
+        with self.lock:
+            entry = self.entries.get(self.get_entry_id(key))
+            if entry is not None:
+                entry["refs"] = max(0, entry["refs"] - 1)
+        self.evict()
+
+    def evict(self):
+        evicted = []
+        with self.lock:
+            total_size = sum(x["size"] for x in self.entries.values())
+            for entry_id, entry in list(self.entries.items()):
+                if total_size <= self.max_bytes:
+                    break
+                if entry["refs"] > 0:
+                    continue
+                del self.entries[entry_id]
+                total_size -= entry["size"]
+                evicted.append((entry_id, entry["key"]))
+        for entry_id, key in evicted:
+            logging.info("artifact cache evicting %s", key)
+            shutil.rmtree(self.get_entry_path(entry_id), ignore_errors=True)
+            if self.on_evict is not None:
+                self.on_evict(key)
+
+
+def resolve_storage_context(storage_context: dict, data_dir: str) -> dict:
+    """Inverse of the relocation done for peers by ArtifactCache.get_manifest."""
+    resolved = {}
+    for k, v in storage_context.items():
+        if isinstance(v, str) and v.startswith(ARTIFACT_DIR_PLACEHOLDER):
+            v = data_dir + v[len(ARTIFACT_DIR_PLACEHOLDER):]
+        resolved[k] = v
+    return resolved
@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import time
+import urllib.parse
+import urllib.request
+
+from .artifact_cache import ArtifactCache, resolve_storage_context
+
+ARTIFACT_HOLDERS_KEY = "@artifact_holders" # set of worker ids having an artifact cached, per artifact
+ARTIFACT_PEER_PATH = "/_artifacts"
+ARTIFACT_PEER_TOKEN_HEADER = "X-Inferout-Artifact-Token"
+ARTIFACT_PEER_WORKER_HEADER = "X-Inferout-Worker-Id"
+ARTIFACT_PEER_CHUNK_SIZE = 1024*1024
+ARTIFACT_PEER_TIMEOUT = 30
+ARTIFACT_PEER_MAX_TRIES = 3
+ARTIFACT_PEER_IDLE_TIMEOUT = 5 # a peer keeps its upload slot between the files of an artifact this long
+
+
+class ArtifactPeers(object):
+    """Lets workers copy cached model artifacts from each other instead of the origin store.
+
+    Workers announce the artifacts they have cached in redis and serve
+    them from the internal artifact API, each worker serving at most
+    max_uploads peers at upload_rate bytes per second each. When token is
+    set, peers have to send it to be served. Copies are checked against
+    the sha256 of every file listed in the manifest.
+    """
+    def __init__(self, worker, artifact_cache: ArtifactCache, max_uploads: int, upload_rate: int, token: str = "") -> None:
+        self.worker = worker
+        self.cluster = worker.cluster
+        self.artifact_cache = artifact_cache
+        self.max_uploads = max_uploads
+        self.upload_rate = upload_rate
+        self.token = token
+        self.uploading_peers = {}#peer -> [files being uploaded to it, when the last one ended]
+        self.loop = asyncio.get_event_loop()
+
+    def get_holders_key(self, key: str) -> str:
+        return self.cluster.get_redis_key(ARTIFACT_HOLDERS_KEY, self.artifact_cache.get_entry_id(key))
+
+    async def announce(self, keys: list):
+        if not keys:
+            return
+        async with self.cluster.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.sadd(self.get_holders_key(key), self.worker.id)
+            await pipe.execute()
+
+    async def withdraw(self, key: str):
+        await self.cluster.redis.srem(self.get_holders_key(key), self.worker.id)
+
+    def on_evict(self, key: str):
+        #called from the load executor
+        asyncio.run_coroutine_threadsafe(self.withdraw(key), self.loop)
+
+    async def find_peers(self, key: str) -> list:
+        """Serving workers holding the artifact, the ones in our rack first."""
+        holders_key = self.get_holders_key(key)
+        peers = []
+        for worker_id in await self.cluster.redis.smembers(holders_key):
+            if worker_id == self.worker.id:
+                continue
+            worker_data = await self.worker.routing_table.fetch_worker_data(worker_id)
+            if worker_data is None:
+                await self.cluster.redis.srem(holders_key, worker_id)
+                continue
+            peers.append(worker_data)
+        random.shuffle(peers)
+        peers.sort(key=lambda x: x["rack"] != self.worker.rack)
+        return peers[:ARTIFACT_PEER_MAX_TRIES]
+
+    def fetch(self, peers: list, key: str, target_dir: str) -> dict:
+        """Copies the artifact from the first peer that serves it, None if none did.
+
+        Blocks, called from the load executor.
+        """
+        entry_id = self.artifact_cache.get_entry_id(key)
+        for peer in peers:
+            if not peer.get("artifact_endpoint"):
+                continue
+            url = "{}{}/{}".format(peer["artifact_endpoint"], ARTIFACT_PEER_PATH, entry_id)
+            try:
+                started_at = time.monotonic()
+                storage_context = self.download(url, target_dir)
+                logging.info("fetched artifact %s from worker %s in %fs", key, peer["id"], time.monotonic() - started_at)
+                return storage_context
+            except (OSError, ValueError) as e:#urllib errors are OSErrors
+                logging.warning("unable to fetch artifact %s from worker %s: %s", key, peer["id"], e)
+                for name in os.listdir(target_dir):
+                    path = os.path.join(target_dir, name)
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+        return None
+
+    def open_url(self, url: str):
+        headers = {ARTIFACT_PEER_WORKER_HEADER: self.worker.id}
+        if self.token:
+            headers[ARTIFACT_PEER_TOKEN_HEADER] = self.token
+        return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=ARTIFACT_PEER_TIMEOUT)
+
+    def download(self, url: str, target_dir: str) -> dict:
+        with self.open_url(url) as response:
+            manifest = json.load(response)
+        real_target_dir = os.path.realpath(target_dir)
+        for each in manifest["files"]:
+            path = os.path.realpath(os.path.join(target_dir, each["path"]))
+            if not path.startswith(real_target_dir + os.sep):
+                raise ValueError("invalid artifact file path " + each["path"])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file_url = "{}/files/{}".format(url, urllib.parse.quote(each["path"]))
+            if not each.get("sha256"):#served by a worker not hashing its artifacts yet
+                raise ValueError("no checksum for artifact file " + each["path"])
+            sha256 = hashlib.sha256()
+            with self.open_url(file_url) as response, open(path, "wb") as f:
+                for chunk in iter(lambda: response.read(ARTIFACT_PEER_CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+                    f.write(chunk)
+            if os.path.getsize(path) != each["size"]:
+                raise ValueError("size mismatch for artifact file " + each["path"])
+            if sha256.hexdigest() != each["sha256"]:
+                raise ValueError("checksum mismatch for artifact file " + each["path"])
+        return resolve_storage_context(manifest["storage_context"], target_dir)
+
+    def start_upload(self, peer: str) -> bool:
+        """Counts peer as served until end_upload, False if max_uploads other peers already are."""
+        now = time.monotonic()
+        for each, (uploads, ended_at) in list(self.uploading_peers.items()):
+            if uploads == 0 and now - ended_at > ARTIFACT_PEER_IDLE_TIMEOUT:
+                del self.uploading_peers[each]
+        if peer not in self.uploading_peers and len(self.uploading_peers) >= self.max_uploads:
+            return False
+        self.uploading_peers.setdefault(peer, [0, now])[0] += 1
+        return True
+
+    def end_upload(self, peer: str):
+        self.uploading_peers[peer][0] -= 1
+        self.uploading_peers[peer][1] = time.monotonic()
+
+    async def upload_file(self, response, path: str):
+        """Writes the file to the response, no faster than upload_rate."""
+        started_at = time.monotonic()
+        sent = 0
+        with open(path, "rb") as f:
+            while True:
+                chunk = await self.loop.run_in_executor(self.worker.load_executor, f.read, ARTIFACT_PEER_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await response.write(chunk)
+                sent += len(chunk)
+                if self.upload_rate > 0:
+                    ahead = sent / self.upload_rate - (time.monotonic() - started_at)
+                    if ahead > 0:
+                        await asyncio.sleep(ahead)
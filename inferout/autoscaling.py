@@ -0,0 +1,123 @@
+from collections import Counter
+import math
+import time
+
+from .cluster import Cluster
+from . import utils
+from .models import NAMESPACE_DEFAULT_SETTINGS
+
+MODEL_LOAD_KEY = "@model_load" # hash of worker id -> json load of its instances of the model, per model
+MODEL_AUTOSCALING_KEY = "@model_autoscaling" # hash with the autoscaled instance count of the model, per model
+MODEL_LOAD_REPORT_INTERVAL = 10
+MODEL_LOAD_MAX_AGE = 30 # loads of workers that stopped reporting are ignored after this many seconds
+
+
+def get_model_load_key(cluster: Cluster, namespace_id: str, model_id: str) -> str:
+    return cluster.get_redis_key(namespace_id, utils.covert_to_redis_slot(model_id), MODEL_LOAD_KEY)
+
+def get_model_autoscaling_key(cluster: Cluster, namespace_id: str, model_id: str) -> str:
+    return cluster.get_redis_key(namespace_id, utils.covert_to_redis_slot(model_id), MODEL_AUTOSCALING_KEY)
+
+def get_utilization(load: dict) -> float:
+    """Share of the reported capacity used, time spent queued included."""
+    if not load["capacity"]:
+        return 0.0
+    return load["concurrency"] / load["capacity"]
+
+
+class ModelLoadTracker(object):
+    """Accumulates the traffic of the local instances of every model between load reports.
+
+    The time requests spend queued and served adds up to the average
+    concurrency of a model over the window, which compared to the
+    concurrency its instances allow gives their utilization.
+    """
+    def __init__(self) -> None:
+        self.requests = Counter()
+        self.busy_time = Counter()
+        self.window_started_at = time.monotonic()
+
+    def record(self, model_key: str, latency: float):
+        self.requests[model_key] += 1
+        self.busy_time[model_key] += latency
+
+    def flush(self, capacities: dict, queued: dict) -> dict:
+        """Returns the load of every model in capacities since the last flush and starts a new window."""
+        now = time.monotonic()
+        window = max(now - self.window_started_at, 0.001)
+        reported_at = time.time()
+        loads = {}
+        for model_key, capacity in capacities.items():
+            requests = self.requests[model_key]
+            busy_time = self.busy_time[model_key]
+            loads[model_key] = {
+                "qps": requests / window,
+                "concurrency": busy_time / window,
+                "latency": busy_time / requests if requests else 0.0,
+                "queued": queued.get(model_key, 0),
+                "capacity": capacity,
+                "reported_at": reported_at
+                }
+        self.requests.clear()
+        self.busy_time.clear()
+        self.window_started_at = now
+        return loads
+
+
+def get_desired_instances(current: int, scaled_at: float, loads: list, settings: dict, now: float) -> int:
+    """Instances the model should have given the loads reported by the workers serving it.
+
+    current is the instance count decided last, at scaled_at. The count
+    moves only once utilization leaves target_utilization by more than
+    tolerance, and not within the cooldown of the last change.
+    """
+    instances_settings = settings["instances_per_model"]
+    autoscaling_settings = settings.get("autoscaling") or {}
+    min_instances = int(instances_settings["min"])
+    max_instances = max(min_instances, int(instances_settings["max"]))
+    current = min(max(current, min_instances), max_instances)
+    loads = [x for x in loads if now - x["reported_at"] <= MODEL_LOAD_MAX_AGE]
+    if not loads:#nothing serving yet, or nobody reporting
+        return current
+
+    target_utilization = float(autoscaling_settings.get("target_utilization", 0.7))
+    tolerance = float(autoscaling_settings.get("tolerance", 0.1))
+    max_latency = float(autoscaling_settings.get("max_latency") or 0)
+    #namespaces saved before request queues existed have no settings for them
+    request_queue_settings = dict(NAMESPACE_DEFAULT_SETTINGS["request_queue"], **(settings.get("request_queue") or {}))
+    instance_capacity = max(1, int(request_queue_settings["max_concurrency"]))
+
+    #latencies are recorded end to end, so concurrency already counts queued requests
+    demand = sum(x["concurrency"] for x in loads)
+    utilization = demand / (current * instance_capacity) if current else float("inf")
+    requests = sum(x["qps"] for x in loads)
+    latency = sum(x["latency"] * x["qps"] for x in loads) / requests if requests else 0.0
+
+    desired = math.ceil(demand / (instance_capacity * target_utilization))
+    #slow but idle models are slow by nature, more instances wouldn't help
+    if max_latency > 0 and latency > max_latency and utilization >= target_utilization * (1 - tolerance):
+        desired = max(desired, current + 1)
+    elif utilization <= target_utilization * (1 + tolerance) and desired > current:
+        desired = current
+    if utilization >= target_utilization * (1 - tolerance) and desired < current:
+        desired = current
+    desired = min(max(desired, min_instances), max_instances)
+
+    if desired > current and now - scaled_at < float(autoscaling_settings.get("scale_up_cooldown", 30)):
+        return current
+    if desired < current and now - scaled_at < float(autoscaling_settings.get("scale_down_cooldown", 300)):
+        return current
+    return desired
+
+def needs_scale_up(load: dict, settings: dict) -> bool:
+    """Whether the local load of one worker hints the model is short of instances."""
+    autoscaling_settings = settings.get("autoscaling") or {}
+    if not autoscaling_settings.get("enabled"):
+        return False
+    max_latency = float(autoscaling_settings.get("max_latency") or 0)
+    target_utilization = float(autoscaling_settings.get("target_utilization", 0.7))
+    tolerance = float(autoscaling_settings.get("tolerance", 0.1))
+    utilization = get_utilization(load)
+    if max_latency > 0 and load["latency"] > max_latency and utilization >= target_utilization * (1 - tolerance):
+        return True
+    return utilization > target_utilization * (1 + tolerance)
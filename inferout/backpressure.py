@@ -0,0 +1,39 @@
+import asyncio
+
+from .exceptions import QueueFullException
+
+
+class RequestLimiter(object):
+    """Limits concurrent requests of one model instance and bounds the queue in front of it.
+
+    Used as an async context manager around an inference, raises
+    QueueFullException instead of queueing once max_queue_size requests
+    are already waiting.
+    """
+    def __init__(self, max_concurrency: int, max_queue_size: int) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.queued = 0
+
+    async def acquire(self):
+        if self.semaphore.locked() and self.queued >= self.max_queue_size:
+            raise QueueFullException()
+        self.queued += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.semaphore.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import time
+
+
+class Batcher(object):
+    """Collects concurrent inference requests of one model instance into batches.
+
+    A batch is dispatched once it reaches max_batch_size or once the first
+    request in it has waited max_wait_time seconds, whichever comes first.
+    infer_batch is a coroutine function taking a list of inputs and
+    returning a list of outputs in the same order.
+    """
+    def __init__(self, infer_batch, max_batch_size: int, max_wait_time: float) -> None:
+        self.infer_batch = infer_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_time = max_wait_time
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_event_loop().create_task(self.run_forever())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        while not self.queue.empty():
+            _data, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("model instance is no longer serving"))
+
+    async def submit(self, data):
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((data, future))
+        return await future
+
+    async def collect_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait_time
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run_forever(self):
+        while True:
+            batch = await self.collect_batch()
+            batch = [x for x in batch if not x[1].done()]#drop cancelled requests
+            if not batch:
+                continue
+            logging.debug("dispatching batch of size %d", len(batch))
+            try:
+                results = await self.infer_batch([x[0] for x in batch])
+                if len(results) != len(batch):
+                    raise ValueError("infer_batch returned {} results for {} inputs".format(len(results), len(batch)))
+            except asyncio.CancelledError:
+                for _data, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError("model instance is no longer serving"))
+                raise
+            except Exception as e:
+                for _data, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_data, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
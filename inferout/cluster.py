@@ -9,6 +9,7 @@ REDIS_LOCK_TIMEOUT = 10
 REDIS_LOCK_BLOCKING_TIMEOUT = 0
 
 CLUSTER_INFO_KEY = '@cluster_info'
+CLUSTER_DEFAULT_SCHEDULER_SHARDS = 1 # clusters bootstrapped before scheduler sharding
 
 
 class Cluster(object):
@@ -17,6 +18,7 @@ class Cluster(object):
         self.redis_key_prefix = redis_key_prefix
         self.name = name
         self.version = None
+        self.scheduler_shards = CLUSTER_DEFAULT_SCHEDULER_SHARDS
     
     def get_async_lock(self, *args):
         return self.redis.lock(
@@ -30,6 +32,11 @@ class Cluster(object):
     
     def get_redis_channel_key(self, *args):
         return utils.get_redis_key(self.redis_key_prefix, 'channel', *args)
+
+    async def get_time(self) -> float:
+        """Time of the redis server, expiry scores compared across workers must not depend on their clocks."""
+        seconds, microseconds = await self.redis.time()
+        return seconds + microseconds / 1000000
     
     async def sync(self):
         cluster_info = await self.redis.hgetall(self.get_redis_key(CLUSTER_INFO_KEY))
@@ -38,9 +45,10 @@ class Cluster(object):
         if cluster_info['name'] != self.name:
             raise InvalidClusterError("Name mismatch")
         self.version = cluster_info['version']
+        self.scheduler_shards = int(cluster_info.get('scheduler_shards', CLUSTER_DEFAULT_SCHEDULER_SHARDS))
 
 
-    async def bootstrap(self):
+    async def bootstrap(self, scheduler_shards: int = CLUSTER_DEFAULT_SCHEDULER_SHARDS):
         async with self.get_async_lock(CLUSTER_INFO_KEY):
             existing_cluster_info = await self.redis.hgetall(self.get_redis_key(CLUSTER_INFO_KEY))
             if(existing_cluster_info):
@@ -49,7 +57,8 @@ class Cluster(object):
             else:
                 cluster_info = {
                     "name": self.name,
-                    "version": CLUSTER_BOOTSTRAP_VERSION
+                    "version": CLUSTER_BOOTSTRAP_VERSION,
+                    "scheduler_shards": scheduler_shards
                     }
                 await self.redis.hset(self.get_redis_key(CLUSTER_INFO_KEY),
                 mapping=cluster_info)
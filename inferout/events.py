@@ -0,0 +1,106 @@
+import asyncio
+import json
+import logging
+
+import aioredis
+
+from .cluster import Cluster
+from . import utils
+
+EVENT_STREAM_KEY = "@events" # redis stream of events, per recipient
+EVENT_STREAM_MAXLEN = 10000
+EVENT_STREAM_READ_COUNT = 100
+EVENT_STREAM_BLOCK_DURATION = 1 # shutdown is noticed within this many seconds
+EVENT_STREAM_ERROR_SLEEP_DURATION = 1
+
+
+def get_stream_key(cluster: Cluster, stream_name: str) -> str:
+    return cluster.get_redis_key(EVENT_STREAM_KEY, stream_name)
+
+def get_consumer_group_name(group: str, consumer: str) -> str:
+    return utils.get_redis_key(group, consumer)
+
+async def publish_event(cluster: Cluster, stream_name: str, event_type: str, event_data: dict):
+    await cluster.redis.xadd(
+        get_stream_key(cluster, stream_name),
+        {
+            "event_type": event_type,
+            "event_data": json.dumps(event_data)
+        },
+        maxlen=EVENT_STREAM_MAXLEN,
+        approximate=True)
+
+async def delete_consumer_groups(cluster: Cluster, stream_name: str, consumer: str):
+    """Deletes the groups a departed consumer read the stream with."""
+    stream_key = get_stream_key(cluster, stream_name)
+    try:
+        groups = await cluster.redis.xinfo_groups(stream_key)
+    except aioredis.exceptions.ResponseError:#no such stream
+        return
+    for group in groups:
+        if utils.split_redis_key(group["name"])[-1] == consumer:
+            await cluster.redis.xgroup_destroy(stream_key, group["name"])
+
+
+class EventStreamReader(object):
+    """Reads a stream of events through a consumer group.
+
+    Events are acked once handled, events read but not acked before a
+    disconnect or a restart with the same consumer are handled again.
+    """
+    def __init__(self, cluster: Cluster, stream_name: str, group: str, consumer: str, handler, start_id: str = "$") -> None:
+        self.cluster = cluster
+        self.stream_key = get_stream_key(cluster, stream_name)
+        self.group = group
+        self.consumer = consumer
+        self.handler = handler
+        self.start_id = start_id
+        self.shutdown_requested = False
+
+    async def setup(self):
+        try:
+            await self.cluster.redis.xgroup_create(self.stream_key, self.group, id=self.start_id, mkstream=True)
+        except aioredis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def delete(self):
+        await self.cluster.redis.xgroup_destroy(self.stream_key, self.group)
+
+    async def read_forever(self):
+        replay_pending = True
+        while not self.shutdown_requested:
+            try:
+                if replay_pending:
+                    response = await self.cluster.redis.xreadgroup(self.group, self.consumer,
+                        {self.stream_key: "0"}, count=EVENT_STREAM_READ_COUNT)
+                else:
+                    response = await self.cluster.redis.xreadgroup(self.group, self.consumer,
+                        {self.stream_key: ">"}, count=EVENT_STREAM_READ_COUNT,
+                        block=int(EVENT_STREAM_BLOCK_DURATION*1000))
+            except aioredis.exceptions.ResponseError as e:
+                if "NOGROUP" not in str(e):
+                    raise
+                logging.warning("Consumer group %s of %s missing, recreating", self.group, self.stream_key)
+                await self.setup()
+                continue
+            except (aioredis.exceptions.ConnectionError, asyncio.TimeoutError) as e:
+                logging.warning("Unable to read events from %s: %s", self.stream_key, e)
+                replay_pending = True
+                await asyncio.sleep(EVENT_STREAM_ERROR_SLEEP_DURATION)
+                continue
+            messages = response[0][1] if response else []
+            if replay_pending and not messages:
+                replay_pending = False
+                continue
+            for message_id, fields in messages:
+                await self.handle_message(message_id, fields)
+
+    async def handle_message(self, message_id, fields):
+        if fields:#empty once trimmed from the stream while pending
+            logging.debug("(%s) Event Received: %s", self.stream_key, fields)
+            try:
+                await self.handler(fields["event_type"], json.loads(fields["event_data"]))
+            except Exception:
+                logging.exception("Error handling event %s from %s", message_id, self.stream_key)
+        await self.cluster.redis.xack(self.stream_key, self.group, message_id)
@@ -2,4 +2,16 @@ class InvalidClusterError(ValueError):
     pass
 
 class NotFoundException(ValueError):
-    pass
\ No newline at end of file
+    pass
+
+class ServingProcessError(RuntimeError):
+    pass
+
+class QueueFullException(RuntimeError):
+    pass
+
+class LeaseLostException(RuntimeError):
+    pass
+
+class ModelLoadError(RuntimeError):
+    pass
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+
+import aioredis
+
+from .cluster import Cluster
+from . import exceptions
+from . import utils
+
+LEASE_KEY = "@lease"
+LEASE_TOKEN_KEY = "@lease_token" # counter handing out fencing tokens, per lease
+LEASE_RENEW_RATIO = 3 # renewed this many times per lease duration
+
+#a fencing token is handed out only when the lease is free
+ACQUIRE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], ARGV[1] .. '::' .. token, 'PX', ARGV[2])
+return token
+"""
+
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class Lease(object):
+    """Time bound leadership of name, renewed while held.
+
+    Each acquisition gets a fencing token greater than any before it,
+    writes made on behalf of the leader are fenced with fence() so they
+    fail once the lease has been lost, even if the leader hasn't noticed.
+    """
+    def __init__(self, cluster: Cluster, name: str, holder_id: str, duration: float) -> None:
+        self.cluster = cluster
+        self.name = name
+        self.holder_id = holder_id
+        self.duration = duration
+        self.redis_key = cluster.get_redis_key(LEASE_KEY, name)
+        self.token_redis_key = cluster.get_redis_key(LEASE_TOKEN_KEY, name)
+        self.token = None
+        self.value = None
+
+    @property
+    def is_held(self) -> bool:
+        return self.value is not None
+
+    async def acquire(self) -> bool:
+        token = await self.cluster.redis.eval(ACQUIRE_SCRIPT, 2, self.redis_key, self.token_redis_key,
+            self.holder_id, int(self.duration*1000))
+        if not token:
+            return False
+        self.token = int(token)
+        self.value = utils.get_redis_key(self.holder_id, str(self.token))
+        return True
+
+    async def renew(self) -> bool:
+        if not self.is_held:
+            return False
+        renewed = await self.cluster.redis.eval(RENEW_SCRIPT, 1, self.redis_key,
+            self.value, int(self.duration*1000))
+        if not renewed:
+            logging.warning("Lease %s lost, fencing token %d", self.name, self.token)
+            self.value = None
+        return bool(renewed)
+
+    async def release(self):
+        if not self.is_held:
+            return
+        value, self.value = self.value, None
+        await self.cluster.redis.eval(RELEASE_SCRIPT, 1, self.redis_key, value)
+
+    async def keep_alive(self):
+        """Renews the lease until it is released or lost."""
+        while self.is_held:
+            await asyncio.sleep(self.duration/LEASE_RENEW_RATIO)
+            try:
+                if not await self.renew():
+                    return
+            except (aioredis.exceptions.ConnectionError, asyncio.TimeoutError) as e:
+                #retried until the lease runs out, fenced writes fail meanwhile
+                logging.warning("Unable to renew lease %s: %s", self.name, e)
+
+    async def check(self):
+        """Raises LeaseLostException unless the lease is still held."""
+        if not self.is_held or await self.cluster.redis.get(self.redis_key) != self.value:
+            raise exceptions.LeaseLostException(self.name)
+
+    async def fence(self, pipe):
+        """Watches the lease on a pipeline before its MULTI.
+
+        The transaction then fails with a WatchError if the lease changes
+        hands before it is executed.
+        """
+        await pipe.watch(self.redis_key)
+        if not self.is_held or await pipe.get(self.redis_key) != self.value:
+            raise exceptions.LeaseLostException(self.name)
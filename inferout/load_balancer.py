@@ -0,0 +1,77 @@
+import collections
+import random
+import time
+
+ROUTING_POLICIES = ["power_of_two_choices", "least_outstanding", "random"]
+REPORTED_LOAD_EXPIRE_DURATION = 5
+
+
+class LoadBalancer(object):
+    """Orders candidate replicas for requests routed to remote workers.
+
+    The load of a remote worker is the number of requests this worker has
+    forwarded to it and not yet seen answered, plus the in flight and
+    queued requests that worker last reported, either in the load header
+    of its responses or in its redis record.
+    """
+    def __init__(self, worker, policy: str, rack_overload_threshold: int) -> None:
+        if policy not in ROUTING_POLICIES:
+            raise ValueError("invalid routing policy %s", policy)
+        self.worker = worker
+        self.policy = policy
+        self.rack_overload_threshold = rack_overload_threshold
+        self.outstanding = collections.Counter()
+        self.reported_load = {}
+
+    def get_reported_load(self, worker_id):
+        reported = self.reported_load.get(worker_id)
+        if reported is not None and time.monotonic() - reported[1] < REPORTED_LOAD_EXPIRE_DURATION:
+            return reported[0]
+        worker_data = self.worker.routing_table.get_worker_data(worker_id) or {}
+        return worker_data.get("in_flight", 0) + worker_data.get("queue_depth", 0)
+
+    def get_load(self, worker_id):
+        return self.outstanding[worker_id] + self.get_reported_load(worker_id)
+
+    def order(self, instances_data: list) -> list:
+        """Returns instances_data in the order they should be tried.
+
+        Replicas in the same rack as this worker go first, unless none of
+        them is on a serving worker below rack_overload_threshold.
+        """
+        if self.worker.rack:
+            routing_table = self.worker.routing_table
+            same_rack = []
+            other = []
+            for each in instances_data:
+                worker_data = routing_table.get_worker_data(each["worker_id"])
+                if (worker_data is not None and worker_data.get("rack") == self.worker.rack
+                    and self.get_load(each["worker_id"]) < self.rack_overload_threshold):
+                    same_rack.append(each)
+                else:
+                    other.append(each)
+            if same_rack:
+                return self.order_by_policy(same_rack) + self.order_by_policy(other)
+        return self.order_by_policy(instances_data)
+
+    def order_by_policy(self, instances_data: list) -> list:
+        instances_data = list(instances_data)
+        random.shuffle(instances_data)
+        if self.policy == "random" or len(instances_data) < 2:
+            return instances_data
+        by_load = sorted(instances_data, key=lambda x: self.get_load(x["worker_id"]))
+        if self.policy == "least_outstanding":
+            return by_load
+        #power_of_two_choices, the lighter of two random replicas goes first, the rest are fallbacks
+        choices = sorted(instances_data[:2], key=lambda x: self.get_load(x["worker_id"]))
+        return [choices[0]] + [x for x in by_load if x is not choices[0]]
+
+    def begin(self, worker_id):
+        self.outstanding[worker_id] += 1
+
+    def end(self, worker_id, reported_load=None):
+        self.outstanding[worker_id] -= 1
+        if self.outstanding[worker_id] <= 0:
+            del self.outstanding[worker_id]
+        if reported_load is not None:
+            self.reported_load[worker_id] = (reported_load, time.monotonic())
@@ -2,6 +2,8 @@ import json
 import copy
 import logging
 import re
+import zlib
+import aioredis
 from .cluster import Cluster
 from inferout import cluster, exceptions, utils
 
@@ -21,6 +23,17 @@ MODEL_INSTANCE_KEY_REGEX = re.compile('@model_instance-(.*)$')
 
 MODEL_INSTANCE_TERMINATING_DURATION = 60
 
+MODELS_CHANNEL_KEY = "@models"
+
+# secondary indexes, kept up to date on save so listing never scans the keyspace
+NAMESPACES_INDEX_KEY = "@namespaces_index" # set of namespace ids
+MODELS_INDEX_KEY = "@models_index" # set of model ids, per namespace
+MODEL_VERSIONS_INDEX_KEY = "@model_versions_index" # sorted set of version ids, per model
+MODEL_INSTANCES_INDEX_KEY = "@model_instances_index" # sorted set of version::instance ids per model, scored by expiry in redis server time
+WORKER_MODELS_INDEX_KEY = "@worker_models_index-{}" # set of namespace::model ids having instances on a worker
+
+DIRTY_MODELS_KEY = "@dirty_models" # set of namespace::model ids the scheduler has to reconcile, per scheduler shard
+
 NAMESPACE_DEFAULT_SETTINGS = {
     "storage_engine": "inferout.storage_engines.local_files",
     "serving_engine": "inferout.serving_engines.echo",
@@ -29,9 +42,96 @@ NAMESPACE_DEFAULT_SETTINGS = {
         "max": 4,
         "target": 2
     },
-    "max_version_history": 10
+    "max_version_history": 10,
+    "batching": {
+        "max_batch_size": 8,
+        "max_wait_time": 0.005
+    },
+    "request_queue": {
+        "max_concurrency": 16,
+        "max_queue_size": 128,
+        "retry_after": 1
+    },
+    "placement": {
+        "worker_anti_affinity": "preferred", #required, preferred or none
+        "rack_spread": "preferred", #required, preferred or none
+        "max_rack_skew": 1
+    },
+    "resources": {
+        "default_memory_bytes": 0, #assumed until a worker has measured the model version
+        "memory_headroom_ratio": 0.1,
+        "memory_overcommit_ratio": 1.0
+    },
+    "warmup": {
+        "min_iterations": 3, #warm-up inferences run on the model version's warmup_inputs before serving
+        "max_iterations": 50,
+        "settle_tolerance": 0.1, #latency has settled once the last runs are within this ratio of each other
+        "timeout": 60 #serves anyway after this many seconds
+    },
+    "rollout": {
+        "max_surge": 1, #instances above target while a new version rolls out
+        "max_unavailable": 0, #serving instances below target while a new version rolls out
+        "drain_timeout": 30 #seconds requests taken by an instance on its way out have to finish
+    },
+    "autoscaling": {
+        "enabled": False, #instances move between instances_per_model min and max with traffic
+        "target_utilization": 0.7, #of the request_queue max_concurrency of every instance
+        "tolerance": 0.1, #no scaling while utilization is within this ratio of the target
+        "max_latency": 0, #seconds, scales up when requests take longer, 0 disables
+        "scale_up_cooldown": 30,
+        "scale_down_cooldown": 300
+    },
+    "on_demand": {
+        "enabled": False, #models load on the first request instead of being scheduled
+        "load_timeout": 120,
+        "idle_timeout": 900
+    }
 }
 
+async def publish_models_event(cluster: Cluster, event_type: str, event_data: dict):
+    await cluster.redis.publish(
+        cluster.get_redis_channel_key(MODELS_CHANNEL_KEY),
+        message=json.dumps({
+                "event_type": event_type,
+                "event_data": event_data
+            })
+    )
+
+def get_model_key(namespace_id: str, model_id: str) -> str:
+    return utils.get_redis_key(namespace_id, model_id)
+
+def get_model_shard(cluster: Cluster, model_key: str) -> int:
+    return zlib.crc32(model_key.encode()) % cluster.scheduler_shards
+
+def get_dirty_models_key(cluster: Cluster, shard: int) -> str:
+    return cluster.get_redis_key(DIRTY_MODELS_KEY, str(shard))
+
+async def mark_models_dirty(cluster: Cluster, model_keys: list):
+    if not model_keys:
+        return
+    async with cluster.redis.pipeline(transaction=False) as pipe:
+        for model_key in model_keys:
+            pipe.sadd(get_dirty_models_key(cluster, get_model_shard(cluster, model_key)), model_key)
+        await pipe.execute()
+
+async def hgetall_many(cluster: Cluster, redis_keys: list) -> list:
+    """HGETALL of every key in one pipeline, missing keys give empty dicts."""
+    if not redis_keys:
+        return []
+    async with cluster.redis.pipeline(transaction=False) as pipe:
+        for each in redis_keys:
+            pipe.hgetall(each)
+        return await pipe.execute()
+
+async def read_many(cluster: Cluster, objects: list) -> list:
+    """Bulk version of read_from_redis, returns only the objects found in redis."""
+    found = []
+    for each, data in zip(objects, await hgetall_many(cluster, [x.redis_key for x in objects])):
+        if data:
+            each.load_redis_data(data)
+            found.append(each)
+    return found
+
 class ModelNamespace(object):
     def __init__(self, cluster: Cluster, id:str) -> None:
         if NAMESPACE_REGEX.match(id) is None:
@@ -48,7 +148,9 @@ class ModelNamespace(object):
         )
         if not data:
             raise exceptions.NotFoundException()
+        self.load_redis_data(data)
 
+    def load_redis_data(self, data: dict):
         self.settings = json.loads(data["settings"])
     
     async def read(self):
@@ -56,25 +158,39 @@ class ModelNamespace(object):
 
     async def save_to_redis(self):
         data = {"settings": json.dumps(self.settings)}
-        await self.cluster.redis.hset(
-            self.redis_key,
-            mapping=data
-        )
+        async with self.cluster.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                self.redis_key,
+                mapping=data
+            )
+            pipe.sadd(self.cluster.get_redis_key(NAMESPACES_INDEX_KEY), self.id)
+            await pipe.execute()
     
     async def save(self):
         settings = copy.deepcopy(NAMESPACE_DEFAULT_SETTINGS)
         self.settings = utils.deep_update(settings, self.settings or {})
 
         await self.save_to_redis()
+        await mark_models_dirty(self.cluster,
+            [get_model_key(self.id, x) for x in await Model.get_all_ids(self.cluster, self)])
+        await publish_models_event(self.cluster, "NAMESPACE_UPDATE", {
+            "namespace_id": self.id,
+            "settings": self.settings
+            })
     
+    @classmethod
+    async def get_all_ids(cls, cluster):
+        return await cluster.redis.smembers(cluster.get_redis_key(NAMESPACES_INDEX_KEY))
+
     @classmethod
     async def get_all_as_list(cls, cluster):
         data = []
-        async for each in cluster.redis.scan_iter(
-            cluster.get_redis_key(NAMESPACE_KEY.format('*'))
-            ):
-            each_data = await cluster.redis.hgetall(each)
-            each_data["id"] = NAMESPACE_KEY_REGEX.search(each).group(1)
+        ids = list(await cls.get_all_ids(cluster))
+        all_data = await hgetall_many(cluster, [cluster.get_redis_key(NAMESPACE_KEY.format(x)) for x in ids])
+        for id, each_data in zip(ids, all_data):
+            if not each_data:
+                continue
+            each_data["id"] = id
             each_data["settings"] = json.loads(each_data["settings"])
             data.append(each_data)
         return data
@@ -96,14 +212,19 @@ class Model(object):
             self.namespace.id,
             MODEL_KEY.format(self.id))
     
+    @classmethod
+    async def get_all_ids(cls, cluster:Cluster, namespace:ModelNamespace):
+        return await cluster.redis.smembers(cluster.get_redis_key(namespace.id, MODELS_INDEX_KEY))
+
     @classmethod
     async def get_all_as_list(cls, cluster:Cluster, namespace:ModelNamespace):
         data = []
-        async for each in cluster.redis.scan_iter(
-            cluster.get_redis_key(namespace.id, MODEL_KEY.format('*'))
-            ):
-            each_data = await cluster.redis.hgetall(each)
-            each_data["id"] = MODEL_KEY_REGEX.search(each).group(1)
+        ids = list(await cls.get_all_ids(cluster, namespace))
+        all_data = await hgetall_many(cluster, [cluster.get_redis_key(namespace.id, MODEL_KEY.format(x)) for x in ids])
+        for id, each_data in zip(ids, all_data):
+            if not each_data:
+                continue
+            each_data["id"] = id
             each_data["parameters"] = json.loads(each_data["parameters"])
             each_data["latest_version_id"] = int(each_data["latest_version_id"])
             data.append(each_data)
@@ -115,7 +236,9 @@ class Model(object):
         )
         if not data:
             raise exceptions.NotFoundException()
+        self.load_redis_data(data)
 
+    def load_redis_data(self, data: dict):
         self.latest_version_id = int(data["latest_version_id"])
         self.parameters = json.loads(data["parameters"])
 
@@ -129,10 +252,15 @@ class Model(object):
             "latest_version_id": self.latest_version_id,
             "parameters": json.dumps(self.parameters)
         }
-        await self.cluster.redis.hset(
-            self.redis_key,
-            mapping=data
-        )
+        async with self.cluster.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                self.redis_key,
+                mapping=data
+            )
+            pipe.sadd(self.cluster.get_redis_key(self.namespace.id, MODELS_INDEX_KEY), self.id)
+            model_key = get_model_key(self.namespace.id, self.id)
+            pipe.sadd(get_dirty_models_key(self.cluster, get_model_shard(self.cluster, model_key)), model_key)
+            await pipe.execute()
 
     async def save(self):
         self.parameters = self.parameters or {}
@@ -145,6 +273,11 @@ class Model(object):
         await latest_version.save()
         self.latest_version = self.parameters
         await self.save_to_redis()
+        await publish_models_event(self.cluster, "MODEL_UPDATE", {
+            "namespace_id": self.namespace.id,
+            "model_id": self.id,
+            "latest_version_id": self.latest_version_id
+            })
 
 class ModelVersion(object):
     def __init__(self, model:Model, id:str) -> None:
@@ -152,25 +285,39 @@ class ModelVersion(object):
         self.cluster = model.cluster
         self.id = id
         self.parameters = None
+        self.footprint = None # measured by workers on load
 
         self.redis_key = self.cluster.get_redis_key(
             self.model.namespace.id,
             utils.covert_to_redis_slot(self.model.id),
             MODEL_VERSION_KEY.format(self.id))
         
+    @classmethod
+    async def get_all_ids(cls, cluster:Cluster, model: Model):
+        return [int(x) for x in await cluster.redis.zrange(
+            cluster.get_redis_key(
+                model.namespace.id,
+                utils.covert_to_redis_slot(model.id),
+                MODEL_VERSIONS_INDEX_KEY),
+            0, -1)]
+
     @classmethod
     async def get_all_as_list(cls, cluster:Cluster, model: Model):
         data = []
-        async for each in cluster.redis.scan_iter(
+        ids = await cls.get_all_ids(cluster, model)
+        all_data = await hgetall_many(cluster, [
             cluster.get_redis_key(
                 model.namespace.id,
                 utils.covert_to_redis_slot(model.id),
-                MODEL_VERSION_KEY.format("*")
+                MODEL_VERSION_KEY.format(x)
                 )
-            ):
-            each_data = await cluster.redis.hgetall(each)
-            each_data["id"] = int(MODEL_VERSION_KEY_REGEX.search(each).group(1))
+            for x in ids])
+        for id, each_data in zip(ids, all_data):
+            if not each_data:
+                continue
+            each_data["id"] = id
             each_data["parameters"] = json.loads(each_data["parameters"])
+            each_data["footprint"] = json.loads(each_data.get("footprint") or "{}")
             data.append(each_data)
         return sorted(data, key=lambda x: x["id"], reverse=True)
 
@@ -180,25 +327,45 @@ class ModelVersion(object):
         )
         if not data:
             raise exceptions.NotFoundException()
+        self.load_redis_data(data)
 
+    def load_redis_data(self, data: dict):
         self.parameters = json.loads(data["parameters"])
+        self.footprint = json.loads(data.get("footprint") or "{}")
 
     async def read(self):
         await self.read_from_redis()
 
     async def save_to_redis(self):
         data = {
-            "parameters": json.dumps(self.parameters)
+            "parameters": json.dumps(self.parameters),
+            "footprint": json.dumps(self.footprint)
         }
-        await self.cluster.redis.hset(
-            self.redis_key,
-            mapping=data
-        )
+        async with self.cluster.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                self.redis_key,
+                mapping=data
+            )
+            pipe.zadd(
+                self.cluster.get_redis_key(
+                    self.model.namespace.id,
+                    utils.covert_to_redis_slot(self.model.id),
+                    MODEL_VERSIONS_INDEX_KEY),
+                {str(self.id): int(self.id)})
+            await pipe.execute()
 
     async def save(self):
         self.parameters = self.parameters or {}
+        self.footprint = self.footprint or {}
         await self.save_to_redis()
 
+    async def save_footprint(self, footprint: dict):
+        self.footprint = footprint
+        await self.cluster.redis.hset(
+            self.redis_key,
+            mapping={"footprint": json.dumps(self.footprint)}
+        )
+
 class ModelInstance(object):
     def __init__(self, model_version:ModelVersion, id) -> None:
         self.id = id
@@ -228,6 +395,9 @@ class ModelInstance(object):
         )
         if not data:
             raise exceptions.NotFoundException()
+        self.load_redis_data(data)
+
+    def load_redis_data(self, data: dict):
         self.worker_id = data["worker_id"]
         self.state = data["state"]
         self.storage_context = json.loads(data["storage_context"])
@@ -238,7 +408,12 @@ class ModelInstance(object):
         await self.read_from_redis()
 
 
-    async def save_to_redis(self):
+    async def save_to_redis(self, fence=None) -> bool:
+        """fence is a leases.Lease the write is made on behalf of, the write fails once it's lost.
+
+        Fenced writes never bring back an instance its worker has moved to
+        terminating meanwhile, they are skipped and False is returned.
+        """
         data = {
             "worker_id": self.worker_id,
             "state": self.state,
@@ -246,41 +421,110 @@ class ModelInstance(object):
             "serving_context": json.dumps(self.serving_context),
             "error_messages": json.dumps(self.error_messages)
         }
-        await self.cluster.redis.hset(
-            self.redis_key,
-            mapping=data
-        )
+        index_key = self.get_index_key(self.cluster, self.model)
+        index_member = utils.get_redis_key(str(self.model_version.id), self.id)
+        model_key = get_model_key(self.model.namespace.id, self.model.id)
+        while True:
+            async with self.cluster.redis.pipeline(transaction=True) as pipe:
+                if fence is not None:
+                    await fence.fence(pipe)
+                    await pipe.watch(self.redis_key)
+                    if self.state != "terminating" and await pipe.hget(self.redis_key, "state") == "terminating":
+                        self.state = "terminating"
+                        return False
+                    pipe.multi()
+                pipe.hset(
+                    self.redis_key,
+                    mapping=data
+                )
+                if self.state != "terminating":
+                    pipe.zadd(index_key, {index_member: float("inf")})
+                if self.worker_id:
+                    pipe.sadd(self.cluster.get_redis_key(WORKER_MODELS_INDEX_KEY.format(self.worker_id)), model_key)
+                if self.state != "scheduled":#scheduled instances are written by the scheduler itself
+                    pipe.sadd(get_dirty_models_key(self.cluster, get_model_shard(self.cluster, model_key)), model_key)
+                try:
+                    await pipe.execute()
+                    break
+                except aioredis.exceptions.WatchError:
+                    #either the lease or the instance changed, only the former is fatal
+                    await fence.check()
         if self.state == "terminating":
             ttl = await self.cluster.redis.ttl(self.redis_key)
+            now = await self.cluster.get_time()
             if ttl == -1:
-                await self.cluster.redis.expire(
-                    self.redis_key,
-                    MODEL_INSTANCE_TERMINATING_DURATION
-                )
-
-    async def save(self):
+                async with self.cluster.redis.pipeline(transaction=True) as pipe:
+                    pipe.expire(
+                        self.redis_key,
+                        MODEL_INSTANCE_TERMINATING_DURATION
+                    )
+                    pipe.zadd(index_key,
+                        {index_member: now + MODEL_INSTANCE_TERMINATING_DURATION})
+                    await pipe.execute()
+            elif ttl > 0:
+                await self.cluster.redis.zadd(index_key, {index_member: now + ttl}, nx=True)
+        return True
+
+    async def save(self, fence=None):
         self.storage_context = self.storage_context or {}
         self.serving_context = self.serving_context or {}
-        await self.save_to_redis()
+        if not await self.save_to_redis(fence=fence):
+            return
+        await publish_models_event(self.cluster, "MODEL_INSTANCE_UPDATE", {
+            "namespace_id": self.model.namespace.id,
+            "model_id": self.model.id,
+            "model_version_id": self.model_version.id,
+            "model_instance_id": self.id,
+            "worker_id": self.worker_id,
+            "state": self.state
+            })
     
+    @classmethod
+    def get_index_key(cls, cluster:Cluster, model: Model):
+        return cluster.get_redis_key(
+            model.namespace.id,
+            utils.covert_to_redis_slot(model.id),
+            MODEL_INSTANCES_INDEX_KEY)
+
+    @classmethod
+    async def get_all_ids(cls, cluster:Cluster, model: Model, version:ModelVersion=None):
+        """Returns (version_id, instance_id) tuples of instances not yet expired."""
+        ids = (await cls.get_all_ids_of_models(cluster, [model]))[0]
+        if version is not None:
+            ids = [x for x in ids if x[0] == str(version.id)]
+        return ids
+
+    @classmethod
+    async def get_all_ids_of_models(cls, cluster:Cluster, models: list) -> list:
+        """get_all_ids for many models in one pipeline, one list per model."""
+        if not models:
+            return []
+        now = await cluster.get_time()
+        async with cluster.redis.pipeline(transaction=False) as pipe:
+            for model in models:
+                index_key = cls.get_index_key(cluster, model)
+                pipe.zremrangebyscore(index_key, "-inf", now)
+                pipe.zrangebyscore(index_key, now, "+inf")
+            results = await pipe.execute()
+        return [[tuple(utils.split_redis_key(x)) for x in members] for members in results[1::2]]
+
     @classmethod
     async def get_all_as_list(cls, cluster:Cluster, model: Model, version:ModelVersion=None):
         data = []
-        if version is None:
-            version_id_key = "*" #any version
-        else:
-            version_id_key = version.id
-        async for each in cluster.redis.scan_iter(
+        ids = await cls.get_all_ids(cluster, model, version)
+        all_data = await hgetall_many(cluster, [
             cluster.get_redis_key(
                 model.namespace.id,
                 utils.covert_to_redis_slot(model.id),
-                version_id_key,
-                MODEL_INSTANCE_KEY.format("*")
+                version_id,
+                MODEL_INSTANCE_KEY.format(instance_id)
                 )
-            ):
-            each_data = await cluster.redis.hgetall(each)
-            each_data["id"] = MODEL_INSTANCE_KEY_REGEX.search(each).group(1)
-            each_data["model_version_id"] = utils.split_redis_key(each)[-2]
+            for version_id, instance_id in ids])
+        for (version_id, instance_id), each_data in zip(ids, all_data):
+            if not each_data:
+                continue
+            each_data["id"] = instance_id
+            each_data["model_version_id"] = version_id
             each_data["worker_id"] = each_data["worker_id"]
             each_data["state"] = each_data["state"]
             each_data["storage_context"] = json.loads(each_data["storage_context"])
@@ -288,4 +532,38 @@ class ModelInstance(object):
             each_data["error_messages"] = json.loads(each_data["error_messages"])
             data.append(each_data)
         return sorted(data, key=lambda x: x["model_version_id"], reverse=True)
-    
\ No newline at end of file
+
+
+async def rebuild_indexes(cluster: Cluster):
+    """Populates the secondary indexes from a full keyspace scan.
+
+    Only needed once for clusters created before the indexes existed.
+    """
+    async for each in cluster.redis.scan_iter(
+        cluster.get_redis_key(NAMESPACE_KEY.format('*'))
+        ):
+        ns_id = NAMESPACE_KEY_REGEX.search(each).group(1)
+        await cluster.redis.sadd(cluster.get_redis_key(NAMESPACES_INDEX_KEY), ns_id)
+        async for model_key in cluster.redis.scan_iter(
+            cluster.get_redis_key(ns_id, MODEL_KEY.format('*'))
+            ):
+            model_id = MODEL_KEY_REGEX.search(model_key).group(1)
+            await cluster.redis.sadd(cluster.get_redis_key(ns_id, MODELS_INDEX_KEY), model_id)
+            model_slot = utils.covert_to_redis_slot(model_id)
+            async for version_key in cluster.redis.scan_iter(
+                cluster.get_redis_key(ns_id, model_slot, MODEL_VERSION_KEY.format("*"))
+                ):
+                version_id = MODEL_VERSION_KEY_REGEX.search(version_key).group(1)
+                await cluster.redis.zadd(
+                    cluster.get_redis_key(ns_id, model_slot, MODEL_VERSIONS_INDEX_KEY),
+                    {version_id: int(version_id)})
+            async for instance_key in cluster.redis.scan_iter(
+                cluster.get_redis_key(ns_id, model_slot, "*", MODEL_INSTANCE_KEY.format("*"))
+                ):
+                version_id, instance_key_part = utils.split_redis_key(instance_key)[-2:]
+                instance_id = MODEL_INSTANCE_KEY_REGEX.search(instance_key_part).group(1)
+                ttl = await cluster.redis.ttl(instance_key)
+                await cluster.redis.zadd(
+                    cluster.get_redis_key(ns_id, model_slot, MODEL_INSTANCES_INDEX_KEY),
+                    {utils.get_redis_key(version_id, instance_id): await cluster.get_time() + ttl if ttl > 0 else float("inf")})
+        logging.info("rebuilt indexes of namespace %s", ns_id)
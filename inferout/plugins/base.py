@@ -17,6 +17,9 @@ class Plugin(object):
     def get_serving_port(self) -> int:
         raise NotImplementedError()
     
+    def get_artifact_peer_host(self) -> str:
+        raise NotImplementedError()
+    
     def get_rack_format(self) -> str:
         raise NotImplementedError()
     
@@ -21,6 +21,9 @@ class Plugin(base.Plugin):
     def get_serving_host(self) -> str:
         return self.pod_ip
     
+    def get_artifact_peer_host(self) -> str:
+        return self.pod_ip
+    
     def get_rack_format(self) -> str:
         return "{k8s_rack}"
     
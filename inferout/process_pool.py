@@ -0,0 +1,297 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .exceptions import ServingProcessError
+from . import resources
+
+SERVING_PROCESS_LOAD_OPS = ("load_model", "unload_model")
+
+
+def run_serving_request(serving_engines: dict, loaded_models: dict, op: str, payload: dict):
+    if op == "load_model":
+        serving_engine = serving_engines[payload["serving_engine"]]
+        rss_before = resources.get_process_rss()
+        load_started_at = time.monotonic()
+        serving_context, worker_serving_context = serving_engine.load_model(
+            model_parameters=payload["model_parameters"],
+            storage_context=payload["storage_context"])
+        footprint = {
+            "memory_bytes": max(0, resources.get_process_rss() - rss_before),
+            "load_time": time.monotonic() - load_started_at
+            }
+        loaded_models[payload["key"]] = {
+            "serving_engine": serving_engine,
+            "model_parameters": payload["model_parameters"],
+            "storage_context": payload["storage_context"],
+            "serving_context": serving_context,
+            "worker_serving_context": worker_serving_context
+            }
+        return (serving_context, footprint)
+    elif op == "unload_model":
+        loaded_model = loaded_models.pop(payload["key"])
+        return loaded_model["serving_engine"].unload_model(
+            model_parameters=loaded_model["model_parameters"],
+            storage_context=loaded_model["storage_context"],
+            serving_context=loaded_model["serving_context"],
+            worker_serving_context=loaded_model["worker_serving_context"])
+    elif op == "infer":
+        loaded_model = loaded_models[payload["key"]]
+        return loaded_model["serving_engine"].infer(
+            model_parameters=loaded_model["model_parameters"],
+            storage_context=loaded_model["storage_context"],
+            serving_context=loaded_model["serving_context"],
+            worker_serving_context=loaded_model["worker_serving_context"],
+            data=payload["data"])
+    elif op == "warmup":
+        loaded_model = loaded_models[payload["key"]]
+        return loaded_model["serving_engine"].warmup(
+            model_parameters=loaded_model["model_parameters"],
+            storage_context=loaded_model["storage_context"],
+            serving_context=loaded_model["serving_context"],
+            worker_serving_context=loaded_model["worker_serving_context"],
+            data=payload["data"])
+    elif op == "infer_batch":
+        loaded_model = loaded_models[payload["key"]]
+        return loaded_model["serving_engine"].infer_batch(
+            model_parameters=loaded_model["model_parameters"],
+            storage_context=loaded_model["storage_context"],
+            serving_context=loaded_model["serving_context"],
+            worker_serving_context=loaded_model["worker_serving_context"],
+            data_list=payload["data_list"])
+    else:
+        raise ValueError("Unknown op {}".format(op))
+
+def serve_loads(load_requests: queue.Queue, reply, serving_engines: dict, loaded_models: dict):
+    for request_id, op, payload in iter(load_requests.get, None):
+        try:
+            result = run_serving_request(serving_engines, loaded_models, op, payload)
+        except Exception as e:
+            reply(request_id, False, "{}: {}".format(type(e).__name__, e))
+            continue
+        reply(request_id, True, result)
+
+def serving_process_main(conn, serving_engines: dict):
+    # the worker stops us on shutdown, a ctrl-c in its terminal must not
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    send_lock = threading.Lock()
+    def reply(request_id, ok, result):
+        with send_lock:
+            try:
+                conn.send((request_id, ok, result))
+            except Exception as e:#result not picklable
+                conn.send((request_id, False, "{}: {}".format(type(e).__name__, e)))
+
+    #loads and unloads run on their own thread, inference isn't stuck behind a slow load
+    loaded_models = {}
+    load_requests = queue.Queue()
+    threading.Thread(target=serve_loads,
+        args=(load_requests, reply, serving_engines, loaded_models),
+        name="inferout-serving-process-loads",
+        daemon=True).start()
+    while True:
+        try:
+            #nobody else holds the worker's end of the pipe, EOF once it's gone
+            request_id, op, payload = conn.recv()
+        except EOFError:
+            break
+        if op in SERVING_PROCESS_LOAD_OPS:
+            load_requests.put((request_id, op, payload))
+            continue
+        try:
+            result = run_serving_request(serving_engines, loaded_models, op, payload)
+        except Exception as e:
+            reply(request_id, False, "{}: {}".format(type(e).__name__, e))
+            continue
+        reply(request_id, True, result)
+
+
+class ServingProcess(object):
+    """One child process hosting model instances, talking to the worker over a pipe."""
+    def __init__(self, pool, index: int) -> None:
+        self.pool = pool
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.pending = {}
+        self.request_ids = itertools.count()
+        #single thread keeps messages ordered and keeps blocking sends off the event loop
+        self.send_executor = ThreadPoolExecutor(max_workers=1,
+            thread_name_prefix="inferout-serving-process-{}".format(index))
+        self.loaded_models = {}#key -> load_model payload, replayed on restart
+        self.loading = {}#key -> future of its load_model request
+
+    def start(self):
+        context = self.pool.context
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=serving_process_main,
+            args=(child_conn, self.pool.serving_engines),
+            name="inferout-serving-process-{}".format(self.index),
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        self.pool.loop.add_reader(self.conn.fileno(), self.on_readable)
+        logging.info("serving process %d started, pid=%d", self.index, self.process.pid)
+
+    def stop(self):
+        if self.conn is not None:
+            self.pool.loop.remove_reader(self.conn.fileno())
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+        self.fail_pending("serving process stopped")
+        self.send_executor.shutdown(wait=False)
+
+    def fail_pending(self, reason):
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ServingProcessError(reason))
+
+    def on_readable(self):
+        try:
+            while self.conn.poll():
+                request_id, ok, result = self.conn.recv()
+                future = self.pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(ServingProcessError(result))
+        except (EOFError, OSError):
+            self.restart()
+
+    def restart(self):
+        logging.error("serving process %d exited unexpectedly, exitcode=%s, restarting",
+            self.index, self.process.exitcode if self.process else None)
+        self.pool.loop.remove_reader(self.conn.fileno())
+        self.conn.close()
+        self.conn = None
+        self.process.join()
+        self.fail_pending("serving process crashed")
+        self.start()
+        for payload in self.loaded_models.values():
+            self.send("load_model", payload).add_done_callback(self.on_reload_done)
+
+    def on_reload_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error("serving process %d, error reloading model: %s", self.index, future.exception())
+
+    def on_load_done(self, key, future):
+        if self.loading.get(key) is future:
+            del self.loading[key]
+
+    def send(self, op: str, payload: dict) -> asyncio.Future:
+        request_id = next(self.request_ids)
+        future = self.pool.loop.create_future()
+        self.pending[request_id] = future
+        if op == "load_model":
+            self.loading[payload["key"]] = future
+            future.add_done_callback(partial(self.on_load_done, payload["key"]))
+        send_future = self.pool.loop.run_in_executor(self.send_executor,
+            self.conn.send, (request_id, op, payload))
+        send_future.add_done_callback(partial(self.on_send_done, request_id))
+        return future
+
+    def on_send_done(self, request_id, send_future):
+        if send_future.cancelled() or send_future.exception() is None:
+            return
+        future = self.pending.pop(request_id, None)
+        if future is not None and not future.done():
+            future.set_exception(ServingProcessError(str(send_future.exception())))
+
+    async def call(self, op: str, payload: dict):
+        loading = self.loading.get(payload["key"])
+        if loading is not None and op not in SERVING_PROCESS_LOAD_OPS:
+            #loads run apart from inference in the child, wait for the one reloading the model after a restart
+            await asyncio.wait([loading])
+        return await self.send(op, payload)
+
+
+class ServingProcessPool(object):
+    """Hosts model instances in a pool of child processes.
+
+    Children are forked from a fork server rather than from the worker,
+    which has threads and redis connections by then. The fork server
+    imports the serving engine modules once, so they are shared
+    copy-on-write, and the engines themselves are pickled to each child.
+    Where there is no fork server children are spawned.
+    """
+    def __init__(self, serving_engines: dict, size: int) -> None:
+        self.serving_engines = serving_engines
+        self.size = size
+        self.processes = []
+        self.assigned_processes = {}
+        self.loop = None
+        self.context = None
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            self.context = multiprocessing.get_context("forkserver")
+            self.context.set_forkserver_preload([__name__] + sorted(
+                set(type(x).__module__ for x in self.serving_engines.values())))
+        else:
+            self.context = multiprocessing.get_context("spawn")
+        for index in range(self.size):
+            process = ServingProcess(pool=self, index=index)
+            process.start()
+            self.processes.append(process)
+
+    def shutdown(self):
+        for process in self.processes:
+            process.stop()
+        self.processes = []
+
+    def assign_process(self, key: str) -> ServingProcess:
+        process = self.assigned_processes.get(key)
+        if process is None:
+            process = min(self.processes, key=lambda x: len(x.loaded_models))
+            self.assigned_processes[key] = process
+        return process
+
+    async def load_model(self, key: str, serving_engine: str, model_parameters: dict, storage_context: dict) -> tuple:#serving_context, footprint
+        process = self.assign_process(key)
+        payload = {
+            "key": key,
+            "serving_engine": serving_engine,
+            "model_parameters": model_parameters,
+            "storage_context": storage_context
+            }
+        process.loaded_models[key] = payload
+        try:
+            return await process.call("load_model", payload)
+        except Exception:
+            process.loaded_models.pop(key, None)
+            self.assigned_processes.pop(key, None)
+            raise
+
+    async def unload_model(self, key: str):
+        process = self.assigned_processes.pop(key)
+        process.loaded_models.pop(key, None)
+        await process.call("unload_model", {"key": key})
+
+    async def infer(self, key: str, data: dict) -> dict:
+        return await self.assigned_processes[key].call("infer", {"key": key, "data": data})
+
+    async def warmup(self, key: str, data: dict):
+        return await self.assigned_processes[key].call("warmup", {"key": key, "data": data})
+
+    async def infer_batch(self, key: str, data_list: list) -> list:
+        return await self.assigned_processes[key].call("infer_batch", {"key": key, "data_list": data_list})
@@ -0,0 +1,40 @@
+import os
+import resource
+import shutil
+
+
+def get_memory_info() -> dict:
+    memory_info = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                if key in ("MemTotal", "MemAvailable"):
+                    memory_info[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        pass
+    if "MemTotal" not in memory_info:
+        memory_info["MemTotal"] = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    if "MemAvailable" not in memory_info:
+        memory_info["MemAvailable"] = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    return {
+        "memory_total": memory_info["MemTotal"],
+        "memory_available": memory_info["MemAvailable"]
+        }
+
+def get_process_rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        #peak rss, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def get_capacity(disk_path: str) -> dict:
+    capacity = get_memory_info()
+    capacity["cpu_count"] = os.cpu_count() or 1
+    try:
+        capacity["disk_free"] = shutil.disk_usage(disk_path).free
+    except OSError:
+        capacity["disk_free"] = None
+    return capacity
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import logging
+import time
+
+from .cluster import Cluster
+from . import events
+from . import exceptions
+from .models import (
+    MODELS_CHANNEL_KEY,
+    ModelNamespace,
+    Model,
+    ModelInstance)
+from .worker import WORKER_ACTIVE_STATES
+
+ROUTING_TABLE_SYNC_INTERVAL = 30
+
+
+class RoutingTable(object):
+    """Worker local view of namespaces, models, model instances and workers.
+
+    Kept up to date by events published on MODELS_CHANNEL_KEY and by a
+    periodic full resync, so that the serving API can route requests
+    without touching redis.
+    """
+    def __init__(self, cluster: Cluster, worker) -> None:
+        self.cluster = cluster
+        self.worker = worker
+        self.shutdown_requested = False
+
+        self.namespaces = {}
+        self.workers = {}
+        self.last_synced_at = None
+        self.sync_buffered_events = None
+
+    def _get_model_entry(self, namespace_id, model_id):
+        ns_entry = self.namespaces.setdefault(namespace_id, {"settings": None, "models": {}})
+        return ns_entry["models"].setdefault(model_id, {"latest_version_id": None, "instances": {}})
+
+    def get_namespace_settings(self, namespace_id):
+        try:
+            ns_entry = self.namespaces[namespace_id]
+        except KeyError:
+            raise exceptions.NotFoundException()
+        if ns_entry["settings"] is None:
+            raise exceptions.NotFoundException()
+        return ns_entry["settings"]
+
+    def get_latest_version_id(self, namespace_id, model_id):
+        try:
+            return self.namespaces[namespace_id]["models"][model_id]["latest_version_id"]
+        except KeyError:
+            return None
+
+    def get_model_instances(self, namespace_id, model_id, version_id=None, state="serving"):
+        self.get_namespace_settings(namespace_id)
+        try:
+            instances = self.namespaces[namespace_id]["models"][model_id]["instances"]
+        except KeyError:
+            return []
+        data = [x for x in instances.values()
+            if (state is None or x["state"] == state)
+            and (version_id is None or x["model_version_id"] == int(version_id))]
+        return sorted(data, key=lambda x: x["model_version_id"], reverse=True)
+
+    def get_worker_data(self, worker_id):
+        return self.workers.get(worker_id)
+
+    async def fetch_worker_data(self, worker_id):
+        """Returns cached worker data, reading it from redis only on a cache miss."""
+        worker_data = self.workers.get(worker_id)
+        if worker_data is None:
+            try:
+                worker_data = await self.worker.get_remote_worker_data(worker_id=worker_id)
+            except KeyError:
+                return None
+            if worker_data.get("state") not in WORKER_ACTIVE_STATES:
+                return None
+            self.workers[worker_id] = worker_data
+        return worker_data
+
+    def apply_namespace_update(self, event_data):
+        ns_entry = self.namespaces.setdefault(event_data["namespace_id"], {"settings": None, "models": {}})
+        ns_entry["settings"] = event_data["settings"]
+
+    def apply_model_update(self, event_data):
+        model_entry = self._get_model_entry(event_data["namespace_id"], event_data["model_id"])
+        model_entry["latest_version_id"] = int(event_data["latest_version_id"])
+
+    def apply_model_instance_update(self, event_data):
+        model_entry = self._get_model_entry(event_data["namespace_id"], event_data["model_id"])
+        model_entry["instances"][event_data["model_instance_id"]] = {
+            "id": event_data["model_instance_id"],
+            "model_version_id": int(event_data["model_version_id"]),
+            "worker_id": event_data["worker_id"],
+            "state": event_data["state"]
+            }
+
+    def apply_worker_update(self, event_data) -> bool:
+        """Returns whether the worker data has to be read from redis."""
+        worker_id = event_data["worker_id"]
+        if event_data["state"] not in WORKER_ACTIVE_STATES:
+            self.workers.pop(worker_id, None)
+            return False
+        if event_data.get("worker_data"):
+            self.workers[worker_id] = event_data["worker_data"]
+            return False
+        return True
+
+    async def sync_once(self):
+        """Replaces the table with a fresh read of redis.
+
+        Events handled while reading are newer than some of what is read,
+        they are applied again on top of it.
+        """
+        self.sync_buffered_events = []
+        try:
+            cluster = self.cluster
+            namespaces = {}
+            for ns_data in await ModelNamespace.get_all_as_list(cluster):
+                ns = ModelNamespace(cluster=cluster, id=ns_data["id"])
+                models = {}
+                for model_data in await Model.get_all_as_list(cluster, ns):
+                    model = Model(namespace=ns, id=model_data["id"])
+                    instances = {}
+                    for instance_data in await ModelInstance.get_all_as_list(cluster, model):
+                        instances[instance_data["id"]] = {
+                            "id": instance_data["id"],
+                            "model_version_id": int(instance_data["model_version_id"]),
+                            "worker_id": instance_data["worker_id"],
+                            "state": instance_data["state"]
+                            }
+                    models[model.id] = {
+                        "latest_version_id": model_data["latest_version_id"],
+                        "instances": instances
+                        }
+                namespaces[ns.id] = {"settings": ns_data["settings"], "models": models}
+            workers = {}
+            for worker_data in await self.worker.get_all_workers_data():
+                if worker_data["state"] in WORKER_ACTIVE_STATES:
+                    workers[worker_data["id"]] = worker_data
+            self.namespaces = namespaces
+            self.workers = workers
+            for event_type, event_data in self.sync_buffered_events:
+                if self.apply_event(event_type, event_data):
+                    #read again when next needed
+                    self.workers.pop(event_data["worker_id"], None)
+            self.last_synced_at = time.time()
+            logging.debug("routing table synced, namespaces=%d workers=%d", len(namespaces), len(workers))
+        finally:
+            self.sync_buffered_events = None
+
+    async def sync_forever(self):
+        while not self.shutdown_requested:
+            try:
+                await self.sync_once()
+            except Exception as e:
+                logging.exception(e)
+                logging.error("error syncing routing table")
+            slept = 0
+            while slept < ROUTING_TABLE_SYNC_INTERVAL and not self.shutdown_requested:
+                await asyncio.sleep(1)
+                slept += 1
+
+    async def channel_reader(self):
+        while not self.shutdown_requested:
+            #blocks until a message arrives or a second has passed
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+            if message is not None:
+                logging.debug(f"(Routing Reader) Message Received: {message}")
+                data = json.loads(message["data"])
+                await self.handle_event(data["event_type"], data["event_data"])
+        self.event_stream_reader.shutdown_requested = True
+
+    def apply_event(self, event_type, event_data) -> bool:
+        """Applies an event to the table, returns whether worker data has to be read from redis."""
+        if event_type == "NAMESPACE_UPDATE":
+            self.apply_namespace_update(event_data)
+        elif event_type == "MODEL_UPDATE":
+            self.apply_model_update(event_data)
+        elif event_type == "MODEL_INSTANCE_UPDATE":
+            self.apply_model_instance_update(event_data)
+        elif event_type == "WORKER_UPDATE":
+            return self.apply_worker_update(event_data)
+        else:
+            logging.debug("Event type %s not used for routing, skipping", event_type)
+        return False
+
+    async def handle_event(self, event_type, event_data):
+        if self.sync_buffered_events is not None:
+            self.sync_buffered_events.append((event_type, event_data))
+        if self.apply_event(event_type, event_data):
+            await self.fetch_worker_data(event_data["worker_id"])
+
+    async def read_event_stream(self):
+        #stopped along with channel_reader
+        await self.event_stream_reader.read_forever()
+        await self.event_stream_reader.delete()
+
+    async def read_events(self):
+        await asyncio.gather(self.channel_reader(), self.read_event_stream())
+
+    async def setup_pubsub(self):
+        from .scheduler import SCHEDULER_KEY
+        self.pubsub = self.cluster.redis.pubsub()
+        await self.pubsub.subscribe(
+            self.cluster.get_redis_channel_key(MODELS_CHANNEL_KEY)
+            )
+        #worker updates come over the scheduler event stream
+        self.event_stream_reader = events.EventStreamReader(cluster=self.cluster,
+            stream_name=SCHEDULER_KEY,
+            group=events.get_consumer_group_name("routing", self.worker.id),
+            consumer=self.worker.id,
+            handler=self.handle_event)
+        await self.event_stream_reader.setup()
+        return self.read_events()
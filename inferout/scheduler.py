@@ -1,39 +1,40 @@
 import asyncio
-from asyncio.tasks import sleep
-from copy import deepcopy
+from collections import Counter
 import json
+import math
+import random
 import time
 
-import aioredis
-import async_timeout
 from . import exceptions
 
-from configargparse import Namespace
-from inferout.management_api import workers
 import logging
 
 from .cluster import Cluster
+from .leases import Lease
+from . import events
+from . import autoscaling
 from . import utils
-from .storage_engines.base import StorageEngine
-from .serving_engines.base import ServingEngine
-from .worker import (Worker, WORKER_KEY)
+from .worker import (Worker, WORKER_KEY, WORKER_ACTIVE_STATES)
+from . import models
 from .models import (
-    MODEL_INSTANCE_KEY,
     ModelNamespace,
     Model,
     ModelVersion,
     ModelInstance,
-    MODEL_KEY,
-    MODEL_KEY_REGEX,
-    MODEL_INSTANCE_KEY_REGEX)
-from . import utils
+    MODELS_INDEX_KEY)
 
 SCHEDULER_INTERVAL = 5
+SCHEDULER_FULL_RECONCILE_INTERVAL = 60
+SCHEDULER_ACTIVE_WORKERS_REFRESH_INTERVAL = 1
 SCHEDULER_SLEEP_WARNNING_DURATION = 3
-SCHEDULER_LOCK_ERROR_SLEEP_DURATION = 0.5
+SCHEDULER_LEASE_DURATION = 10
+SCHEDULER_STANDBY_CHECK_INTERVAL = 5 # standbys look for free shards this often, or when one is handed over
 SCHEDULER_KEY = "@scheduler"
+UNSCHEDULABLE_MODELS_KEY = "@unschedulable_models" # set of namespace::model ids short of instances for lack of workers, per shard
 MODEL_INSTANCE_SCHEDULED_SLEEP_DURATION = 0.1
 MAX_MODEL_INSTANCE_SCHEDULED_PER_CYCLE = 20
+SCHEDULER_READ_BATCH_SIZE = 500
+LEAVING_STATES = ("draining", "terminating") # model instances on their way out, not counted as replicas
 
 class Scheduler(object):
     def __init__(self, cluster: Cluster, worker: Worker) -> None:
@@ -42,196 +43,558 @@ class Scheduler(object):
         self.shutdown_requested = False
 
         self.active_workers_map = {}
+        self.active_workers_refreshed_at = 0
+        self.active_workers_refresh_lock = asyncio.Lock()
+        self.pending_memory = Counter()
+
+        self.owned_shards = set()
+        self.shard_tasks = {}
+        self.shard_released_event = asyncio.Event()
+        self.event_stream_reader = None
+        self.leases = {x: Lease(cluster=cluster, name=utils.get_redis_key(SCHEDULER_KEY, str(x)),
+            holder_id=worker.id, duration=SCHEDULER_LEASE_DURATION) for x in range(cluster.scheduler_shards)}
+        self.dirty_models_events = {x: asyncio.Event() for x in range(cluster.scheduler_shards)}
+        self.next_full_reconcile_at = {}
+
+    async def select_worker(self, model_version: ModelVersion, model_instances: list):
+        """Picks a worker for a new instance of model_version.
 
-    async def select_worker(self, model_version: ModelVersion):
-        storage_engine = model_version.model.namespace.settings.get("storage_engine")
-        serving_engine = model_version.model.namespace.settings.get("serving_engine")
-        workers = self.active_workers_map.values()
+        model_instances are the live instances of the same model, replicas
+        are spread across workers and racks as per the namespace placement
+        settings, then the least loaded worker wins.
+        """
+        settings = model_version.model.namespace.settings
+        storage_engine = settings.get("storage_engine")
+        serving_engine = settings.get("serving_engine")
+        placement = settings.get("placement") or {}
+        worker_anti_affinity = placement.get("worker_anti_affinity", "none")
+        rack_spread = placement.get("rack_spread", "none")
+        max_rack_skew = int(placement.get("max_rack_skew", 1))
+
+        #draining workers are on their way out
+        workers = filter(lambda x: x["state"] == "serving", self.active_workers_map.values())
         if storage_engine:
             workers = filter(lambda x: storage_engine in x["available_storage_engines"], workers)
         if serving_engine:
             workers = filter(lambda x: serving_engine in x["available_serving_engines"], workers)
-        
-        workers = sorted(workers, key=lambda x: int(x["model_instances_count"]))
+        workers = list(workers)
+
+        worker_counts = Counter()
+        rack_counts = Counter()
+        for each in model_instances:
+            worker_counts[each.worker_id] += 1
+            worker_data = self.active_workers_map.get(each.worker_id)
+            if worker_data is not None:
+                rack_counts[worker_data["rack"]] += 1
+
+        if worker_anti_affinity == "required":
+            workers = [x for x in workers if worker_counts[x["id"]] == 0]
+        if rack_spread == "required" and workers:
+            min_rack_count = min(rack_counts[x["rack"]] for x in workers)
+            workers = [x for x in workers if rack_counts[x["rack"]] + 1 - min_rack_count <= max_rack_skew]
+
+        memory_bytes = self.get_required_memory(model_version)
+        workers = [x for x in workers if self.get_remaining_memory(x, memory_bytes, settings) >= 0]
+
+        workers = sorted(workers, key=lambda x: (
+            rack_counts[x["rack"]] if rack_spread != "none" else 0,
+            worker_counts[x["id"]] if worker_anti_affinity != "none" else 0,
+            self.get_remaining_memory(x, memory_bytes, settings),#best fit
+            int(x["model_instances_count"])))
         return workers[0]["id"] if workers else None
+
+    def get_required_memory(self, model_version: ModelVersion):
+        footprint = model_version.footprint or {}
+        resources_settings = model_version.model.namespace.settings.get("resources") or {}
+        return int(footprint.get("memory_bytes") or resources_settings.get("default_memory_bytes") or 0)
+
+    def get_remaining_memory(self, worker_data, memory_bytes, settings):
+        """Memory left on the worker after placing memory_bytes, negative if it does not fit.
+
+        Reservations are the measured footprints of the instances a worker
+        hosts plus those scheduled on it during this cycle, they may add up
+        to memory_overcommit_ratio of its memory. Without overcommit the
+        memory actually available must also cover the new instance.
+        """
+        capacity = worker_data.get("capacity") or {}
+        if not capacity.get("memory_total"):
+            return float("inf")#worker does not report capacity
+        resources_settings = settings.get("resources") or {}
+        headroom = capacity["memory_total"] * float(resources_settings.get("memory_headroom_ratio", 0))
+        overcommit_ratio = float(resources_settings.get("memory_overcommit_ratio", 1))
+        pending = self.pending_memory[worker_data["id"]]
+        #on demand instances are a cache the worker evicts to make room
+        on_demand = worker_data.get("memory_reserved_on_demand", 0)
+        remaining = (capacity["memory_total"] * overcommit_ratio - headroom
+            - (worker_data.get("memory_reserved", 0) - on_demand) - pending - memory_bytes)
+        if overcommit_ratio <= 1:
+            remaining = min(remaining, capacity["memory_available"] + on_demand - headroom - pending - memory_bytes)
+        return remaining
     
     async def refresh_active_workers_data(self):
-        active_workers_map = {}
-        for each_worker in await self.worker.get_all_workers_data():
-            if each_worker["state"]=="serving":
-                active_workers_map[each_worker["id"]] = each_worker
-        self.active_workers_map = active_workers_map
+        """Re-reads active workers, at most once per SCHEDULER_ACTIVE_WORKERS_REFRESH_INTERVAL for all shards."""
+        async with self.active_workers_refresh_lock:
+            if time.time() - self.active_workers_refreshed_at < SCHEDULER_ACTIVE_WORKERS_REFRESH_INTERVAL:
+                return
+            active_workers_map = {}
+            for each_worker in await self.worker.get_all_workers_data():
+                if each_worker["state"] in WORKER_ACTIVE_STATES:
+                    active_workers_map[each_worker["id"]] = each_worker
+            workers_left = set(self.active_workers_map) - set(active_workers_map)
+            workers_joined = set(active_workers_map) - set(self.active_workers_map)
+            workers_draining = set(x for x, worker_data in active_workers_map.items()
+                if worker_data["state"] == "draining"
+                and (self.active_workers_map.get(x) or {}).get("state") != "draining")
+            self.active_workers_map = active_workers_map
+            self.active_workers_refreshed_at = time.time()
+            self.pending_memory = Counter()
+            if workers_left:
+                await self.handle_workers_left(workers_left)
+            if workers_joined:
+                await self.handle_workers_joined()
+            if workers_draining:
+                await self.handle_workers_draining(workers_draining)
 
-    async def schedule_once(self):
-        instances_scheduled_count = 0
+    async def handle_workers_left(self, worker_ids):
+        """Marks models that had instances on the given workers dirty."""
         cluster = self.cluster
-        async for each in cluster.redis.scan_iter(
-            cluster.get_redis_key(
-                "*",#any namespace
-                MODEL_KEY.format("*"),#any model
-                )
-            ):
-
-            ns_id, model_key = utils.split_redis_key(each)[1:]
-            model_id = MODEL_KEY_REGEX.search(model_key).group(1)
-            ns = ModelNamespace(cluster=cluster, id=ns_id)
-            try:
-                await ns.read()
-            except exceptions.NotFoundException:
-                continue
-            model = Model(namespace=ns,id=model_id)
-            try:
-                await model.read()
-            except exceptions.NotFoundException:
-                continue
-            logging.debug("looking for pending model instances of namespace=%s model=%s version=%s", ns.id, model.id, model.latest_version_id)
-            latest_model_instances = []
-            outdated_model_instances = []
-            async for each_instance_key in cluster.redis.scan_iter(
-                cluster.get_redis_key(
-                    ns.id,
-                    utils.covert_to_redis_slot(model.id),
-                    "*", #any version
-                    MODEL_INSTANCE_KEY.format("*") #any instance
-                    )
-                ):
-                logging.debug("each_instance_key %s", each_instance_key)
-                version_id, instance_key = utils.split_redis_key(each_instance_key)[-2:]
+        index_keys = [cluster.get_redis_key(models.WORKER_MODELS_INDEX_KEY.format(x)) for x in worker_ids]
+        async with cluster.redis.pipeline(transaction=True) as pipe:
+            pipe.sunion(index_keys)
+            pipe.delete(*index_keys)
+            model_keys, _deleted = await pipe.execute()
+        await models.mark_models_dirty(cluster, list(model_keys))
+        for worker_id in worker_ids:
+            await cluster.redis.delete(events.get_stream_key(cluster, WORKER_KEY.format(worker_id)))
+            await events.delete_consumer_groups(cluster, SCHEDULER_KEY, worker_id)
+        self.wake_up_shards(self.owned_shards)
+
+    async def handle_workers_draining(self, worker_ids):
+        """Marks models that have instances on the given workers dirty, for replacements to be placed."""
+        cluster = self.cluster
+        model_keys = await cluster.redis.sunion(
+            [cluster.get_redis_key(models.WORKER_MODELS_INDEX_KEY.format(x)) for x in worker_ids])
+        await models.mark_models_dirty(cluster, list(model_keys))
+        self.wake_up_shards(self.owned_shards)
+
+    async def handle_workers_joined(self):
+        """Marks models of the owned shards that are short of instances for lack of workers dirty.
+
+        Shards owned by other workers are handled by them, they see the same worker joining.
+        """
+        cluster = self.cluster
+        async with cluster.redis.pipeline(transaction=False) as pipe:
+            for shard in self.owned_shards:
+                pipe.sunionstore(models.get_dirty_models_key(cluster, shard),
+                    [models.get_dirty_models_key(cluster, shard), self.get_unschedulable_models_key(shard)])
+            await pipe.execute()
+        self.wake_up_shards(self.owned_shards)
+
+    def get_unschedulable_models_key(self, shard: int) -> str:
+        return self.cluster.get_redis_key(UNSCHEDULABLE_MODELS_KEY, str(shard))
+
+    def wake_up_shards(self, shards):
+        for shard in shards:
+            self.dirty_models_events[shard].set()
+
+    def get_fair_share(self) -> int:
+        """Number of shards this worker may own, so leadership spreads across workers."""
+        serving_workers_count = len([x for x in self.active_workers_map.values() if x["state"] == "serving"])
+        return math.ceil(self.cluster.scheduler_shards / max(1, serving_workers_count))
+
+    async def get_all_model_keys(self):
+        cluster = self.cluster
+        ns_ids = list(await ModelNamespace.get_all_ids(cluster))
+        async with cluster.redis.pipeline(transaction=False) as pipe:
+            for ns_id in ns_ids:
+                pipe.smembers(cluster.get_redis_key(ns_id, MODELS_INDEX_KEY))
+            results = await pipe.execute()
+        return [(ns_id, model_id) for ns_id, model_ids in zip(ns_ids, results) for model_id in model_ids]
+
+    async def load_models(self, model_keys: list) -> list:
+        """Reads models, their latest versions and their instances with a handful of pipelines.
+
+        Returns (model, model_instances) tuples, models missing in redis are skipped.
+        """
+        cluster = self.cluster
+        namespaces = {}
+        for ns_id, _model_id in model_keys:
+            if ns_id not in namespaces:
+                namespaces[ns_id] = ModelNamespace(cluster=cluster, id=ns_id)
+        found_namespaces = {x.id: x for x in await models.read_many(cluster, list(namespaces.values()))}
+
+        all_models = [Model(namespace=found_namespaces[ns_id], id=model_id)
+            for ns_id, model_id in model_keys if ns_id in found_namespaces]
+        all_models = await models.read_many(cluster, all_models)
+        for model in all_models:
+            model.latest_version = ModelVersion(model=model, id=model.latest_version_id)
+        found_versions = set(map(id, await models.read_many(cluster, [x.latest_version for x in all_models])))
+        all_models = [x for x in all_models if id(x.latest_version) in found_versions]
+
+        all_instances = []
+        models_instances = []
+        for model, instance_ids in zip(all_models, await ModelInstance.get_all_ids_of_models(cluster, all_models)):
+            model_versions = {model.latest_version_id: model.latest_version}
+            model_instances = []
+            for version_id, instance_id in instance_ids:
                 version_id = int(version_id)
-                instance_id = MODEL_INSTANCE_KEY_REGEX.search(instance_key).group(1)
+                if version_id not in model_versions:
+                    model_versions[version_id] = ModelVersion(model=model, id=version_id)
+                model_instances.append(ModelInstance(model_version=model_versions[version_id], id=instance_id))
+            all_instances.extend(model_instances)
+            models_instances.append(model_instances)
+        found_instances = set(map(id, await models.read_many(cluster, all_instances)))
+        return [(model, [x for x in model_instances if id(x) in found_instances])
+            for model, model_instances in zip(all_models, models_instances)]
 
-                model_version = ModelVersion(model=model, id=version_id)
-                try:
-                    await model_version.read()
-                except exceptions.NotFoundException:
-                    continue
+    async def schedule_once(self, shard: int):
+        """Full reconcile of every model of the shard."""
+        model_keys = [x for x in await self.get_all_model_keys()
+            if models.get_model_shard(self.cluster, models.get_model_key(*x)) == shard]
+        await self.schedule_models(shard, model_keys)
 
-                model_instance = ModelInstance(model_version=model_version,id=instance_id)
-                try:
-                    await model_instance.read()
-                except exceptions.NotFoundException:
-                    continue
-                if model_instance.state != "terminating" and (model_instance.worker_id not in self.active_workers_map):
-                    model_instance.state = "terminating"
-                    await model_instance.save()
-                    continue
-                if model.latest_version_id == model_instance.model_version_id:
-                    latest_model_instances.append(model_instance)
-                else:
-                    outdated_model_instances.append(model_instance)
-            logging.debug("outdated_model_instances: %s", ",".join([x.id for x in outdated_model_instances]))
-            logging.debug("latest_model_instances: %s", ",".join([x.id for x in latest_model_instances]))
-            
-            latest_serving_model_instances = list(filter(lambda x: x.state=="serving",latest_model_instances))
-            if len(latest_serving_model_instances) >= int(ns.settings["instances_per_model"]["target"]):
-                for outdated_model_instance in outdated_model_instances:
-                    if outdated_model_instance.state == "terminating":
-                        continue
-                    event_data = {
-                        "namespace_id": ns.id,
-                        "model_id": outdated_model_instance.model.id,
-                        "model_version_id": outdated_model_instance.model_version.id,
-                        "model_instance_id": outdated_model_instance.id,
-                        "worker_id": outdated_model_instance.worker_id
-                        }
-                    await self.cluster.redis.publish(
-                        self.cluster.get_redis_channel_key(
-                            WORKER_KEY.format(outdated_model_instance.worker_id)
-                        ),
-                        message=json.dumps({
-                                "event_type": "TERMINATE_MODEL_INSTANCE",
-                                "event_data": event_data
-                            })
-                    )
-                    logging.info("terminating model instance %s", event_data)
-
-            no_new_instances_required = int(ns.settings["instances_per_model"]["target"]) - len(latest_model_instances)
-            logging.debug("New model instances required: %d.", no_new_instances_required)
-
-            for i in range(no_new_instances_required):
-                new_model_instance = ModelInstance(
-                    model_version=model.latest_version,
-                    id=utils.get_uuid_as_string())
-                new_model_instance.worker_id = await self.select_worker(
-                    model_version=model.latest_version)
-                if new_model_instance.worker_id is None:
-                    logging.error("No sutable workers available for namespace=%s model=%s version=%s",ns.id,model.id, model.latest_version_id)
-                    break
-                new_model_instance.state = "scheduled"
-                await new_model_instance.save()
-                event_data = {
-                    "namespace_id": ns.id,
-                    "model_id": new_model_instance.model.id,
-                    "model_version_id": new_model_instance.model_version.id,
-                    "model_instance_id": new_model_instance.id,
-                    "worker_id": new_model_instance.worker_id
-                    }
-                await self.cluster.redis.publish(
-                    self.cluster.get_redis_channel_key(
-                        WORKER_KEY.format(new_model_instance.worker_id)
-                    ),
-                    message=json.dumps({
-                            "event_type": "MODEL_INSTANCE_SCHEDULED",
-                            "event_data": event_data
-                        })
-                )
-                logging.info("scheduled model instance %s", event_data)
-                instances_scheduled_count +=1
+    async def schedule_dirty_models(self, shard: int):
+        """Reconciles only the models of the shard marked dirty since the last pass."""
+        model_keys = await self.cluster.redis.spop(
+            models.get_dirty_models_key(self.cluster, shard), SCHEDULER_READ_BATCH_SIZE)
+        if not model_keys:
+            return
+        logging.debug("reconciling %d dirty models of shard %d", len(model_keys), shard)
+        await self.schedule_models(shard, [tuple(utils.split_redis_key(x)) for x in model_keys])
+        if len(model_keys) >= SCHEDULER_READ_BATCH_SIZE:
+            self.dirty_models_events[shard].set()
+
+    async def schedule_models(self, shard: int, model_keys: list):
+        instances_scheduled_count = 0
+        for i in range(0, len(model_keys), SCHEDULER_READ_BATCH_SIZE):
+            for model, model_instances in await self.load_models(model_keys[i:i+SCHEDULER_READ_BATCH_SIZE]):
                 if(instances_scheduled_count>=MAX_MODEL_INSTANCE_SCHEDULED_PER_CYCLE):
-                    logging.warning("instances_scheduled_count=%d, reached max limit per cycle, skipping other pending",
-                    instances_scheduled_count)
-                    return
-                await asyncio.sleep(MODEL_INSTANCE_SCHEDULED_SLEEP_DURATION)
+                    #left for the next pass
+                    await models.mark_models_dirty(self.cluster, [models.get_model_key(model.namespace.id, model.id)])
+                    continue
+                instances_scheduled_count += await self.schedule_model(model, model_instances,
+                    max_instances_to_schedule=MAX_MODEL_INSTANCE_SCHEDULED_PER_CYCLE-instances_scheduled_count)
+        if(instances_scheduled_count>=MAX_MODEL_INSTANCE_SCHEDULED_PER_CYCLE):
+            logging.warning("instances_scheduled_count=%d, reached max limit per cycle of shard %d, skipping other pending",
+            instances_scheduled_count, shard)
+            self.dirty_models_events[shard].set()
+
+    async def get_target_instances(self, model: Model, lease: Lease) -> int:
+        """Instances the model should have, autoscaled between instances_per_model min and max when enabled."""
+        settings = model.namespace.settings
+        target = int(settings["instances_per_model"]["target"])
+        if not (settings.get("autoscaling") or {}).get("enabled"):
+            return target
+        load_key = autoscaling.get_model_load_key(self.cluster, model.namespace.id, model.id)
+        autoscaling_key = autoscaling.get_model_autoscaling_key(self.cluster, model.namespace.id, model.id)
+        async with self.cluster.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(load_key)
+            pipe.hgetall(autoscaling_key)
+            loads, state = await pipe.execute()
+        now = time.time()
+        current = int(state["instances"]) if state else target
+        scaled_at = float(state["scaled_at"]) if state else now
+        desired = autoscaling.get_desired_instances(current, scaled_at,
+            [json.loads(x) for x in loads.values()], settings, now)
+        if not state or desired != current:
+            if desired != current:
+                logging.info("autoscaling namespace=%s model=%s from %d to %d instances",
+                    model.namespace.id, model.id, current, desired)
+            await lease.check()
+            await self.cluster.redis.hset(autoscaling_key, mapping={"instances": desired, "scaled_at": now})
+        return desired
+
+    def get_model_instance_load(self, model_instance: ModelInstance) -> int:
+        worker_data = self.active_workers_map.get(model_instance.worker_id) or {}
+        load = (worker_data.get("model_instances_load") or {}).get(model_instance.id) or {}
+        return load.get("in_flight", 0) + load.get("queued", 0)
+
+    async def drain_model_instance(self, model_instance: ModelInstance, lease: Lease):
+        """Has the worker stop routing to the instance, finish its requests and unload it.
+
+        Instances not serving have nothing to drain, they are terminated
+        right away, even if their worker hasn't loaded them yet.
+        """
+        if model_instance.state != "serving":
+            model_instance.state = "terminating"
+            await model_instance.save(fence=lease)
+        event_data = {
+            "namespace_id": model_instance.model.namespace.id,
+            "model_id": model_instance.model.id,
+            "model_version_id": model_instance.model_version.id,
+            "model_instance_id": model_instance.id,
+            "worker_id": model_instance.worker_id
+            }
+        await lease.check()
+        await events.publish_event(self.cluster, WORKER_KEY.format(model_instance.worker_id),
+            "TERMINATE_MODEL_INSTANCE", event_data)
+        logging.info("terminating model instance %s", event_data)
+        if model_instance.state == "serving":
+            #after the event, an instance never gets stuck draining if we lose the lease in between
+            model_instance.state = "draining"
+            await model_instance.save(fence=lease)
+
+    async def schedule_model(self, model: Model, model_instances: list, max_instances_to_schedule: int) -> int:
+        """Reconciles the instances of one model, returns the number of instances scheduled."""
+        instances_scheduled_count = 0
+        ns = model.namespace
+        model_key = models.get_model_key(ns.id, model.id)
+        shard = models.get_model_shard(self.cluster, model_key)
+        unschedulable_models_key = self.get_unschedulable_models_key(shard)
+        lease = self.leases[shard]
+        logging.debug("looking for pending model instances of namespace=%s model=%s version=%s", ns.id, model.id, model.latest_version_id)
+        latest_model_instances = []
+        outdated_model_instances = []
+        for model_instance in model_instances:
+            if model_instance.state != "terminating" and (model_instance.worker_id not in self.active_workers_map):
+                model_instance.state = "terminating"
+                await model_instance.save(fence=lease)
+                continue
+            if model.latest_version_id == model_instance.model_version_id:
+                latest_model_instances.append(model_instance)
+            else:
+                outdated_model_instances.append(model_instance)
+        logging.debug("outdated_model_instances: %s", ",".join([x.id for x in outdated_model_instances]))
+        logging.debug("latest_model_instances: %s", ",".join([x.id for x in latest_model_instances]))
+        
+        #on demand models are loaded by workers on first request and evicted when idle, never scheduled
+        on_demand = bool((ns.settings.get("on_demand") or {}).get("enabled"))
+        target_instances = 0 if on_demand else await self.get_target_instances(model, lease)
+        live_model_instances = [x for x in latest_model_instances if x.state not in LEAVING_STATES]
+        live_outdated_model_instances = [x for x in outdated_model_instances if x.state not in LEAVING_STATES]
+        #workers may have left while we awaited, their instances are gone and get replaced
+        gone_model_instances = [x for x in live_model_instances + live_outdated_model_instances
+            if x.worker_id not in self.active_workers_map]
+        for gone_model_instance in gone_model_instances:
+            gone_model_instance.state = "terminating"
+            await gone_model_instance.save(fence=lease)
+        live_model_instances = [x for x in live_model_instances if x not in gone_model_instances]
+        live_outdated_model_instances = [x for x in live_outdated_model_instances if x not in gone_model_instances]
+        #instances on draining workers are replaced, and serve until their replacements do
+        handed_off_model_instances = [x for x in live_model_instances
+            if (self.active_workers_map.get(x.worker_id) or {}).get("state") == "draining"]
+        live_model_instances = [x for x in live_model_instances if x not in handed_off_model_instances]
+
+        rollout_settings = ns.settings.get("rollout") or {}
+        max_unavailable = max(0, int(rollout_settings.get("max_unavailable", 0)))
+        max_surge = max(0 if max_unavailable else 1, int(rollout_settings.get("max_surge", 1)))#or no rollout could start
+
+        retiring_model_instances = live_outdated_model_instances + handed_off_model_instances
+        if not on_demand and retiring_model_instances:
+            #rolling update or hand off, serving instances never drop below target - max_unavailable
+            available = len([x for x in live_model_instances + retiring_model_instances if x.state == "serving"])
+            removable = available - (target_instances - max_unavailable)
+            for retiring_model_instance in sorted(retiring_model_instances, key=lambda x: (
+                    x.state == "serving", self.get_model_instance_load(x))):
+                if retiring_model_instance.state == "serving":#the others can always go
+                    if removable <= 0:
+                        break
+                    removable -= 1
+                await self.drain_model_instance(retiring_model_instance, lease)
+                if retiring_model_instance in live_outdated_model_instances:
+                    live_outdated_model_instances.remove(retiring_model_instance)
+
+        if not on_demand and len(live_model_instances) > target_instances:
+            #scaled down, instances still loading go first, then the least busy ones
+            excess_model_instances = sorted(live_model_instances, key=lambda x: (
+                x.state == "serving", self.get_model_instance_load(x)))[:len(live_model_instances) - target_instances]
+            for excess_model_instance in excess_model_instances:
+                await self.drain_model_instance(excess_model_instance, lease)
+
+        #replacements of handed off instances are placed right away, not held back by max_surge
+        no_new_instances_required = target_instances - len(live_model_instances)
+        if live_outdated_model_instances:
+            no_new_instances_required = min(no_new_instances_required,
+                target_instances + max_surge - len(live_model_instances) - len(live_outdated_model_instances))
+        logging.debug("New model instances required: %d.", no_new_instances_required)
+
+        #replicas are spread among live instances only, the others are on their way out
+        placed_model_instances = list(live_model_instances)
+        for i in range(no_new_instances_required):
+            new_model_instance = ModelInstance(
+                model_version=model.latest_version,
+                id=utils.get_uuid_as_string())
+            new_model_instance.worker_id = await self.select_worker(
+                model_version=model.latest_version,
+                model_instances=placed_model_instances)
+            if new_model_instance.worker_id is None:
+                logging.error("No sutable workers available for namespace=%s model=%s version=%s",ns.id,model.id, model.latest_version_id)
+                await self.cluster.redis.sadd(unschedulable_models_key, model_key)
+                return instances_scheduled_count
+            new_model_instance.state = "scheduled"
+            await new_model_instance.save(fence=lease)
+            event_data = {
+                "namespace_id": ns.id,
+                "model_id": new_model_instance.model.id,
+                "model_version_id": new_model_instance.model_version.id,
+                "model_instance_id": new_model_instance.id,
+                "worker_id": new_model_instance.worker_id
+                }
+            await events.publish_event(self.cluster, WORKER_KEY.format(new_model_instance.worker_id),
+                "MODEL_INSTANCE_SCHEDULED", event_data)
+            logging.info("scheduled model instance %s", event_data)
+            placed_model_instances.append(new_model_instance)
+            if new_model_instance.worker_id in self.active_workers_map:#may have left while saving
+                self.active_workers_map[new_model_instance.worker_id]["model_instances_count"] += 1
+            self.pending_memory[new_model_instance.worker_id] += self.get_required_memory(model.latest_version)
+            instances_scheduled_count +=1
+            if(instances_scheduled_count>=max_instances_to_schedule):
+                if instances_scheduled_count < no_new_instances_required:
+                    await models.mark_models_dirty(self.cluster, [model_key])
+                break
+            await asyncio.sleep(MODEL_INSTANCE_SCHEDULED_SLEEP_DURATION)
+        await self.cluster.redis.srem(unschedulable_models_key, model_key)
+        return instances_scheduled_count
 
     async def handle_worker_update(self, event_data):
         logging.debug("handle_worker_update %s", event_data)
         worker_id = event_data["worker_id"]
-        worker_data = await self.worker.get_remote_worker_data(worker_id=worker_id)
-        if worker_data["state"] == "serving":
+        worker_data = event_data.get("worker_data") or await self.worker.get_remote_worker_data(worker_id=worker_id)
+        if worker_data["state"] in WORKER_ACTIVE_STATES:
+            previous_state = (self.active_workers_map.get(worker_id) or {}).get("state")
             self.active_workers_map[worker_id] = worker_data
+            if worker_data["state"] == "serving" and previous_state is None:
+                await self.handle_workers_joined()
+            elif worker_data["state"] == "draining" and previous_state != "draining":
+                await self.handle_workers_draining([worker_id])
         else:
             if worker_id in self.active_workers_map:
                 del self.active_workers_map[worker_id]
+                await self.handle_workers_left([worker_id])
 
     async def channel_reader(self):
         while not self.shutdown_requested:
-            message = None
-            try:
-                async with async_timeout.timeout(1):
-                    message = await self.pubsub.get_message(ignore_subscribe_messages=True)
-                    await asyncio.sleep(0.01)
-            except asyncio.TimeoutError:
-                pass
+            #blocks until a message arrives or a second has passed
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
             if message is not None:
                 logging.debug(f"(Scheduler Reader) Message Received: {message}")
                 data = json.loads(message["data"])
-                if data["event_type"] == "WORKER_UPDATE":
-                    await self.handle_worker_update(data["event_data"])
-                else:
-                    logging.info("Unknown event type %s, skipping", data["event_type"])
-    
+                await self.handle_event(data["event_type"], data["event_data"])
+        self.event_stream_reader.shutdown_requested = True
+
+    async def handle_event(self, event_type, event_data):
+        if event_type == "WORKER_UPDATE":
+            await self.handle_worker_update(event_data)
+        elif event_type == "SCHEDULER_SHARD_RELEASED":
+            self.shard_released_event.set()
+        elif event_type == "NAMESPACE_UPDATE":
+            #the models were marked dirty by whoever saved them
+            self.wake_up_shards(self.owned_shards)
+        elif event_type in ("MODEL_UPDATE", "MODEL_INSTANCE_UPDATE"):
+            self.wake_up_shards([models.get_model_shard(self.cluster,
+                models.get_model_key(event_data["namespace_id"], event_data["model_id"]))])
+        else:
+            logging.info("Unknown event type %s, skipping", event_type)
+
+    async def read_event_stream(self):
+        #stopped along with channel_reader
+        await self.event_stream_reader.read_forever()
+        await self.event_stream_reader.delete()
+
+    async def read_events(self):
+        await asyncio.gather(self.channel_reader(), self.read_event_stream())
+
     async def setup_pubsub(self):
+        """Model updates are wake up hints and come over pub/sub, scheduler events over a stream.
+
+        Every worker reads the scheduler stream with a consumer group of its own.
+        """
         self.pubsub = self.cluster.redis.pubsub()
         await self.pubsub.subscribe(
-            self.cluster.get_redis_channel_key(SCHEDULER_KEY)
+            self.cluster.get_redis_channel_key(models.MODELS_CHANNEL_KEY)
             )
-        return self.channel_reader()
+        self.event_stream_reader = events.EventStreamReader(cluster=self.cluster,
+            stream_name=SCHEDULER_KEY,
+            group=events.get_consumer_group_name("scheduler", self.worker.id),
+            consumer=self.worker.id,
+            handler=self.handle_event)
+        await self.event_stream_reader.setup()
+        return self.read_events()
 
     async def schedule_forever(self):
+        """Stands by for free shard leases, leading shards while under the fair share.
+
+        Standbys check all leases in one round trip every
+        SCHEDULER_STANDBY_CHECK_INTERVAL, or right away when a leader hands
+        a shard over, instead of contending for locks. Active workers are
+        read once for the fair share, from then on standbys follow them
+        through WORKER_UPDATE events and leaders re-read them while scheduling.
+        """
         while not self.shutdown_requested:
+            self.shard_released_event.clear()
+            if not self.active_workers_refreshed_at:
+                await self.refresh_active_workers_data()
+            await self.acquire_free_shards()
             try:
-                async with self.cluster.get_async_lock(SCHEDULER_KEY):
-                    start_time = time.time()
-                    await self.refresh_active_workers_data()
-                    await self.schedule_once()
-                    end_time = time.time()
-                    time_to_sleep = SCHEDULER_INTERVAL - (end_time - start_time)
-                    if time_to_sleep <= 0:
-                        raise Exception("scheduler taking unexpectedly longer")
-                    if time_to_sleep <= SCHEDULER_SLEEP_WARNNING_DURATION:
-                        logging.warning("scheduler taking longer, took %f, sleeping for %f",(end_time - start_time), time_to_sleep)
-                    logging.debug("sleeping for %f",time_to_sleep)
-                    await asyncio.sleep(time_to_sleep)
-            except aioredis.exceptions.LockError:
-                logging.debug("Unable to acquire lock for scheduler")
-                await asyncio.sleep(SCHEDULER_LOCK_ERROR_SLEEP_DURATION)
\ No newline at end of file
+                await asyncio.wait_for(self.shard_released_event.wait(),
+                    SCHEDULER_STANDBY_CHECK_INTERVAL * random.uniform(0.8, 1.2))
+            except asyncio.TimeoutError:
+                pass
+        await asyncio.gather(*self.shard_tasks.values())
+
+    async def acquire_free_shards(self):
+        shards_wanted = self.get_fair_share() - len(self.shard_tasks)
+        if shards_wanted <= 0:
+            return
+        shards = [x for x in self.leases if x not in self.shard_tasks]
+        async with self.cluster.redis.pipeline(transaction=False) as pipe:
+            for shard in shards:
+                pipe.exists(self.leases[shard].redis_key)
+            results = await pipe.execute()
+        free_shards = [x for x, exists in zip(shards, results) if not exists]
+        random.shuffle(free_shards)#standbys racing for the same shards mostly miss each other
+        for shard in free_shards:
+            if shards_wanted <= 0:
+                break
+            if await self.leases[shard].acquire():
+                self.shard_tasks[shard] = asyncio.create_task(self.lead_shard(shard))
+                shards_wanted -= 1
+
+    async def lead_shard(self, shard: int):
+        lease = self.leases[shard]
+        logging.info("Leading scheduler shard %d, fencing token %d", shard, lease.token)
+        self.owned_shards.add(shard)
+        keep_alive_task = asyncio.create_task(lease.keep_alive())
+        #wakes the shard up as soon as the lease is lost
+        keep_alive_task.add_done_callback(lambda _task: self.wake_up_shards([shard]))
+        try:
+            while not self.shutdown_requested and lease.is_held:
+                await self.schedule_shard_once(shard)
+                if len(self.owned_shards) > self.get_fair_share():
+                    logging.info("Handing over scheduler shard %d", shard)
+                    break
+        except exceptions.LeaseLostException:
+            logging.warning("Lost lease of scheduler shard %d while scheduling", shard)
+        finally:
+            self.release_shard(shard)
+            keep_alive_task.cancel()
+            if lease.is_held:
+                await lease.release()
+                await events.publish_event(self.cluster, SCHEDULER_KEY, "SCHEDULER_SHARD_RELEASED",
+                    {"shard": shard, "worker_id": self.worker.id})
+            self.shard_tasks.pop(shard, None)
+
+    def release_shard(self, shard: int):
+        self.owned_shards.discard(shard)
+        self.next_full_reconcile_at.pop(shard, None)
+
+    async def schedule_shard_once(self, shard: int):
+        dirty_models_event = self.dirty_models_events[shard]
+        start_time = time.time()
+        dirty_models_event.clear()
+        await self.refresh_active_workers_data()
+        if start_time >= self.next_full_reconcile_at.get(shard, 0):
+            await self.schedule_once(shard)
+            self.next_full_reconcile_at[shard] = start_time + SCHEDULER_FULL_RECONCILE_INTERVAL
+        else:
+            await self.schedule_dirty_models(shard)
+        end_time = time.time()
+        time_to_sleep = max(0, SCHEDULER_INTERVAL - (end_time - start_time))
+        if time_to_sleep <= SCHEDULER_SLEEP_WARNNING_DURATION:
+            #the lease is renewed meanwhile, so a long cycle no longer overlaps another leader
+            logging.warning("scheduler shard %d taking longer, took %f, sleeping for %f",shard,(end_time - start_time), time_to_sleep)
+        logging.debug("sleeping for up to %f",time_to_sleep)
+        try:
+            await asyncio.wait_for(dirty_models_event.wait(), time_to_sleep)
+        except asyncio.TimeoutError:
+            pass
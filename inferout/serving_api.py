@@ -1,8 +1,8 @@
+import asyncio
 import json
 import logging
 from aiohttp import web
 import contextvars
-import random
 
 import aiohttp
 
@@ -11,6 +11,22 @@ from . import exceptions
 
 context_worker = contextvars.ContextVar('worker')
 
+FORWARDED_HEADER = "X-Inferout-Forwarded-By"
+LOAD_HEADER = "X-Inferout-Load"
+REMOTE_RETRY_STATUSES = (429, 502, 503, 504) # the next replica is tried when one answers with these
+
+@web.middleware
+async def load_header_middleware(request, handler):
+    #lets routing workers track our load without reading it from redis
+    worker = context_worker.get()
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        e.headers[LOAD_HEADER] = str(worker.get_load())
+        raise
+    response.headers[LOAD_HEADER] = str(worker.get_load())
+    return response
+
 
 async def index(request):
     worker = context_worker.get()
@@ -37,79 +53,158 @@ async def handle_infer_post(request):
         
     input_data = request_data.get("input_data") or {}
 
-    ns = models.ModelNamespace(cluster=worker.cluster, id=namespace_id)
+    routing_table = worker.routing_table
     try:
-        await ns.read()
+        on_demand_settings = routing_table.get_namespace_settings(namespace_id).get("on_demand") or {}
     except exceptions.NotFoundException:
         raise web.HTTPNotFound
 
-    model = models.Model(namespace=ns, id=model_id)
-    try:
-        await model.read()
-    except exceptions.NotFoundException:#updating
-        pass
-    
-    version = None
     if version_id in ("_latest", "latest"):
-        version = models.ModelVersion(model=model, id=str(model.latest_version_id))
+        version_id = routing_table.get_latest_version_id(namespace_id, model_id)
+        #on demand models may have never been loaded, the latest version is resolved while loading
+        if version_id is None and not on_demand_settings.get("enabled"):
+            logging.error("No active Model Instances found")
+            raise web.HTTPServiceUnavailable
     elif version_id in (None, "", "any", "_latest_available"):
-        version = None
+        version_id = None
     else:
-        version = models.ModelVersion(model=model, id=version_id)
-    if version is not None:
         try:
-            await version.read()
-        except exceptions.NotFoundException:#updating
-            pass
+            version_id = int(version_id)
+        except ValueError:
+            raise web.HTTPNotFound
 
-    instances_data = await models.ModelInstance.get_all_as_list(
-        cluster=worker.cluster,
-        model=model,
-        version=version)
-    
-    instances_data = list(filter(lambda x: x["state"]=="serving", instances_data))
+    instances_data = routing_table.get_model_instances(
+        namespace_id=namespace_id,
+        model_id=model_id,
+        version_id=version_id)
 
     output_data = None
+    local_queue_full = False
 
     try:
         local_instance_data = list(filter(lambda x: x["worker_id"]==worker.id, instances_data))[0]
     except IndexError:
         local_instance_data = None
 
-    
+    if not instances_data and on_demand_settings.get("enabled") and not request.headers.get(FORWARDED_HEADER):
+        local_instance_data = await load_on_demand(worker, on_demand_settings, namespace_id, model_id, version_id)
+
+    if not local_instance_data and request.headers.get(FORWARDED_HEADER):
+        #routed by a worker that hasn't seen our instance draining yet, it still finishes what it gets
+        draining_instance = worker.find_local_model_instance(namespace_id, model_id, version_id, state="draining")
+        if draining_instance is not None:
+            local_instance_data = {
+                "id": draining_instance.id,
+                "model_version_id": draining_instance.model_version.id,
+                "worker_id": worker.id,
+                "state": draining_instance.state
+                }
+
     if local_instance_data:
-        logging.info("Serving from local worker")
-        if version is None:
-            version = models.ModelVersion(model=model, id=local_instance_data["model_version_id"])
-            try:
-                await version.read()
-            except exceptions.NotFoundException:#updating
-                pass
+        logging.debug("Serving from local worker")
+        ns = models.ModelNamespace(cluster=worker.cluster, id=namespace_id)
+        model = models.Model(namespace=ns, id=model_id)
+        version = models.ModelVersion(model=model, id=local_instance_data["model_version_id"])
         instance = models.ModelInstance(model_version=version,id=local_instance_data["id"])
-        output_data = await worker.do_infer(model_instance=instance, data=input_data)
-        return web.json_response({
-            "model_version": version.id,
-            "worker_id": local_instance_data["worker_id"],
-            "input_data": input_data,
-            "output_data": output_data
-            })
-    else:
-        random.shuffle(instances_data)
-        for each in instances_data:
-            remote_worker_data = await worker.get_remote_worker_data(worker_id=each["worker_id"])
-            logging.info("Routing to remote worker id=%s endpoint=%s",
-                remote_worker_data["id"], remote_worker_data["serving_endpoint"])
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    remote_worker_data["serving_endpoint"]+request.path_qs,
-                    json=request_data) as response:
-                    response_data = await response.json()
-                    return web.json_response(response_data)
-        
-        logging.error("No active Model Instances found")
+        try:
+            output_data = await worker.do_infer(model_instance=instance, data=input_data)
+        except exceptions.QueueFullException:
+            logging.debug("Request queue full for local model instance %s", instance.id)
+            local_queue_full = True
+        else:
+            return web.json_response({
+                "model_version": str(version.id),
+                "worker_id": local_instance_data["worker_id"],
+                "input_data": input_data,
+                "output_data": output_data
+                })
+    elif request.headers.get(FORWARDED_HEADER):
+        logging.error("No local Model Instance found for request forwarded by worker %s",
+            request.headers[FORWARDED_HEADER])
         raise web.HTTPServiceUnavailable
 
-app = web.Application()
+    remote_instances_data = list(filter(lambda x: x["worker_id"]!=worker.id, instances_data))
+    if not request.headers.get(FORWARDED_HEADER):
+        response = await route_to_remote_workers(request, worker, remote_instances_data)
+        if response is not None:
+            return response
+
+    if local_queue_full:
+        retry_after = routing_table.get_namespace_settings(namespace_id).get("request_queue", {}).get("retry_after", 1)
+        raise web.HTTPTooManyRequests(headers={"Retry-After": str(retry_after)})
+    logging.error("No active Model Instances found")
+    raise web.HTTPServiceUnavailable
+
+async def load_on_demand(worker, on_demand_settings, namespace_id, model_id, version_id):
+    """Loads the model on this worker, returns the data of the new instance."""
+    try:
+        model_instance = await asyncio.wait_for(
+            worker.load_on_demand(namespace_id, model_id, version_id),
+            on_demand_settings.get("load_timeout", 120))
+    except exceptions.NotFoundException:
+        raise web.HTTPNotFound
+    except asyncio.TimeoutError:
+        logging.error("Timed out loading on demand model namespace=%s model=%s", namespace_id, model_id)
+        raise web.HTTPServiceUnavailable(headers={"Retry-After": "1"})
+    except exceptions.ModelLoadError as e:
+        logging.error("Unable to load on demand model namespace=%s model=%s: %s", namespace_id, model_id, e)
+        raise web.HTTPServiceUnavailable
+    return {
+        "id": model_instance.id,
+        "model_version_id": model_instance.model_version.id,
+        "worker_id": worker.id,
+        "state": model_instance.state
+        }
+
+async def route_to_remote_workers(request, worker, instances_data):
+    """Forwards the request to the first remote replica that accepts it.
+
+    Replicas shedding load or failing with a 502, 503 or 504 are skipped.
+    Returns None when no replica is reachable, or the last of those
+    responses when every reachable replica answered with one.
+    """
+    request_body = await request.read()
+    failed_response = None
+    for each in worker.load_balancer.order(instances_data):
+        remote_worker_data = await worker.routing_table.fetch_worker_data(each["worker_id"])
+        if remote_worker_data is None:
+            continue
+        logging.debug("Routing to remote worker id=%s endpoint=%s",
+            remote_worker_data["id"], remote_worker_data["serving_endpoint"])
+        reported_load = None
+        worker.load_balancer.begin(remote_worker_data["id"])
+        try:
+            async with worker.http_session.post(
+                remote_worker_data["serving_endpoint"]+request.path_qs,
+                data=request_body,
+                headers={
+                    "Content-Type": "application/json",
+                    FORWARDED_HEADER: worker.id
+                    }) as response:
+                response_body = await response.read()
+                if response.headers.get(LOAD_HEADER, "").isdigit():
+                    reported_load = int(response.headers[LOAD_HEADER])
+                if response.status in REMOTE_RETRY_STATUSES:
+                    logging.debug("Remote worker id=%s answered %d, trying the next replica",
+                        remote_worker_data["id"], response.status)
+                    retry_after = response.headers.get("Retry-After",
+                        "1" if response.status == web.HTTPTooManyRequests.status_code else None)
+                    failed_response = web.Response(
+                        body=response_body,
+                        status=response.status,
+                        headers={"Retry-After": retry_after} if retry_after else None)
+                    continue
+                return web.Response(
+                    body=response_body,
+                    status=response.status,
+                    content_type="application/json")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning("Routing to remote worker id=%s failed: %s", remote_worker_data["id"], e)
+        finally:
+            worker.load_balancer.end(remote_worker_data["id"], reported_load=reported_load)
+    return failed_response
+
+app = web.Application(middlewares=[load_header_middleware])
 app.add_routes([
     web.get('/', index),
     web.post('/{namespace_id}/{model_id}', handle_infer_post),
@@ -21,4 +21,19 @@ class ServingEngine(object):
         raise NotImplementedError()
     
     def infer(self, model_parameters:dict, storage_context:dict, serving_context: dict, worker_serving_context:dict, data: dict) -> dict:
-        raise NotImplementedError()
\ No newline at end of file
+        raise NotImplementedError()
+
+    def infer_batch(self, model_parameters:dict, storage_context:dict, serving_context: dict, worker_serving_context:dict, data_list: list) -> list:
+        #optional, must return one output per item of data_list, in the same order
+        raise NotImplementedError()
+
+    def warmup(self, model_parameters:dict, storage_context:dict, serving_context: dict, worker_serving_context:dict, data: dict):
+        #optional, one warm-up pass with an item of the model's warmup_inputs, an inference unless overridden
+        self.infer(model_parameters=model_parameters,
+            storage_context=storage_context,
+            serving_context=serving_context,
+            worker_serving_context=worker_serving_context,
+            data=data)
+
+    def supports_infer_batch(self) -> bool:
+        return type(self).infer_batch is not ServingEngine.infer_batch
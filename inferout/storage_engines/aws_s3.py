@@ -7,6 +7,14 @@ import random
 import string
 import boto3
 import urllib.parse
+import io
+import hashlib
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+TAR_ARCHIVE_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+READ_BUFFER_SIZE = 1024*1024
 
 def dir_path(string):
     if os.path.isdir(string):
@@ -17,6 +25,69 @@ def dir_path(string):
 def get_temp_dir_name():
     return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
 
+
+class ChecksumMismatchError(ValueError):
+    pass
+
+
+class RangedReader(io.RawIOBase):
+    """Reads an s3 object in order, fetching up to max_concurrency parts ahead with ranged GETs.
+
+    Every part is requested with the ETag seen up front, so an object
+    replaced mid download fails instead of mixing versions.
+    """
+    def __init__(self, s3_client, bucket: str, key: str, size: int, etag: str, part_size: int, max_concurrency: int) -> None:
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.part_size = part_size
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="inferout-s3")
+        self.offsets = iter(range(0, size, part_size))
+        self.pending = deque()
+        self.part = memoryview(b"")
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        for _ in range(max_concurrency):
+            self.submit_next_part()
+
+    def submit_next_part(self):
+        offset = next(self.offsets, None)
+        if offset is not None:
+            self.pending.append(self.executor.submit(self.get_part, offset, min(offset+self.part_size, self.size)-1))
+
+    def get_part(self, start: int, end: int) -> bytes:
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key,
+            Range="bytes={}-{}".format(start, end), IfMatch=self.etag)
+        return response["Body"].read()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.part:
+            if not self.pending:
+                return 0
+            data = self.pending.popleft().result()
+            self.md5.update(data)
+            self.sha256.update(data)
+            self.part = memoryview(data)
+            self.submit_next_part()
+        n = min(len(b), len(self.part))
+        b[:n] = self.part[:n]
+        self.part = self.part[n:]
+        return n
+
+    def close(self):
+        #parts not started yet are dropped, shutdown's cancel_futures needs python 3.9
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
+        super().close()
+
+
 class StorageEngine(base.StorageEngine):
     def __init__(self) -> None:
         self.s3_client = boto3.client('s3')
@@ -25,32 +96,94 @@ class StorageEngine(base.StorageEngine):
         p = configargparse.ArgParser()
 
         p.add('--storage-aws-s3-local-temp-dir', default='/tmp', type=dir_path, help='Directory location for keeping models in local')
+        p.add('--storage-aws-s3-endpoint-url', default=None, help='S3 endpoint url, for S3 compatible stores')
+        p.add('--storage-aws-s3-part-size', default=16*1024*1024, type=int, help='size in bytes of the ranges models are downloaded in')
+        p.add('--storage-aws-s3-max-concurrency', default=8, type=int, help='max ranges of a model downloaded at the same time')
         options, _unknown = p.parse_known_args()
         self.temp_dir = options.storage_aws_s3_local_temp_dir
-    
+        self.part_size = options.storage_aws_s3_part_size
+        self.max_concurrency = options.storage_aws_s3_max_concurrency
+        if options.storage_aws_s3_endpoint_url:
+            self.s3_client = boto3.client('s3', endpoint_url=options.storage_aws_s3_endpoint_url)
+
     def prepare(self):
         pass
-    
+
     def validate_model_parameters(self, model_parameters):
         if not model_parameters.get("storage_aws_s3_url"):
             raise ValueError("storage_aws_s3_url is required")
         url = urllib.parse.urlparse(model_parameters.get("storage_aws_s3_url"))
         if url.scheme.lower()!="s3" or not url.hostname or not url.path:
             raise ValueError("invalid s3 url "+model_parameters.get("storage_aws_s3_url"))
-    
-    def fetch_model(self, model_parameters) -> dict:
+
+    def get_artifact_key(self, model_parameters) -> str:
         s3_url_parts = urllib.parse.urlparse(model_parameters.get("storage_aws_s3_url"))
-        temp_dir = os.path.join(self.temp_dir, get_temp_dir_name())
-        os.mkdir(temp_dir)
+        head = self.s3_client.head_object(Bucket=s3_url_parts.hostname, Key=s3_url_parts.path[1:])
+        return "s3://{}{}::{}::{}".format(s3_url_parts.hostname, s3_url_parts.path, head["ETag"].strip('"'),
+            "unpacked" if model_parameters.get("storage_aws_s3_unpack_archive") else "packed")
+
+    def fetch_artifact(self, model_parameters, target_dir: str) -> dict:
+        s3_url_parts = urllib.parse.urlparse(model_parameters.get("storage_aws_s3_url"))
+        bucket, key = s3_url_parts.hostname, s3_url_parts.path[1:]
         file_name = os.path.split(s3_url_parts.path)[-1]
-        final_path = os.path.join(temp_dir,file_name)
-        self.s3_client.download_file(s3_url_parts.hostname,s3_url_parts.path[1:],final_path)
-        if model_parameters.get("storage_aws_s3_unpack_archive"):
-            temp_dir = os.path.join(self.temp_dir, get_temp_dir_name())
-            os.mkdir(temp_dir)
-            shutil.unpack_archive(final_path, temp_dir)
-            final_path = temp_dir
+        head = self.s3_client.head_object(Bucket=bucket, Key=key)
+        reader = RangedReader(self.s3_client, bucket=bucket, key=key,
+            size=head["ContentLength"], etag=head["ETag"],
+            part_size=self.part_size, max_concurrency=self.max_concurrency)
+        try:
+            unpack = model_parameters.get("storage_aws_s3_unpack_archive")
+            if unpack and file_name.lower().endswith(TAR_ARCHIVE_EXTENSIONS):
+                #extracted while the rest is still downloading, never written to disk as an archive
+                final_path = os.path.join(target_dir, "unpacked")
+                os.mkdir(final_path)
+                stream = io.BufferedReader(reader, buffer_size=READ_BUFFER_SIZE)
+                with tarfile.open(fileobj=stream, mode="r|*") as tar:
+                    if hasattr(tarfile, "data_filter"):
+                        tar.extractall(final_path, filter="data")
+                    else:
+                        tar.extractall(final_path)
+                while stream.read(READ_BUFFER_SIZE):#trailing padding, needed for the checksum
+                    pass
+            else:
+                final_path = os.path.join(target_dir, file_name)
+                with open(final_path, "wb") as f:
+                    shutil.copyfileobj(reader, f, READ_BUFFER_SIZE)
+            self.verify_checksum(model_parameters, head, reader)
+            if unpack and not file_name.lower().endswith(TAR_ARCHIVE_EXTENSIONS):
+                #zip and friends need random access
+                archive_path = final_path
+                final_path = os.path.join(target_dir, "unpacked")
+                os.mkdir(final_path)
+                shutil.unpack_archive(archive_path, final_path)
+                os.remove(archive_path)
+        finally:
+            reader.close()
         return {"local_path": final_path}
-        
+
+    def verify_checksum(self, model_parameters, head, reader: RangedReader):
+        """Checks the sha256 given in model parameters, else the ETag when it is a plain MD5."""
+        expected_sha256 = model_parameters.get("storage_aws_s3_sha256")
+        if expected_sha256:
+            if reader.sha256.hexdigest() != expected_sha256.lower():
+                raise ChecksumMismatchError("sha256 mismatch for "+model_parameters["storage_aws_s3_url"])
+            return
+        etag = head["ETag"].strip('"')
+        #multipart uploads and SSE-KMS objects don't have the MD5 as ETag
+        if "-" in etag or head.get("ServerSideEncryption") == "aws:kms":
+            return
+        if reader.md5.hexdigest() != etag:
+            raise ChecksumMismatchError("md5 mismatch for "+model_parameters["storage_aws_s3_url"])
+
+    def fetch_model(self, model_parameters) -> dict:
+        temp_dir = os.path.join(self.temp_dir, get_temp_dir_name())
+        os.mkdir(temp_dir)
+        try:
+            storage_context = self.fetch_artifact(model_parameters, temp_dir)
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        storage_context["temp_dir"] = temp_dir
+        return storage_context
+
     def clean_model(self, model_parameters:dict, storage_context:dict):
-        shutil.rmtree(storage_context["local_path"])
\ No newline at end of file
+        shutil.rmtree(storage_context.get("temp_dir") or storage_context["local_path"])
@@ -15,4 +15,11 @@ class StorageEngine(object):
         raise NotImplementedError()
     
     def clean_model(self, model_parameters:dict, storage_context:dict):
+        raise NotImplementedError()
+
+    #optional, for engines whose artifacts can be shared through the worker's artifact cache
+    def get_artifact_key(self, model_parameters) -> str:#content hash, ETag..., None to not cache
+        raise NotImplementedError()
+
+    def fetch_artifact(self, model_parameters, target_dir: str) -> dict:#fetches into target_dir, returns model fetch_context
         raise NotImplementedError()
\ No newline at end of file
@@ -7,35 +7,68 @@ from inferout.models import (
     Model,
     ModelInstance,
     ModelNamespace,
-    ModelVersion)
-import async_timeout
+    ModelVersion,
+    NAMESPACE_DEFAULT_SETTINGS,
+    get_model_key,
+    hgetall_many,
+    mark_models_dirty)
 import logging
+from collections import Counter
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 from .cluster import Cluster
 from . import utils
 import signal
 from . import management_api
 from . import serving_api
+from . import artifact_api
 from aiohttp import web
+import aiohttp
 import re
 from .plugins.base import Plugin
 from .storage_engines.base import StorageEngine
 from .serving_engines.base import ServingEngine
 from . import exceptions
 from . import worker_annotators
+from .batching import Batcher
+from .process_pool import ServingProcessPool
+from .backpressure import RequestLimiter
+from .load_balancer import LoadBalancer
+from . import resources
+from . import events
+from . import autoscaling
+from .artifact_cache import ArtifactCache
+from .artifact_peers import ArtifactPeers
 
 import os
 import sys
+import time
 sys.path.append(os.getcwd())
 
-WORKER_ANNOTATORS = [worker_annotators.serving_endpoint_from_options]
+WORKER_ANNOTATORS = [worker_annotators.serving_endpoint_from_options,
+    worker_annotators.artifact_endpoint_from_options]
 
 WORKER_KEY = '{{@worker-{}}}'
 WORKER_KEY_REGEX = re.compile('{@worker-(.*)}$')
 WORKER_REPORT_SLEEP_DURATION = 5
 WORKER_REPORT_EXPIRE_MULTIPLIER = 2
 WORKER_REPORT_EXPIRE_ADDITION = 10
+WORKERS_INDEX_KEY = '@workers_index' # sorted set of worker ids, scored by expiry of their report, in redis server time
+WORKER_REPORT_DEBOUNCE_DURATION = 0.2 # state changes within this are reported together
+WORKER_ACTIVE_STATES = ("serving", "draining") # a draining worker serves until its instances are replaced
+WORKER_DRAIN_CHECK_INTERVAL = 0.5
+ON_DEMAND_IDLE_CHECK_INTERVAL = 30
+DRAIN_ROUTING_GRACE_DURATION = 1 # routing tables elsewhere see a draining instance within this
+DRAIN_CHECK_INTERVAL = 0.1
+WARMUP_SETTLE_WINDOW = 3 # warm-up latencies compared to tell whether latency has settled
+
+def is_latency_settled(latencies: list, tolerance: float) -> bool:
+    """Whether the last warm-up latencies are within tolerance of each other."""
+    window = latencies[-WARMUP_SETTLE_WINDOW:]
+    if min(window) <= 0:
+        return True
+    return max(window) / min(window) - 1 <= tolerance
 
 class Worker(object):
     def __init__(self, cluster: Cluster, options) -> None:
@@ -52,12 +85,39 @@ class Worker(object):
         self.plugins_context = {}
 
         self.serving_endpoint = None
+        self.artifact_endpoint = None
 
         self.attributes = {}
 
         self.rack = ""
 
         self.local_model_instances = {}
+        self.batchers = {}
+        self.request_limiters = {}
+        self.process_pool = None
+        self.local_model_footprints = {}
+
+        self.routing_table = None
+        self.http_session = None
+        self.load_balancer = None
+        self.event_stream_reader = None
+
+        self.event_tasks = set()
+        self.model_instance_event_tasks = {}
+        self.model_loads_semaphore = None
+        self.load_executor = None
+        self.infer_executor = None
+
+        self.debounced_report_task = None
+
+        self.artifact_cache = None
+        self.artifact_peers = None
+
+        self.on_demand_loads = {}
+        self.model_instances_last_used = {}
+
+        self.load_tracker = autoscaling.ModelLoadTracker()
+        self.load_reported_models = set()
         
     
     async def report_forever(self):
@@ -67,21 +127,51 @@ class Worker(object):
                 break
             await asyncio.sleep(WORKER_REPORT_SLEEP_DURATION)
 
+    def request_report(self):
+        """Reports state changes, a burst of them makes one write and one WORKER_UPDATE."""
+        if self.debounced_report_task is None:
+            self.debounced_report_task = asyncio.create_task(self.report_debounced())
+
+    async def report_debounced(self):
+        await asyncio.sleep(WORKER_REPORT_DEBOUNCE_DURATION)
+        #changes from here on need a report of their own
+        self.debounced_report_task = None
+        try:
+            await self.report_once(send_events=True)
+        except Exception as e:
+            logging.exception(e)
+            logging.error("error reporting worker state")
+
+    def get_worker_data(self) -> dict:
+        return {
+            "id": self.id,
+            "state": self.state,
+            "serving_endpoint": self.serving_endpoint,
+            "artifact_endpoint": self.artifact_endpoint or "",
+            "rack": self.rack,
+            "available_storage_engines": list(self.storage_engines.keys()),
+            "available_serving_engines": list(self.serving_engines.keys()),
+            "model_instances_count": len(self.local_model_instances),
+            "in_flight": sum(x.in_flight for x in self.request_limiters.values()),
+            "queue_depth": sum(x.queued for x in self.request_limiters.values()),
+            "model_instances_load": self.get_model_instances_load(),
+            "capacity": resources.get_capacity(self.options.resources_disk_path),
+            "memory_reserved": sum(x.get("memory_bytes", 0) for x in self.local_model_footprints.values()),
+            "memory_reserved_on_demand": self.get_on_demand_memory_reserved(),
+            "attributes": self.attributes
+            }
+
     async def report_once(self, send_events=False):
             from .scheduler import SCHEDULER_KEY
             logging.debug("Reporting %s", self.worker_key)
-            data = {
-                "state": self.state,
-                "serving_endpoint": self.serving_endpoint,
-                "rack": self.rack,
-                "available_storage_engines": json.dumps(list(self.storage_engines.keys())),
-                "available_serving_engines": json.dumps(list(self.serving_engines.keys())),
-                "model_instances_count": len(self.local_model_instances),
-                "attributes": json.dumps(self.attributes)
-                }
+            worker_data = self.get_worker_data()
+            data = {k: json.dumps(v) if isinstance(v, (list, dict)) else v
+                for k, v in worker_data.items() if k != "id"}
             logging.debug("Reporting %s %s", self.worker_key, data)
             
             redis_key = self.cluster.get_redis_key(self.worker_key)
+            index_key = self.cluster.get_redis_key(WORKERS_INDEX_KEY)
+            now = await self.cluster.get_time()
             async with self.cluster.redis.pipeline(transaction=True) as pipe:
                 pipe.hset(
                     redis_key,
@@ -90,29 +180,37 @@ class Worker(object):
                 pipe.expire(redis_key,
                 WORKER_REPORT_SLEEP_DURATION*WORKER_REPORT_EXPIRE_MULTIPLIER
                 )
+                pipe.zadd(index_key,
+                    {self.id: now + WORKER_REPORT_SLEEP_DURATION*WORKER_REPORT_EXPIRE_MULTIPLIER})
+                pipe.zremrangebyscore(index_key, "-inf", now)
+                #our event stream goes away along with the report
+                pipe.expire(events.get_stream_key(self.cluster, self.worker_key),
+                WORKER_REPORT_SLEEP_DURATION*WORKER_REPORT_EXPIRE_MULTIPLIER
+                )
                 await pipe.execute()
             if send_events:
                 event_data = {
                     "worker_id": self.id,
                     "state": self.state,
-                    "model_instances_count": len(self.local_model_instances)
+                    "model_instances_count": len(self.local_model_instances),
+                    "worker_data": worker_data #saves receivers reading it back
                     }
-                await self.cluster.redis.publish(
-                    self.cluster.get_redis_channel_key(
-                        SCHEDULER_KEY
-                    ),
-                    message=json.dumps({
-                            "event_type": "WORKER_UPDATE",
-                            "event_data": event_data
-                        })
-                )
+                await events.publish_event(self.cluster, SCHEDULER_KEY, "WORKER_UPDATE", event_data)
     
     async def get_worker_data_from_redis(self, redis_key):
-        worker_data = await self.cluster.redis.hgetall(redis_key)
+        return self.parse_worker_data(redis_key, await self.cluster.redis.hgetall(redis_key))
+
+    def parse_worker_data(self, redis_key, worker_data):
         worker_data["id"] = WORKER_KEY_REGEX.search(redis_key).group(1)
         worker_data["available_storage_engines"] = json.loads(worker_data["available_storage_engines"])
         worker_data["available_serving_engines"] = json.loads(worker_data["available_serving_engines"])
         worker_data["model_instances_count"] = int(worker_data["model_instances_count"])
+        worker_data["in_flight"] = int(worker_data.get("in_flight") or 0)
+        worker_data["queue_depth"] = int(worker_data.get("queue_depth") or 0)
+        worker_data["model_instances_load"] = json.loads(worker_data.get("model_instances_load") or "{}")
+        worker_data["capacity"] = json.loads(worker_data.get("capacity") or "{}")
+        worker_data["memory_reserved"] = int(worker_data.get("memory_reserved") or 0)
+        worker_data["memory_reserved_on_demand"] = int(worker_data.get("memory_reserved_on_demand") or 0)
         if worker_data.get("attributes"):
             worker_data["attributes"] = json.loads(worker_data["attributes"])
         else:
@@ -121,11 +219,14 @@ class Worker(object):
         return worker_data
 
     async def get_all_workers_data(self):
+        redis_keys = [self.cluster.get_redis_key(WORKER_KEY.format(x))
+            for x in await self.cluster.redis.zrangebyscore(
+                self.cluster.get_redis_key(WORKERS_INDEX_KEY), await self.cluster.get_time(), "+inf")]
         data = []
-        async for each in self.cluster.redis.scan_iter(
-            self.cluster.get_redis_key(WORKER_KEY.format('*'))
-            ):
-            data.append(await self.get_worker_data_from_redis(each))
+        for redis_key, worker_data in zip(redis_keys, await hgetall_many(self.cluster, redis_keys)):
+            if not worker_data:#expired since
+                continue
+            data.append(self.parse_worker_data(redis_key, worker_data))
         return data
     
     async def get_remote_worker_data(self, worker_id):
@@ -161,6 +262,10 @@ class Worker(object):
                 serving_port = plugin.get_serving_port()
             except NotImplementedError:
                 serving_port = None
+            try:
+                artifact_peer_host = plugin.get_artifact_peer_host()
+            except NotImplementedError:
+                artifact_peer_host = None
             try:
                 rack_format = plugin.get_rack_format()
             except NotImplementedError:
@@ -174,6 +279,7 @@ class Worker(object):
             self.plugins_context["management_port"] = management_port or self.plugins_context.get("management_port")
             self.plugins_context["serving_host"] = serving_host or self.plugins_context.get("serving_host")
             self.plugins_context["serving_port"] = serving_port or self.plugins_context.get("serving_port")
+            self.plugins_context["artifact_peer_host"] = artifact_peer_host or self.plugins_context.get("artifact_peer_host")
             self.plugins_context["rack_format"] = rack_format or self.plugins_context.get("rack_format")
 
             self.plugins_context["worker_attributes"].update(worker_attributes)
@@ -190,6 +296,9 @@ class Worker(object):
         if self.plugins_context.get("serving_port"):
             if self.options.default_options_map["serving-port"] is self.options.serving_port:
                 self.options.serving_port = self.plugins_context["serving_port"]
+        if self.plugins_context.get("artifact_peer_host"):
+            if self.options.default_options_map["host"] is self.options.artifact_peer_host:
+                self.options.artifact_peer_host = self.plugins_context["artifact_peer_host"]
         
         if self.plugins_context.get("rack_format"):
             if self.options.rack_format is None:
@@ -232,24 +341,70 @@ class Worker(object):
         logging.info("available storages engines: %s",",".join(self.storage_engines))
     
     async def shutdown(self, sig, loop):
+        if self.state in ("draining", "shutting_down"):
+            return
         logging.info("Shutting down gracefully, reson=%s",sig)
+        await self.hand_off_model_instances()
         self.state = "shutting_down"
         await self.report_once(send_events=True)
 
         self.shutdown_requested = True
+        self.event_stream_reader.shutdown_requested = True
         self.scheduler.shutdown_requested = True
+        self.routing_table.shutdown_requested = True
 
-        logging.info("watting for worker_pubsub_task")
-        await self.worker_pubsub_task
+        logging.info("watting for worker_events_task")
+        await self.worker_events_task
+        logging.info("waitting for %d model instance events", len(self.event_tasks))
+        await asyncio.gather(*self.event_tasks, return_exceptions=True)
+        logging.info("waitting for evict_idle_task")
+        await self.evict_idle_task
+        logging.info("waitting for report_load_task")
+        await self.report_load_task
         logging.info("watting for report_forever")
         await self.report_forever_task
         logging.info("waitting for scheduler")
         await self.scheduler_task
         logging.info("waitting for scheduler_pubsub_task")
         await self.scheduler_pubsub_task
+        logging.info("waitting for routing_table_sync_task")
+        await self.routing_table_sync_task
+        logging.info("waitting for routing_table_pubsub_task")
+        await self.routing_table_pubsub_task
+        await self.http_session.close()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+        self.load_executor.shutdown(wait=False)
+        self.infer_executor.shutdown(wait=False)
         logging.info("Shutting down gracefully Completed")
     
 
+    async def hand_off_model_instances(self):
+        """Keeps serving until replacements of our model instances are live elsewhere.
+
+        Once told we are draining, schedulers place replacements on other
+        workers and drain our instances as the replacements start serving.
+        Instances still here after --shutdown-drain-timeout are drained
+        on the spot, in flight requests finish either way.
+        """
+        self.state = "draining"
+        await self.report_once(send_events=True)
+        if self.options.shutdown_drain_timeout <= 0:
+            return
+        #on demand instances aren't replaced, they load again wherever they are next needed
+        await asyncio.gather(*[self.deactivate_model_instance(x) for x in list(self.local_model_instances.values())
+            if self.is_on_demand(x)], return_exceptions=True)
+        deadline = time.monotonic() + self.options.shutdown_drain_timeout
+        while self.local_model_instances:
+            if time.monotonic() > deadline:
+                logging.warning("%d model instances not handed off in time, draining them",
+                    len(self.local_model_instances))
+                break
+            await asyncio.sleep(WORKER_DRAIN_CHECK_INTERVAL)
+        await asyncio.gather(*[self.drain_model_instance(x) for x in list(self.local_model_instances.values())],
+            return_exceptions=True)
+        logging.info("model instances handed off")
+
     async def _get_model_instance_from_event_data(self, event_data):
         if(event_data["worker_id"]!=self.id):
             logging.error("worker_id missmatch, expected %s found %s", self.id, event_data["worker_id"])
@@ -277,34 +432,62 @@ class Worker(object):
         return model_instance
 
     async def handle_model_instance_scheduled(self, event_data):
-        model_instance = await self._get_model_instance_from_event_data(event_data)
-        await self.activate_model_instance(model_instance)
+        async with self.model_loads_semaphore:
+            model_instance = await self._get_model_instance_from_event_data(event_data)
+            if model_instance is None or model_instance.state == "terminating":
+                return
+            if model_instance.state == "draining":#scaled down before we got to it
+                model_instance.state = "terminating"
+                await model_instance.save()
+                return
+            await self.evict_on_demand_instances(self.get_required_memory(model_instance.model_version), for_on_demand=False)
+            await self.activate_model_instance(model_instance)
     
     async def handle_terminate_model_instance(self, event_data):
         model_instance = await self._get_model_instance_from_event_data(event_data)
-        local_model_instance = self.local_model_instances[model_instance.redis_key]
+        if model_instance is None:
+            return
+        local_model_instance = self.local_model_instances.get(model_instance.redis_key)
+        if local_model_instance is None:#terminated before it was loaded
+            if model_instance.state != "terminating":
+                model_instance.state = "terminating"
+                await model_instance.save()
+            return
         await self.deactivate_model_instance(local_model_instance)
     
 
 
-    async def channel_reader(self):
-        while not self.shutdown_requested:
-            message = None
-            try:
-                async with async_timeout.timeout(1):
-                    message = await self.worker_pubsub.get_message(ignore_subscribe_messages=True)
-                    await asyncio.sleep(0.01)
-            except asyncio.TimeoutError:
-                pass
-            if message is not None:
-                logging.debug(f"(Worker Reader) Message Received: {message}")
-                data = json.loads(message["data"])
-                if data["event_type"] == "MODEL_INSTANCE_SCHEDULED":
-                    await self.handle_model_instance_scheduled(data["event_data"])
-                elif data["event_type"] == "TERMINATE_MODEL_INSTANCE":
-                    await self.handle_terminate_model_instance(data["event_data"])
-                else:
-                    logging.info("Unknown event type %s, skipping", data["event_type"])
+    async def handle_event(self, event_type, event_data):
+        if event_type == "MODEL_INSTANCE_SCHEDULED":
+            self.dispatch_model_instance_event(self.handle_model_instance_scheduled, event_data)
+        elif event_type == "TERMINATE_MODEL_INSTANCE":
+            self.dispatch_model_instance_event(self.handle_terminate_model_instance, event_data)
+        else:
+            logging.info("Unknown event type %s, skipping", event_type)
+
+    def dispatch_model_instance_event(self, handler, event_data):
+        """Runs handler(event_data) as a task, after earlier events of the same model instance.
+
+        A slow model load doesn't hold up events of other model instances.
+        """
+        key = event_data["model_instance_id"]
+        task = asyncio.create_task(self.run_model_instance_event(
+            self.model_instance_event_tasks.get(key), handler, event_data))
+        self.model_instance_event_tasks[key] = task
+        self.event_tasks.add(task)
+        task.add_done_callback(partial(self.on_model_instance_event_done, key))
+
+    async def run_model_instance_event(self, previous_task, handler, event_data):
+        if previous_task is not None:
+            await asyncio.wait([previous_task])
+        await handler(event_data)
+
+    def on_model_instance_event_done(self, key, task):
+        self.event_tasks.discard(task)
+        if self.model_instance_event_tasks.get(key) is task:
+            del self.model_instance_event_tasks[key]
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Error handling event of model instance %s", key, exc_info=task.exception())
     
     async def activate_model_instance(self, model_instance: ModelInstance):
         ns = model_instance.model.namespace
@@ -319,7 +502,7 @@ class Worker(object):
         await self.register_local_model_instance(model_instance)
 
         try:
-            await loop.run_in_executor(None, partial(storage_engine.validate_model_parameters,
+            await loop.run_in_executor(self.load_executor, partial(storage_engine.validate_model_parameters,
                 model_parameters=model_parameters))
         except Exception as e:
             model_instance.state = "fetch_validation_error"
@@ -329,8 +512,9 @@ class Worker(object):
             return
         storage_context = None
         try:
-            storage_context = await loop.run_in_executor(None, partial(storage_engine.fetch_model,
-            model_parameters=model_parameters))
+            storage_context = await self.fetch_model(
+            storage_engine_name=ns.settings["storage_engine"],
+            model_parameters=model_parameters)
         except Exception as e:
             model_instance.state = "fetch_error"
             model_instance.error_messages = [str(e)]
@@ -343,7 +527,7 @@ class Worker(object):
         await self.register_local_model_instance(model_instance)
 
         try:
-            await loop.run_in_executor(None, partial(serving_engine.validate_model_parameters,
+            await loop.run_in_executor(self.load_executor, partial(serving_engine.validate_model_parameters,
                 model_parameters=model_parameters))
         except Exception as e:
             model_instance.state = "load_model_validation_error"
@@ -354,49 +538,151 @@ class Worker(object):
         serving_context = None
         worker_serving_context = None
         try:
-            serving_context, worker_serving_context  = await loop.run_in_executor(None, partial(serving_engine.load_model,
-            model_parameters=model_parameters,
-            storage_context=storage_context)
-            )
+            if self.process_pool is not None:
+                serving_context, footprint = await self.process_pool.load_model(
+                    key=model_instance.redis_key,
+                    serving_engine=ns.settings["serving_engine"],
+                    model_parameters=model_parameters,
+                    storage_context=storage_context)
+            else:
+                #approximate, other models loading concurrently are counted too
+                rss_before = resources.get_process_rss()
+                load_started_at = time.monotonic()
+                serving_context, worker_serving_context  = await loop.run_in_executor(self.load_executor, partial(serving_engine.load_model,
+                model_parameters=model_parameters,
+                storage_context=storage_context)
+                )
+                footprint = {
+                    "memory_bytes": max(0, resources.get_process_rss() - rss_before),
+                    "load_time": time.monotonic() - load_started_at
+                    }
         except Exception as e:
             model_instance.state = "load_model_error"
             model_instance.error_messages = [str(e)]
             await model_instance.save()
             await self.register_local_model_instance(model_instance)
             return
-        model_instance.state = "serving"
         model_instance.storage_context = storage_context
         model_instance.serving_context = serving_context
         model_instance.worker_serving_context = worker_serving_context
+        self.local_model_footprints[model_instance.redis_key] = footprint
+        await model_instance.model_version.save_footprint(footprint)
+
+        #not routed to until warmed up
+        model_instance.state = "warming_up"
+        await model_instance.save()
+        await self.register_local_model_instance(model_instance)
+        try:
+            await self.warmup_model_instance(model_instance)
+        except Exception as e:
+            model_instance.state = "warmup_error"
+            model_instance.error_messages = [str(e)]
+            await model_instance.save()
+            await self.register_local_model_instance(model_instance)
+            return
+
+        model_instance.state = "serving"
+        self.start_request_limiter(model_instance)
+        self.start_batcher(model_instance)
         await model_instance.save()
         await self.register_local_model_instance(model_instance)
     
+    async def warmup_model_instance(self, model_instance: ModelInstance):
+        """Runs the warmup_inputs of the model version until latency settles.
+
+        Lazy initialisation (JIT, allocator growth, caches) is then paid
+        for before the instance is routed to, rather than by the first
+        requests.
+        """
+        warmup_inputs = (model_instance.model_version.parameters or {}).get("warmup_inputs") or []
+        if not warmup_inputs:
+            return
+        warmup_settings = model_instance.model.namespace.settings.get("warmup") or {}
+        min_iterations = max(1, int(warmup_settings.get("min_iterations", 3)))
+        max_iterations = max(min_iterations, int(warmup_settings.get("max_iterations", 50)))
+        settle_tolerance = float(warmup_settings.get("settle_tolerance", 0.1))
+        deadline = time.monotonic() + float(warmup_settings.get("timeout", 60))
+
+        latencies = []
+        while len(latencies) < max_iterations:
+            started_at = time.monotonic()
+            await self._warmup(model_instance, warmup_inputs[len(latencies) % len(warmup_inputs)])
+            latencies.append(time.monotonic() - started_at)
+            if len(latencies) >= min_iterations and is_latency_settled(latencies, settle_tolerance):
+                break
+            if time.monotonic() > deadline:
+                logging.warning("warm-up of model instance %s timed out, latency not settled", model_instance.id)
+                break
+        logging.info("warmed up model instance %s in %d inferences, latency %fs, first one %fs",
+            model_instance.id, len(latencies), latencies[-1], latencies[0])
+
+    async def _warmup(self, local_instance: ModelInstance, data: dict):
+        if self.process_pool is not None:
+            return await self.process_pool.warmup(key=local_instance.redis_key, data=data)
+        ns = local_instance.model.namespace
+        serving_engine = self.serving_engines[ns.settings["serving_engine"]]
+        loop = asyncio.get_event_loop()
+        #on the threads real requests run on
+        return await loop.run_in_executor(self.infer_executor, partial(serving_engine.warmup,
+            model_parameters=local_instance.model_version.parameters,
+            storage_context=local_instance.storage_context,
+            serving_context=local_instance.serving_context,
+            worker_serving_context=local_instance.worker_serving_context,
+            data=deepcopy(data))
+            )
+
+    async def drain_model_instance(self, model_instance: ModelInstance):
+        """Takes a serving instance out of routing and waits for the requests it has taken to finish."""
+        if model_instance.state != "serving":
+            return
+        drain_timeout = float((model_instance.model.namespace.settings.get("rollout") or {}).get("drain_timeout", 30))
+        started_at = time.monotonic()
+        model_instance.state = "draining"
+        await model_instance.save()
+        self.request_report()
+        #requests from workers that haven't seen the state change yet are still served
+        await asyncio.sleep(DRAIN_ROUTING_GRACE_DURATION)
+        limiter = self.request_limiters.get(model_instance.redis_key)
+        while limiter is not None and (limiter.in_flight or limiter.queued):
+            if time.monotonic() - started_at > drain_timeout:
+                logging.warning("model instance %s still has %d requests after draining for %fs, terminating anyway",
+                    model_instance.id, limiter.in_flight + limiter.queued, drain_timeout)
+                break
+            await asyncio.sleep(DRAIN_CHECK_INTERVAL)
+        logging.info("drained model instance %s in %fs", model_instance.id, time.monotonic() - started_at)
+
     async def deactivate_model_instance(self, model_instance: ModelInstance):
         ns = model_instance.model.namespace
         model_parameters = model_instance.model_version.parameters
 
-        storage_engine = self.storage_engines[ns.settings["storage_engine"]]
         serving_engine = self.serving_engines[ns.settings["serving_engine"]]
 
         loop = asyncio.get_event_loop()
 
+        await self.drain_model_instance(model_instance)
         logging.debug("terminating model instance id=%s model_id=%s version=%s namespace=%s",
             model_instance.id, model_instance.model.id, model_instance.model_version_id, model_instance.model.namespace.id)
         model_instance.state = "terminating"
         await model_instance.save()
-        await self.report_once(send_events=True)
+        self.request_report()
+        await self.stop_batcher(model_instance)
+        self.request_limiters.pop(model_instance.redis_key, None)
         try:
-            await loop.run_in_executor(None, partial(serving_engine.unload_model,
-            model_parameters=model_parameters,
-            storage_context=model_instance.storage_context,
-            serving_context=model_instance.serving_context,
-            worker_serving_context=model_instance.worker_serving_context
-            ))
+            if self.process_pool is not None:
+                await self.process_pool.unload_model(key=model_instance.redis_key)
+            else:
+                await loop.run_in_executor(self.load_executor, partial(serving_engine.unload_model,
+                model_parameters=model_parameters,
+                storage_context=model_instance.storage_context,
+                serving_context=model_instance.serving_context,
+                worker_serving_context=model_instance.worker_serving_context
+                ))
         except Exception as e:
             logging.exception(e)
             logging.error("error unloading model")
         try:
-            await loop.run_in_executor(None, partial(storage_engine.clean_model,
+            await loop.run_in_executor(self.load_executor, partial(self.clean_model,
+            storage_engine_name=ns.settings["storage_engine"],
             model_parameters=model_parameters,
             storage_context=model_instance.storage_context
             ))
@@ -404,28 +690,284 @@ class Worker(object):
             logging.exception(e)
             logging.error("error cleaning storage for model")
         
+        self.local_model_footprints.pop(model_instance.redis_key, None)
+        self.model_instances_last_used.pop(model_instance.redis_key, None)
         await self.deregister_local_model_instance(model_instance)
 
     
+    async def fetch_model(self, storage_engine_name: str, model_parameters: dict) -> dict:
+        """Fetches through the artifact cache when the storage engine supports it.
+
+        Artifacts not cached yet are copied from peers having them, when
+        there are any, before falling back to the storage engine.
+        """
+        loop = asyncio.get_event_loop()
+        storage_engine = self.storage_engines[storage_engine_name]
+        artifact_key = None
+        if self.artifact_cache is not None:
+            try:
+                artifact_key = await loop.run_in_executor(self.load_executor, storage_engine.get_artifact_key, model_parameters)
+            except NotImplementedError:
+                pass
+        if artifact_key is None:
+            return await loop.run_in_executor(self.load_executor, partial(storage_engine.fetch_model,
+                model_parameters=model_parameters))
+        key = utils.get_redis_key(storage_engine_name, artifact_key)
+        peers = []
+        if self.artifact_peers is not None:
+            peers = await self.artifact_peers.find_peers(key)
+        storage_context = await loop.run_in_executor(self.load_executor, partial(self.artifact_cache.acquire,
+            key=key,
+            fetch=partial(self.fetch_artifact, storage_engine, model_parameters, peers, key)))
+        if self.artifact_peers is not None:
+            await self.artifact_peers.announce([key])
+        return storage_context
+
+    def fetch_artifact(self, storage_engine: StorageEngine, model_parameters: dict, peers: list, key: str, target_dir: str) -> dict:
+        if peers:
+            storage_context = self.artifact_peers.fetch(peers, key, target_dir)
+            if storage_context is not None:
+                return storage_context
+        return storage_engine.fetch_artifact(model_parameters, target_dir=target_dir)
+
+    def clean_model(self, storage_engine_name: str, model_parameters: dict, storage_context: dict):
+        if storage_context and storage_context.get("artifact_key"):
+            self.artifact_cache.release(storage_context["artifact_key"])
+            return
+        self.storage_engines[storage_engine_name].clean_model(
+            model_parameters=model_parameters,
+            storage_context=storage_context)
+
+    def start_request_limiter(self, model_instance: ModelInstance):
+        ns = model_instance.model.namespace
+        #namespaces saved before request queues existed have no settings for them
+        request_queue_settings = dict(NAMESPACE_DEFAULT_SETTINGS["request_queue"], **(ns.settings.get("request_queue") or {}))
+        self.request_limiters[model_instance.redis_key] = RequestLimiter(
+            max_concurrency=max(1, int(request_queue_settings["max_concurrency"])),
+            max_queue_size=max(0, int(request_queue_settings["max_queue_size"])))
+
+    def is_on_demand(self, model_instance: ModelInstance) -> bool:
+        return bool((model_instance.model.namespace.settings.get("on_demand") or {}).get("enabled"))
+
+    def get_on_demand_memory_reserved(self) -> int:
+        return sum(self.local_model_footprints.get(x.redis_key, {}).get("memory_bytes", 0)
+            for x in self.local_model_instances.values() if self.is_on_demand(x))
+
+    def get_on_demand_memory_budget(self) -> int:
+        return int(resources.get_memory_info()["memory_total"] * self.options.on_demand_memory_ratio)
+
+    def get_required_memory(self, model_version: ModelVersion) -> int:
+        footprint = model_version.footprint or {}
+        resources_settings = model_version.model.namespace.settings.get("resources") or {}
+        return int(footprint.get("memory_bytes") or resources_settings.get("default_memory_bytes") or 0)
+
+    def find_local_model_instance(self, namespace_id: str, model_id: str, version_id: int, state: str) -> ModelInstance:
+        """A local instance of the model in the given state, of any version when version_id is None."""
+        for model_instance in self.local_model_instances.values():
+            if (model_instance.state == state and model_instance.model.namespace.id == namespace_id
+                    and model_instance.model.id == model_id
+                    and (version_id is None or model_instance.model_version.id == version_id)):
+                return model_instance
+        return None
+
+    async def load_on_demand(self, namespace_id: str, model_id: str, version_id: int = None) -> ModelInstance:
+        """Loads a model of an on_demand namespace on this worker.
+
+        Requests for a model already loading here wait on the same load,
+        version_id None stands for the latest version.
+        """
+        #loaded already, the routing table hasn't caught up yet
+        model_instance = self.find_local_model_instance(namespace_id, model_id, version_id, state="serving")
+        if model_instance is not None:
+            return model_instance
+        key = utils.get_redis_key(namespace_id, model_id, str(version_id))
+        future = self.on_demand_loads.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._load_on_demand(namespace_id, model_id, version_id))
+            self.on_demand_loads[key] = future
+            future.add_done_callback(partial(self.on_demand_load_done, key))
+        #a request giving up must not cancel the load for the others
+        return await asyncio.shield(future)
+
+    def on_demand_load_done(self, key, future):
+        self.on_demand_loads.pop(key, None)
+        if not future.cancelled() and future.exception() is not None:
+            logging.error("Error loading on demand %s: %s", key, future.exception())
+
+    async def _load_on_demand(self, namespace_id: str, model_id: str, version_id: int = None) -> ModelInstance:
+        if self.state != "serving":
+            raise exceptions.ModelLoadError("worker is {}".format(self.state))
+        namespace = ModelNamespace(cluster=self.cluster, id=namespace_id)
+        await namespace.read()
+        model = Model(namespace=namespace, id=model_id)
+        await model.read()
+        model_version = model.latest_version
+        if version_id is not None and version_id != model.latest_version_id:
+            model_version = ModelVersion(model=model, id=version_id)
+            await model_version.read()
+        model_instance = ModelInstance(model_version=model_version, id=utils.get_uuid_as_string())
+        model_instance.worker_id = self.id
+        model_instance.state = "scheduled"
+        await model_instance.save()
+        logging.info("loading on demand model instance id=%s model_id=%s version=%s namespace=%s",
+            model_instance.id, model_id, model_version.id, namespace_id)
+        await self.evict_on_demand_instances(self.get_required_memory(model_version), for_on_demand=True)
+        async with self.model_loads_semaphore:
+            await self.activate_model_instance(model_instance)
+        if model_instance.state != "serving":
+            raise exceptions.ModelLoadError("{}: {}".format(model_instance.state, model_instance.error_messages))
+        return model_instance
+
+    async def evict_on_demand_instances(self, memory_bytes: int, for_on_demand: bool):
+        """Deactivates idle on_demand instances, least recently used first, to make room for memory_bytes.
+
+        On demand instances share the on demand memory budget, other
+        instances may take all the memory the on demand ones use.
+        """
+        def needs_room():
+            if for_on_demand:
+                return self.get_on_demand_memory_reserved() + memory_bytes > self.get_on_demand_memory_budget()
+            return resources.get_memory_info()["memory_available"] < memory_bytes
+
+        candidates = sorted(
+            filter(lambda x: self.is_on_demand(x) and x.state == "serving", self.local_model_instances.values()),
+            key=lambda x: self.model_instances_last_used.get(x.redis_key, 0))
+        for model_instance in candidates:
+            if not needs_room():
+                break
+            limiter = self.request_limiters.get(model_instance.redis_key)
+            if limiter is not None and (limiter.in_flight or limiter.queued):
+                continue
+            logging.info("evicting on demand model instance %s to make room for %d bytes", model_instance.id, memory_bytes)
+            await self.deactivate_model_instance(model_instance)
+
+    async def evict_idle_forever(self):
+        """Scales on_demand models down to zero once they have been idle for their idle_timeout."""
+        while not self.shutdown_requested:
+            now = time.monotonic()
+            for model_instance in list(self.local_model_instances.values()):
+                if not self.is_on_demand(model_instance) or model_instance.state != "serving":
+                    continue
+                idle_timeout = float(model_instance.model.namespace.settings["on_demand"].get("idle_timeout") or 0)
+                last_used_at = self.model_instances_last_used.setdefault(model_instance.redis_key, now)
+                if idle_timeout > 0 and now - last_used_at > idle_timeout:
+                    logging.info("evicting idle on demand model instance %s", model_instance.id)
+                    await self.deactivate_model_instance(model_instance)
+            slept = 0
+            while slept < ON_DEMAND_IDLE_CHECK_INTERVAL and not self.shutdown_requested:
+                await asyncio.sleep(1)
+                slept += 1
+
+    async def report_load_forever(self):
+        """Reports the load of the local instances of autoscaled models, for the scheduler to size them."""
+        while not self.shutdown_requested:
+            slept = 0
+            while slept < autoscaling.MODEL_LOAD_REPORT_INTERVAL and not self.shutdown_requested:
+                await asyncio.sleep(1)
+                slept += 1
+            try:
+                await self.report_load_once()
+            except Exception as e:
+                logging.exception(e)
+                logging.error("error reporting model load")
+
+    async def report_load_once(self):
+        capacities = Counter()
+        queued = Counter()
+        local_models = {}
+        for model_instance in self.local_model_instances.values():
+            ns = model_instance.model.namespace
+            if model_instance.state != "serving" or not (ns.settings.get("autoscaling") or {}).get("enabled"):
+                continue
+            model_key = get_model_key(ns.id, model_instance.model.id)
+            limiter = self.request_limiters.get(model_instance.redis_key)
+            capacities[model_key] += limiter.max_concurrency if limiter is not None else 1
+            queued[model_key] += limiter.queued if limiter is not None else 0
+            local_models[model_key] = model_instance.model
+        loads = self.load_tracker.flush(capacities, queued)
+
+        hot_models = []
+        async with self.cluster.redis.pipeline(transaction=False) as pipe:
+            for model_key, load in loads.items():
+                model = local_models[model_key]
+                load_key = autoscaling.get_model_load_key(self.cluster, model.namespace.id, model.id)
+                pipe.hset(load_key, self.id, json.dumps(load))
+                pipe.expire(load_key, autoscaling.MODEL_LOAD_MAX_AGE)
+                if autoscaling.needs_scale_up(load, model.namespace.settings):
+                    hot_models.append(model_key)
+            for model_key in self.load_reported_models - set(loads):
+                namespace_id, model_id = utils.split_redis_key(model_key)
+                pipe.hdel(autoscaling.get_model_load_key(self.cluster, namespace_id, model_id), self.id)
+            await pipe.execute()
+        self.load_reported_models = set(loads)
+        #scaling down waits for the periodic full reconcile, scaling up shouldn't
+        await mark_models_dirty(self.cluster, hot_models)
+
+    def get_load(self):
+        return sum(x.in_flight + x.queued for x in self.request_limiters.values())
+
+    def get_model_instances_load(self):
+        model_instances_load = {}
+        for key, limiter in self.request_limiters.items():
+            model_instance = self.local_model_instances.get(key)
+            if model_instance is None:
+                continue
+            model_instances_load[model_instance.id] = {
+                "in_flight": limiter.in_flight,
+                "queued": limiter.queued
+                }
+        return model_instances_load
+
+    def start_batcher(self, model_instance: ModelInstance):
+        ns = model_instance.model.namespace
+        serving_engine = self.serving_engines[ns.settings["serving_engine"]]
+        batching_settings = ns.settings.get("batching") or {}
+        max_batch_size = int(batching_settings.get("max_batch_size") or 1)
+        if max_batch_size <= 1 or not serving_engine.supports_infer_batch():
+            return
+        batcher = Batcher(
+            infer_batch=partial(self._infer_batch, model_instance),
+            max_batch_size=max_batch_size,
+            max_wait_time=float(batching_settings.get("max_wait_time") or 0))
+        batcher.start()
+        self.batchers[model_instance.redis_key] = batcher
+
+    async def stop_batcher(self, model_instance: ModelInstance):
+        batcher = self.batchers.pop(model_instance.redis_key, None)
+        if batcher is not None:
+            await batcher.stop()
+
     async def register_local_model_instance(self, model_instance:ModelInstance):
         self.local_model_instances[model_instance.redis_key] = model_instance
-        await self.report_once(send_events=True)
+        self.request_report()
     
     async def deregister_local_model_instance(self, model_instance:ModelInstance):
         try:
             del self.local_model_instances[model_instance.redis_key]
         except KeyError:
             pass
-        await self.report_once(send_events=True)
+        self.request_report()
     
+    def create_http_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.options.routing_connection_limit,
+            limit_per_host=self.options.routing_connection_limit_per_host,
+            keepalive_timeout=self.options.routing_keepalive_timeout)
+        timeout = aiohttp.ClientTimeout(
+            total=self.options.routing_request_timeout,
+            sock_connect=self.options.routing_connect_timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
     async def apply_worker_annotators(self):
         annotations = {}
         for each in WORKER_ANNOTATORS:
             annotations.update(await each(self))
         self.serving_endpoint = annotations.get("serving_endpoint")
+        self.artifact_endpoint = annotations.get("artifact_endpoint")
 
     async def run_forever(self):
         from .scheduler import Scheduler
+        from .routing import RoutingTable
 
         self.clean_options()
 
@@ -436,6 +978,25 @@ class Worker(object):
 
         self.compute_rack()
 
+        loop = asyncio.get_event_loop()
+
+        #in place before the APIs start, requests may come in as soon as they do
+        self.model_loads_semaphore = asyncio.Semaphore(self.options.max_concurrent_model_loads)
+        self.load_executor = ThreadPoolExecutor(max_workers=self.options.model_load_threads,
+            thread_name_prefix="inferout-load")
+        self.infer_executor = ThreadPoolExecutor(max_workers=self.options.inference_threads or None,
+            thread_name_prefix="inferout-infer")
+
+        self.http_session = self.create_http_session()
+        self.load_balancer = LoadBalancer(worker=self,
+            policy=self.options.routing_policy,
+            rack_overload_threshold=self.options.routing_rack_overload_threshold)
+
+        self.routing_table = RoutingTable(cluster=self.cluster, worker=self)
+        self.routing_table_pubsub_task = loop.create_task(await self.routing_table.setup_pubsub())
+        await self.routing_table.sync_once()
+        self.routing_table_sync_task = loop.create_task(self.routing_table.sync_forever())
+
         management_api_runner = web.AppRunner(management_api.app)
         management_api.context_worker.set(self)
         await management_api_runner.setup()
@@ -452,23 +1013,57 @@ class Worker(object):
         await serving_api_site.start()
         logging.info("Serving API started, host=%s port=%d",self.options.serving_host, self.options.serving_port)
 
-        loop = asyncio.get_event_loop()
-
         self.state = "initializing"
         await self.report_once(send_events=True)
         self.report_forever_task = loop.create_task(self.report_forever())
         await loop.run_in_executor(None, self.load_storage_engines, self.options.storage_engines)
         await loop.run_in_executor(None, self.load_serving_engines, self.options.serving_engines)
+        if self.options.artifact_cache_max_bytes > 0:
+            self.artifact_cache = ArtifactCache(cache_dir=self.options.artifact_cache_dir,
+                max_bytes=self.options.artifact_cache_max_bytes)
+            if self.options.artifact_peer_max_uploads > 0:
+                self.artifact_peers = ArtifactPeers(worker=self,
+                    artifact_cache=self.artifact_cache,
+                    max_uploads=self.options.artifact_peer_max_uploads,
+                    upload_rate=self.options.artifact_peer_upload_rate,
+                    token=self.options.artifact_peer_token)
+                self.artifact_cache.on_evict = self.artifact_peers.on_evict
+                if not self.options.artifact_peer_token:
+                    logging.warning("Artifact API serves cached artifacts to anyone reaching %s:%d, set --artifact-peer-token",
+                        self.options.artifact_peer_host, self.options.artifact_peer_port)
+
+                #kept off the serving API, which may be exposed outside the cluster
+                artifact_api_runner = web.AppRunner(artifact_api.app)
+                artifact_api.context_worker.set(self)
+                await artifact_api_runner.setup()
+                artifact_api_site = web.TCPSite(artifact_api_runner,
+                    self.options.artifact_peer_host, self.options.artifact_peer_port)
+                await artifact_api_site.start()
+                logging.info("Artifact API started, host=%s port=%d",self.options.artifact_peer_host, self.options.artifact_peer_port)
+            await loop.run_in_executor(None, self.artifact_cache.load)
+
+        if self.options.serving_processes > 0:
+            self.process_pool = ServingProcessPool(
+                serving_engines=self.serving_engines,
+                size=self.options.serving_processes)
+            self.process_pool.start()
         
         self.state = "serving"
         await self.report_once(send_events=True)
+        if self.artifact_peers is not None:
+            await self.artifact_peers.announce(self.artifact_cache.get_keys())
 
-        self.worker_pubsub = self.cluster.redis.pubsub()
-        await self.worker_pubsub.subscribe(
-            self.cluster.get_redis_channel_key(self.worker_key)
-            )
-
-        self.worker_pubsub_task = loop.create_task(self.channel_reader())
+        #reads everything sent to us, including events sent before we got here
+        self.event_stream_reader = events.EventStreamReader(cluster=self.cluster,
+            stream_name=self.worker_key,
+            group="worker",
+            consumer=self.id,
+            handler=self.handle_event,
+            start_id="0")
+        await self.event_stream_reader.setup()
+        self.worker_events_task = loop.create_task(self.event_stream_reader.read_forever())
+        self.evict_idle_task = loop.create_task(self.evict_idle_forever())
+        self.report_load_task = loop.create_task(self.report_load_forever())
         self.scheduler = Scheduler(cluster=self.cluster, worker=self)
         self.scheduler_task = loop.create_task(self.scheduler.schedule_forever())
         self.scheduler_pubsub_task = loop.create_task(await self.scheduler.setup_pubsub())
@@ -481,19 +1076,59 @@ class Worker(object):
         await asyncio.gather(
             self.report_forever_task,
             self.scheduler_task,
-            self.worker_pubsub_task,
-            self.scheduler_pubsub_task
+            self.worker_events_task,
+            self.evict_idle_task,
+            self.report_load_task,
+            self.scheduler_pubsub_task,
+            self.routing_table_sync_task,
+            self.routing_table_pubsub_task
         )
     
     async def do_infer(self, model_instance:ModelInstance, data: dict):
         local_instance = self.local_model_instances[model_instance.redis_key]
+        self.model_instances_last_used[local_instance.redis_key] = time.monotonic()
+        limiter = self.request_limiters.get(local_instance.redis_key)
+        model_key = get_model_key(local_instance.model.namespace.id, local_instance.model.id)
+        started_at = time.monotonic()
+        if limiter is None:
+            try:
+                return await self._infer(local_instance, data)
+            finally:
+                self.load_tracker.record(model_key, time.monotonic() - started_at)
+        #requests shed by a full queue aren't recorded, the queue depth shows them
+        async with limiter:
+            try:
+                return await self._infer(local_instance, data)
+            finally:
+                self.load_tracker.record(model_key, time.monotonic() - started_at)
+
+    async def _infer(self, local_instance:ModelInstance, data: dict):
+        batcher = self.batchers.get(local_instance.redis_key)
+        if batcher is not None:
+            return await batcher.submit(deepcopy(data))
+        if self.process_pool is not None:
+            return await self.process_pool.infer(key=local_instance.redis_key, data=data)
         ns = local_instance.model.namespace
         serving_engine = self.serving_engines[ns.settings["serving_engine"]]
         loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(None, partial(serving_engine.infer,
+        return await loop.run_in_executor(self.infer_executor, partial(serving_engine.infer,
             model_parameters=local_instance.model_version.parameters,
             storage_context=local_instance.storage_context,
             serving_context=local_instance.serving_context,
             worker_serving_context=local_instance.worker_serving_context,
             data=deepcopy(data))
-            )
\ No newline at end of file
+            )
+
+    async def _infer_batch(self, local_instance:ModelInstance, data_list: list):
+        if self.process_pool is not None:
+            return await self.process_pool.infer_batch(key=local_instance.redis_key, data_list=data_list)
+        ns = local_instance.model.namespace
+        serving_engine = self.serving_engines[ns.settings["serving_engine"]]
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.infer_executor, partial(serving_engine.infer_batch,
+            model_parameters=local_instance.model_version.parameters,
+            storage_context=local_instance.storage_context,
+            serving_context=local_instance.serving_context,
+            worker_serving_context=local_instance.worker_serving_context,
+            data_list=data_list)
+            )
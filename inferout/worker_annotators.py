@@ -2,4 +2,10 @@ async def serving_endpoint_from_options(worker):
     host = worker.options.serving_host
     port = worker.options.serving_port
     endpoint = "http://{host}:{port}".format(host=host,port=port)
-    return {"serving_endpoint": endpoint}
\ No newline at end of file
+    return {"serving_endpoint": endpoint}
+
+async def artifact_endpoint_from_options(worker):
+    host = worker.options.artifact_peer_host
+    port = worker.options.artifact_peer_port
+    endpoint = "http://{host}:{port}".format(host=host,port=port)
+    return {"artifact_endpoint": endpoint}
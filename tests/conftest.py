@@ -0,0 +1,54 @@
+import asyncio
+import os
+
+import aioredis
+import pytest
+
+from inferout.cluster import Cluster
+from inferout import utils
+
+TEST_REDIS_URL = os.environ.get("INFEROUT_TEST_REDIS_URL", "redis://localhost:6379/15")
+
+
+def connect_redis():
+    return aioredis.from_url(TEST_REDIS_URL, encoding="utf-8", decode_responses=True)
+
+async def ping_redis():
+    redis = connect_redis()
+    try:
+        await redis.ping()
+    finally:
+        await redis.close()
+
+async def delete_keys(redis_key_prefix):
+    redis = connect_redis()
+    try:
+        keys = [x async for x in redis.scan_iter(match=redis_key_prefix + "*")]
+        if keys:
+            await redis.delete(*keys)
+    finally:
+        await redis.close()
+
+
+@pytest.fixture
+def run_with_cluster():
+    """Runs a coroutine function with a Cluster on the test redis, skipped when it isn't reachable.
+
+    Every test gets a key prefix of its own, its keys are deleted afterwards.
+    """
+    try:
+        asyncio.run(ping_redis())
+    except (aioredis.exceptions.ConnectionError, OSError):
+        pytest.skip("redis not reachable at " + TEST_REDIS_URL)
+    redis_key_prefix = "inferout-test-" + utils.get_uuid_as_string()
+
+    def run(test):
+        async def run_test():
+            cluster = Cluster(redis=connect_redis(), redis_key_prefix=redis_key_prefix, name="test")
+            try:
+                return await test(cluster)
+            finally:
+                await cluster.redis.close()
+        return asyncio.run(run_test())
+    yield run
+    asyncio.run(delete_keys(redis_key_prefix))
@@ -0,0 +1,104 @@
+import hashlib
+import os
+
+import pytest
+
+from inferout.artifact_cache import ArtifactCache, ARTIFACT_DIR_PLACEHOLDER, resolve_storage_context
+
+
+def make_fetch(size, calls=None):
+    def fetch(target_dir):
+        if calls is not None:
+            calls.append(target_dir)
+        with open(os.path.join(target_dir, "model.bin"), "wb") as f:
+            f.write(b"x" * size)
+        return {"model_dir": target_dir}
+    return fetch
+
+def test_cached_artifacts_are_fetched_once(tmp_path):
+    cache = ArtifactCache(cache_dir=str(tmp_path), max_bytes=1000)
+    cache.load()
+    calls = []
+    first = cache.acquire("k1", make_fetch(10, calls))
+    second = cache.acquire("k1", make_fetch(10, calls))
+    assert len(calls) == 1
+    assert first == second
+    assert first["artifact_key"] == "k1"
+    assert os.path.isfile(os.path.join(first["model_dir"], "model.bin"))
+    assert cache.entries[cache.get_entry_id("k1")]["refs"] == 2
+
+def test_least_recently_used_artifacts_are_evicted(tmp_path):
+    evicted = []
+    cache = ArtifactCache(cache_dir=str(tmp_path), max_bytes=25, on_evict=evicted.append)
+    cache.load()
+    for key in ("k1", "k2"):
+        cache.acquire(key, make_fetch(10))
+        cache.release(key)
+    #k1 is used again, k2 becomes the least recently used one
+    cache.acquire("k1", make_fetch(10))
+    cache.release("k1")
+    cache.acquire("k3", make_fetch(10))
+    assert evicted == ["k2"]
+    assert cache.get_keys() == ["k1", "k3"]
+    assert not os.path.exists(cache.get_entry_path(cache.get_entry_id("k2")))
+
+def test_artifacts_in_use_are_never_evicted(tmp_path):
+    evicted = []
+    cache = ArtifactCache(cache_dir=str(tmp_path), max_bytes=15, on_evict=evicted.append)
+    cache.load()
+    cache.acquire("k1", make_fetch(10))
+    cache.acquire("k2", make_fetch(10))
+    assert evicted == []
+    cache.release("k1")
+    assert evicted == ["k1"]
+    #extra releases don't make refs negative
+    cache.release("k2")
+    cache.release("k2")
+    assert cache.entries[cache.get_entry_id("k2")]["refs"] == 0
+
+def test_failed_fetches_leave_nothing_behind(tmp_path):
+    cache = ArtifactCache(cache_dir=str(tmp_path), max_bytes=1000)
+    cache.load()
+    def fetch(target_dir):
+        raise OSError("unreachable")
+    with pytest.raises(OSError):
+        cache.acquire("k1", fetch)
+    assert cache.get_keys() == []
+    assert cache.fetching == {}
+    assert not os.path.exists(cache.get_entry_path(cache.get_entry_id("k1")))
+    #the next acquire fetches again
+    cache.acquire("k1", make_fetch(10))
+    assert cache.get_keys() == ["k1"]
+
+def test_artifacts_survive_restarts(tmp_path):
+    cache = ArtifactCache(cache_dir=str(tmp_path), max_bytes=1000)
+    cache.load()
+    cache.acquire("k1", make_fetch(10))
+    os.makedirs(os.path.join(str(tmp_path), "incomplete", "data"))
+    cache = ArtifactCache(cache_dir=str(tmp_path), max_bytes=1000)
+    cache.load()
+    assert cache.get_keys() == ["k1"]
+    assert cache.entries[cache.get_entry_id("k1")]["refs"] == 0
+    assert not os.path.exists(os.path.join(str(tmp_path), "incomplete"))
+
+def test_manifest_relocates_storage_context(tmp_path):
+    cache = ArtifactCache(cache_dir=str(tmp_path), max_bytes=1000)
+    cache.load()
+    cache.acquire("k1", make_fetch(10))
+    entry_id = cache.get_entry_id("k1")
+    manifest = cache.get_manifest(entry_id)
+    assert manifest["files"] == [{"path": "model.bin", "size": 10, "sha256": hashlib.sha256(b"x" * 10).hexdigest()}]
+    assert manifest["storage_context"] == {"model_dir": ARTIFACT_DIR_PLACEHOLDER}
+    assert resolve_storage_context(manifest["storage_context"], "/elsewhere") == {"model_dir": "/elsewhere"}
+    assert cache.get_manifest("0" * 64) is None
+
+def test_file_paths_stay_inside_the_artifact(tmp_path):
+    cache = ArtifactCache(cache_dir=str(tmp_path), max_bytes=1000)
+    cache.load()
+    cache.acquire("k1", make_fetch(10))
+    entry_id = cache.get_entry_id("k1")
+    assert cache.get_file_path(entry_id, "model.bin") == os.path.join(
+        os.path.realpath(cache.get_data_dir(entry_id)), "model.bin")
+    assert cache.get_file_path(entry_id, "../artifact.json") is None
+    assert cache.get_file_path(entry_id, "missing.bin") is None
+    assert cache.get_file_path("..", "model.bin") is None
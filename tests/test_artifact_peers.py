@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import types
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from inferout import artifact_api
+from inferout.artifact_cache import ArtifactCache, ARTIFACT_DIR_PLACEHOLDER
+from inferout.artifact_peers import ArtifactPeers, ARTIFACT_PEER_PATH, ARTIFACT_PEER_TOKEN_HEADER, ARTIFACT_PEER_IDLE_TIMEOUT
+
+PEER_URL = "http://peer:9520" + ARTIFACT_PEER_PATH + "/entry"
+
+
+def make_artifact_peers(cache_dir, token=""):
+    worker = types.SimpleNamespace(id="self", cluster=None, rack="", load_executor=None)
+    artifact_cache = ArtifactCache(cache_dir=cache_dir, max_bytes=1000)
+    return ArtifactPeers(worker=worker, artifact_cache=artifact_cache, max_uploads=1, upload_rate=0, token=token)
+
+def serve_from(artifact_peers, responses):
+    """Has artifact_peers read urls from responses instead of the network."""
+    def open_url(url):
+        if url not in responses:
+            raise OSError("not found " + url)
+        return io.BytesIO(responses[url])
+    artifact_peers.open_url = open_url
+
+def make_manifest(files):
+    return json.dumps({
+        "key": "k1",
+        "storage_context": {"model_dir": ARTIFACT_DIR_PLACEHOLDER},
+        "files": [{"path": path, "size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+            for path, data in files.items()]
+        }).encode()
+
+
+def test_download_copies_files_and_resolves_storage_context(tmp_path):
+    artifact_peers = make_artifact_peers(str(tmp_path / "cache"))
+    target_dir = tmp_path / "target"
+    target_dir.mkdir()
+    serve_from(artifact_peers, {
+        PEER_URL: make_manifest({"model.bin": b"abc", "sub dir/vocab.txt": b"de"}),
+        PEER_URL + "/files/model.bin": b"abc",
+        PEER_URL + "/files/sub%20dir/vocab.txt": b"de"})
+    storage_context = artifact_peers.download(PEER_URL, str(target_dir))
+    assert storage_context == {"model_dir": str(target_dir)}
+    assert (target_dir / "model.bin").read_bytes() == b"abc"
+    assert (target_dir / "sub dir" / "vocab.txt").read_bytes() == b"de"
+
+@pytest.mark.parametrize("path", ["../escaped.bin", "sub/../../escaped.bin", "/tmp/escaped.bin", ".", "sub/.."])
+def test_download_rejects_paths_outside_the_target_dir(tmp_path, path):
+    artifact_peers = make_artifact_peers(str(tmp_path / "cache"))
+    target_dir = tmp_path / "target"
+    target_dir.mkdir()
+    serve_from(artifact_peers, {
+        PEER_URL: make_manifest({path: b"abc"}),
+        PEER_URL + "/files/" + path: b"abc"})
+    with pytest.raises(ValueError):
+        artifact_peers.download(PEER_URL, str(target_dir))
+    assert not (tmp_path / "escaped.bin").exists()
+
+def test_download_rejects_symlinks_out_of_the_target_dir(tmp_path):
+    artifact_peers = make_artifact_peers(str(tmp_path / "cache"))
+    target_dir = tmp_path / "target"
+    target_dir.mkdir()
+    (tmp_path / "outside").mkdir()
+    os.symlink(str(tmp_path / "outside"), str(target_dir / "link"))
+    serve_from(artifact_peers, {
+        PEER_URL: make_manifest({"link/escaped.bin": b"abc"}),
+        PEER_URL + "/files/link/escaped.bin": b"abc"})
+    with pytest.raises(ValueError):
+        artifact_peers.download(PEER_URL, str(target_dir))
+    assert not (tmp_path / "outside" / "escaped.bin").exists()
+
+def test_download_rejects_size_mismatch(tmp_path):
+    artifact_peers = make_artifact_peers(str(tmp_path / "cache"))
+    target_dir = tmp_path / "target"
+    target_dir.mkdir()
+    serve_from(artifact_peers, {
+        PEER_URL: make_manifest({"model.bin": b"abc"}),
+        PEER_URL + "/files/model.bin": b"ab"})
+    with pytest.raises(ValueError):
+        artifact_peers.download(PEER_URL, str(target_dir))
+
+def test_download_rejects_checksum_mismatch(tmp_path):
+    artifact_peers = make_artifact_peers(str(tmp_path / "cache"))
+    target_dir = tmp_path / "target"
+    target_dir.mkdir()
+    serve_from(artifact_peers, {
+        PEER_URL: make_manifest({"model.bin": b"abc"}),
+        PEER_URL + "/files/model.bin": b"abd"})
+    with pytest.raises(ValueError):
+        artifact_peers.download(PEER_URL, str(target_dir))
+
+def test_download_rejects_manifests_without_checksums(tmp_path):
+    artifact_peers = make_artifact_peers(str(tmp_path / "cache"))
+    target_dir = tmp_path / "target"
+    target_dir.mkdir()
+    manifest = json.loads(make_manifest({"model.bin": b"abc"}))
+    del manifest["files"][0]["sha256"]
+    serve_from(artifact_peers, {
+        PEER_URL: json.dumps(manifest).encode(),
+        PEER_URL + "/files/model.bin": b"abc"})
+    with pytest.raises(ValueError):
+        artifact_peers.download(PEER_URL, str(target_dir))
+
+def test_fetch_falls_back_to_the_next_peer_and_cleans_up(tmp_path):
+    artifact_peers = make_artifact_peers(str(tmp_path / "cache"))
+    target_dir = tmp_path / "target"
+    target_dir.mkdir()
+    entry_id = artifact_peers.artifact_cache.get_entry_id("k1")
+    bad_url = "http://bad:9520" + ARTIFACT_PEER_PATH + "/" + entry_id
+    good_url = "http://good:9520" + ARTIFACT_PEER_PATH + "/" + entry_id
+    serve_from(artifact_peers, {
+        bad_url: make_manifest({"model.bin": b"abc", "other.bin": b"abc"}),
+        bad_url + "/files/model.bin": b"abc",
+        good_url: make_manifest({"model.bin": b"abc"}),
+        good_url + "/files/model.bin": b"abc"})
+    peers = [
+        {"id": "old", "serving_endpoint": "http://old:9510"},#doesn't serve artifacts
+        {"id": "bad", "artifact_endpoint": "http://bad:9520"},
+        {"id": "good", "artifact_endpoint": "http://good:9520"}]
+    storage_context = artifact_peers.fetch(peers, "k1", str(target_dir))
+    assert storage_context == {"model_dir": str(target_dir)}
+    assert sorted(os.listdir(str(target_dir))) == ["model.bin"]
+    assert artifact_peers.fetch(peers[:2], "k1", str(target_dir)) is None
+    assert os.listdir(str(target_dir)) == []
+
+
+def test_artifact_api_requires_the_token(tmp_path):
+    async def run():
+        artifact_peers = make_artifact_peers(str(tmp_path), token="secret")
+        artifact_peers.artifact_cache.load()
+        artifact_peers.artifact_cache.acquire("k1", lambda target_dir: {"model_dir": target_dir})
+        worker = artifact_peers.worker
+        worker.artifact_peers = artifact_peers
+        worker.artifact_cache = artifact_peers.artifact_cache
+        artifact_api.context_worker.set(worker)
+        path = ARTIFACT_PEER_PATH + "/" + artifact_peers.artifact_cache.get_entry_id("k1")
+        async with TestClient(TestServer(artifact_api.app)) as client:
+            response = await client.get(path)
+            assert response.status == 403
+            response = await client.get(path, headers={ARTIFACT_PEER_TOKEN_HEADER: "wrong"})
+            assert response.status == 403
+            response = await client.get(path, headers={ARTIFACT_PEER_TOKEN_HEADER: "secret"})
+            assert response.status == 200
+            assert (await response.json())["key"] == "k1"
+    asyncio.run(run())
+
+def test_max_uploads_counts_peers():
+    async def run():
+        artifact_peers = make_artifact_peers("unused")
+        assert artifact_peers.start_upload("w1")
+        #more files for the same peer at once
+        assert artifact_peers.start_upload("w1")
+        assert not artifact_peers.start_upload("w2")
+        artifact_peers.end_upload("w1")
+        artifact_peers.end_upload("w1")
+        #w1 keeps its slot between files
+        assert not artifact_peers.start_upload("w2")
+        artifact_peers.uploading_peers["w1"][1] -= ARTIFACT_PEER_IDLE_TIMEOUT + 1
+        assert artifact_peers.start_upload("w2")
+        assert not artifact_peers.start_upload("w1")
+    asyncio.run(run())
@@ -0,0 +1,90 @@
+from inferout.autoscaling import ModelLoadTracker, get_desired_instances, get_utilization, needs_scale_up, MODEL_LOAD_MAX_AGE
+
+NOW = 10000.0
+
+
+def make_settings(min_instances=1, max_instances=10, max_concurrency=4, **autoscaling):
+    return {
+        "instances_per_model": {"min": min_instances, "max": max_instances},
+        "request_queue": {"max_concurrency": max_concurrency},
+        "autoscaling": dict({"enabled": True, "target_utilization": 0.5, "tolerance": 0.1,
+            "scale_up_cooldown": 30, "scale_down_cooldown": 300}, **autoscaling)
+        }
+
+def make_load(concurrency, qps=1.0, latency=0.1, queued=0, capacity=4, reported_at=NOW):
+    return {"qps": qps, "concurrency": concurrency, "latency": latency, "queued": queued,
+        "capacity": capacity, "reported_at": reported_at}
+
+def desired(current, loads, settings, scaled_at=0.0):
+    return get_desired_instances(current=current, scaled_at=scaled_at, loads=loads, settings=settings, now=NOW)
+
+
+def test_scales_up_to_target_utilization():
+    #8 busy slots at 4 per instance and 50% target utilization
+    assert desired(2, [make_load(4), make_load(4)], make_settings()) == 4
+
+def test_scales_down_when_idle():
+    assert desired(4, [make_load(0.5), make_load(0.5)], make_settings()) == 1
+
+def test_stays_within_tolerance():
+    #utilization 0.525, within 10% of the target either way
+    assert desired(4, [make_load(4.2), make_load(4.2)], make_settings()) == 4
+
+def test_queued_requests_are_not_counted_twice():
+    #concurrency already includes the time requests spend queued
+    assert desired(2, [make_load(4, queued=10), make_load(4, queued=10)], make_settings()) == 4
+
+def test_bounded_by_instances_per_model():
+    assert desired(2, [make_load(100)], make_settings(max_instances=5)) == 5
+    assert desired(5, [make_load(0)], make_settings(min_instances=3)) == 3
+    #current out of bounds is brought back in
+    assert desired(0, [], make_settings(min_instances=2)) == 2
+
+def test_no_recent_loads_keep_the_current_count():
+    assert desired(3, [], make_settings()) == 3
+    stale = make_load(100, reported_at=NOW - MODEL_LOAD_MAX_AGE - 1)
+    assert desired(3, [stale], make_settings()) == 3
+
+def test_cooldowns():
+    settings = make_settings()
+    assert desired(2, [make_load(8)], settings, scaled_at=NOW - 10) == 2
+    assert desired(2, [make_load(8)], settings, scaled_at=NOW - 31) == 4
+    assert desired(4, [make_load(0)], settings, scaled_at=NOW - 200) == 4
+    assert desired(4, [make_load(0)], settings, scaled_at=NOW - 301) == 1
+
+def test_latency_above_max_latency_adds_an_instance_when_busy():
+    settings = make_settings(max_latency=0.5)
+    assert desired(2, [make_load(4, latency=1.0)], settings) == 3
+    #slow but idle
+    assert desired(2, [make_load(1, latency=1.0)], settings) == 1
+
+def test_capacity_defaults_to_namespace_defaults():
+    settings = make_settings()
+    del settings["request_queue"]
+    #16 concurrent requests per instance by default
+    assert desired(1, [make_load(16)], settings) == 2
+
+def test_utilization():
+    assert get_utilization(make_load(2, capacity=4)) == 0.5
+    assert get_utilization(make_load(2, capacity=0)) == 0.0
+
+def test_needs_scale_up():
+    settings = make_settings()
+    assert needs_scale_up(make_load(3, capacity=4), settings)
+    assert not needs_scale_up(make_load(2, capacity=4), settings)
+    settings["autoscaling"]["enabled"] = False
+    assert not needs_scale_up(make_load(3, capacity=4), settings)
+
+def test_load_tracker_reports_concurrency():
+    tracker = ModelLoadTracker()
+    tracker.window_started_at -= 2
+    tracker.record("m1", 1.0)
+    tracker.record("m1", 3.0)
+    loads = tracker.flush(capacities={"m1": 4, "m2": 4}, queued={"m1": 1})
+    assert abs(loads["m1"]["concurrency"] - 2.0) < 0.1
+    assert abs(loads["m1"]["qps"] - 1.0) < 0.1
+    assert loads["m1"]["latency"] == 2.0
+    assert loads["m1"]["queued"] == 1
+    assert loads["m2"]["concurrency"] == 0.0
+    #a new window starts
+    assert tracker.flush(capacities={"m1": 4}, queued={})["m1"]["qps"] == 0.0
@@ -0,0 +1,126 @@
+import hashlib
+import io
+import os
+import tarfile
+
+import pytest
+
+pytest.importorskip("boto3")
+
+from inferout.storage_engines.aws_s3 import RangedReader, StorageEngine, ChecksumMismatchError
+
+DATA = bytes(range(256)) * 40
+
+
+class MemoryS3Client(object):
+    """Answers head_object and ranged get_object from objects kept in memory."""
+    def __init__(self) -> None:
+        self.objects = {}#(bucket, key) -> (data, etag)
+        self.ranges = []
+
+    def put(self, bucket, key, data, etag=None):
+        self.objects[(bucket, key)] = (data, etag or hashlib.md5(data).hexdigest())
+
+    def head_object(self, Bucket, Key):
+        data, etag = self.objects[(Bucket, Key)]
+        return {"ContentLength": len(data), "ETag": '"{}"'.format(etag)}
+
+    def get_object(self, Bucket, Key, Range, IfMatch):
+        data, etag = self.objects[(Bucket, Key)]
+        if IfMatch.strip('"') != etag:
+            raise ValueError("PreconditionFailed")
+        start, end = [int(x) for x in Range[len("bytes="):].split("-")]
+        self.ranges.append((start, end))
+        return {"Body": io.BytesIO(data[start:end+1])}
+
+
+def make_storage_engine(s3_client, temp_dir):
+    storage_engine = StorageEngine()
+    storage_engine.s3_client = s3_client
+    storage_engine.temp_dir = temp_dir
+    storage_engine.part_size = 1000
+    storage_engine.max_concurrency = 3
+    return storage_engine
+
+def make_tar_gz(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def test_ranged_reader_reads_parts_in_order():
+    s3_client = MemoryS3Client()
+    s3_client.put("bucket", "model.bin", DATA)
+    reader = RangedReader(s3_client, bucket="bucket", key="model.bin", size=len(DATA),
+        etag=s3_client.head_object("bucket", "model.bin")["ETag"], part_size=1000, max_concurrency=3)
+    try:
+        assert reader.read() == DATA
+    finally:
+        reader.close()
+    assert sorted(s3_client.ranges) == [(x, min(x+1000, len(DATA))-1) for x in range(0, len(DATA), 1000)]
+    assert reader.md5.hexdigest() == hashlib.md5(DATA).hexdigest()
+    assert reader.sha256.hexdigest() == hashlib.sha256(DATA).hexdigest()
+
+def test_ranged_reader_fails_when_the_object_is_replaced():
+    s3_client = MemoryS3Client()
+    s3_client.put("bucket", "model.bin", DATA)
+    reader = RangedReader(s3_client, bucket="bucket", key="model.bin", size=len(DATA),
+        etag='"stale"', part_size=1000, max_concurrency=3)
+    try:
+        with pytest.raises(ValueError):
+            reader.read()
+    finally:
+        reader.close()
+
+def test_ranged_reader_close_drops_parts_not_fetched():
+    s3_client = MemoryS3Client()
+    s3_client.put("bucket", "model.bin", DATA)
+    reader = RangedReader(s3_client, bucket="bucket", key="model.bin", size=len(DATA),
+        etag=s3_client.head_object("bucket", "model.bin")["ETag"], part_size=100, max_concurrency=2)
+    assert reader.read(10) == DATA[:10]
+    reader.close()
+    assert reader.closed
+    assert len(reader.pending) == 0
+
+def test_fetch_verifies_checksums(tmp_path):
+    s3_client = MemoryS3Client()
+    s3_client.put("bucket", "model.bin", DATA)
+    storage_engine = make_storage_engine(s3_client, str(tmp_path))
+    model_parameters = {"storage_aws_s3_url": "s3://bucket/model.bin"}
+    storage_context = storage_engine.fetch_model(model_parameters)
+    with open(storage_context["local_path"], "rb") as f:
+        assert f.read() == DATA
+    storage_engine.clean_model(model_parameters, storage_context)
+
+    with pytest.raises(ChecksumMismatchError):
+        storage_engine.fetch_model(dict(model_parameters, storage_aws_s3_sha256="0" * 64))
+    storage_engine.fetch_model(dict(model_parameters, storage_aws_s3_sha256=hashlib.sha256(DATA).hexdigest()))
+    #without a sha256 a plain ETag is checked as the MD5
+    s3_client.put("bucket", "model.bin", DATA, etag="0" * 32)
+    with pytest.raises(ChecksumMismatchError):
+        storage_engine.fetch_model(model_parameters)
+    #ETags of multipart uploads aren't MD5s
+    s3_client.put("bucket", "model.bin", DATA, etag="0" * 32 + "-2")
+    storage_engine.fetch_model(model_parameters)
+    #only the two fetches not cleaned are left, failed ones leave nothing behind
+    assert len(os.listdir(str(tmp_path))) == 2
+
+def test_tar_archives_are_extracted_while_downloading(tmp_path):
+    s3_client = MemoryS3Client()
+    archive = make_tar_gz({"model.bin": DATA, "config/vocab.txt": b"abc"})
+    s3_client.put("bucket", "model.tar.gz", archive)
+    storage_engine = make_storage_engine(s3_client, str(tmp_path))
+    storage_context = storage_engine.fetch_artifact({
+        "storage_aws_s3_url": "s3://bucket/model.tar.gz",
+        "storage_aws_s3_unpack_archive": True,
+        "storage_aws_s3_sha256": hashlib.sha256(archive).hexdigest()}, str(tmp_path))
+    assert storage_context == {"local_path": os.path.join(str(tmp_path), "unpacked")}
+    assert sorted(os.listdir(str(tmp_path))) == ["unpacked"]
+    with open(os.path.join(storage_context["local_path"], "model.bin"), "rb") as f:
+        assert f.read() == DATA
+    with open(os.path.join(storage_context["local_path"], "config", "vocab.txt"), "rb") as f:
+        assert f.read() == b"abc"
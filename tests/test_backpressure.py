@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from inferout.backpressure import RequestLimiter
+from inferout.exceptions import QueueFullException
+
+
+def test_runs_up_to_max_concurrency_then_queues():
+    async def run():
+        limiter = RequestLimiter(max_concurrency=2, max_queue_size=1)
+        release = asyncio.Event()
+
+        async def request():
+            async with limiter:
+                await release.wait()
+
+        tasks = [asyncio.ensure_future(request()) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert limiter.in_flight == 2
+        assert limiter.queued == 1
+        release.set()
+        await asyncio.gather(*tasks)
+        assert limiter.in_flight == 0
+        assert limiter.queued == 0
+    asyncio.run(run())
+
+def test_sheds_requests_once_the_queue_is_full():
+    async def run():
+        limiter = RequestLimiter(max_concurrency=1, max_queue_size=1)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFullException):
+            await limiter.acquire()
+        limiter.release()
+        await waiting
+        assert limiter.in_flight == 1
+        assert limiter.queued == 0
+        limiter.release()
+    asyncio.run(run())
+
+def test_no_queue_sheds_as_soon_as_busy():
+    async def run():
+        limiter = RequestLimiter(max_concurrency=1, max_queue_size=0)
+        async with limiter:
+            with pytest.raises(QueueFullException):
+                await limiter.acquire()
+        #free again
+        async with limiter:
+            assert limiter.in_flight == 1
+    asyncio.run(run())
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        limiter = RequestLimiter(max_concurrency=1, max_queue_size=1)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert limiter.queued == 0
+        assert limiter.in_flight == 1
+        limiter.release()
+    asyncio.run(run())
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from inferout.batching import Batcher
+
+
+def make_batcher(max_batch_size, max_wait_time, fail=False):
+    batches = []
+    async def infer_batch(data_list):
+        batches.append(list(data_list))
+        await asyncio.sleep(0)
+        if fail:
+            raise ValueError("model failed")
+        return [x * 10 for x in data_list]
+    batcher = Batcher(infer_batch=infer_batch, max_batch_size=max_batch_size, max_wait_time=max_wait_time)
+    return batcher, batches
+
+
+def test_full_batches_are_dispatched_right_away():
+    async def run():
+        batcher, batches = make_batcher(max_batch_size=3, max_wait_time=60)
+        batcher.start()
+        results = await asyncio.wait_for(asyncio.gather(*[batcher.submit(x) for x in range(6)]), 5)
+        await batcher.stop()
+        assert batches == [[0, 1, 2], [3, 4, 5]]
+        assert results == [0, 10, 20, 30, 40, 50]
+    asyncio.run(run())
+
+def test_partial_batches_are_dispatched_after_max_wait_time():
+    async def run():
+        batcher, batches = make_batcher(max_batch_size=10, max_wait_time=0.05)
+        batcher.start()
+        started_at = asyncio.get_event_loop().time()
+        results = await asyncio.wait_for(asyncio.gather(batcher.submit(1), batcher.submit(2)), 5)
+        waited = asyncio.get_event_loop().time() - started_at
+        await batcher.stop()
+        assert batches == [[1, 2]]
+        assert results == [10, 20]
+        assert 0.04 <= waited < 1
+    asyncio.run(run())
+
+def test_results_go_back_to_their_requests():
+    async def run():
+        async def infer_batch(data_list):
+            #answers out of order with respect to arrival, but in input order
+            await asyncio.sleep(0.01 * len(data_list))
+            return ["out-" + x for x in data_list]
+        batcher = Batcher(infer_batch=infer_batch, max_batch_size=4, max_wait_time=0.01)
+        batcher.start()
+        inputs = ["in-{}".format(x) for x in range(10)]
+        results = await asyncio.wait_for(asyncio.gather(*[batcher.submit(x) for x in inputs]), 5)
+        await batcher.stop()
+        assert results == ["out-" + x for x in inputs]
+    asyncio.run(run())
+
+def test_errors_reach_every_request_of_the_batch():
+    async def run():
+        batcher, batches = make_batcher(max_batch_size=3, max_wait_time=60, fail=True)
+        batcher.start()
+        results = await asyncio.wait_for(asyncio.gather(*[batcher.submit(x) for x in range(3)],
+            return_exceptions=True), 5)
+        assert [type(x) for x in results] == [ValueError] * 3
+        #the batcher keeps going
+        assert len(batches) == 1
+        batcher.infer_batch = make_batcher(max_batch_size=3, max_wait_time=60)[0].infer_batch
+        results = await asyncio.wait_for(asyncio.gather(*[batcher.submit(x) for x in range(3)]), 5)
+        assert results == [0, 10, 20]
+        await batcher.stop()
+    asyncio.run(run())
+
+def test_result_count_mismatch_fails_the_batch():
+    async def run():
+        async def infer_batch(data_list):
+            return data_list[:-1]
+        batcher = Batcher(infer_batch=infer_batch, max_batch_size=2, max_wait_time=60)
+        batcher.start()
+        results = await asyncio.wait_for(asyncio.gather(batcher.submit(1), batcher.submit(2),
+            return_exceptions=True), 5)
+        await batcher.stop()
+        assert [type(x) for x in results] == [ValueError, ValueError]
+    asyncio.run(run())
+
+def test_stop_fails_waiting_requests():
+    async def run():
+        release = asyncio.Event()
+        async def infer_batch(data_list):
+            await release.wait()
+            return data_list
+        batcher = Batcher(infer_batch=infer_batch, max_batch_size=1, max_wait_time=0)
+        batcher.start()
+        in_flight = asyncio.ensure_future(batcher.submit(1))
+        queued = asyncio.ensure_future(batcher.submit(2))
+        await asyncio.sleep(0.01)
+        await batcher.stop()
+        for future in (in_flight, queued):
+            with pytest.raises(RuntimeError):
+                await future
+    asyncio.run(run())
@@ -0,0 +1,111 @@
+import asyncio
+
+from inferout import events
+
+
+def make_reader(cluster, handled, stop_after=None, consumer="w1", start_id="$"):
+    async def handler(event_type, event_data):
+        handled.append((event_type, event_data))
+        if stop_after is not None and len(handled) >= stop_after:
+            reader.shutdown_requested = True
+    reader = events.EventStreamReader(cluster=cluster, stream_name="stream1",
+        group=events.get_consumer_group_name("group1", consumer), consumer=consumer,
+        handler=handler, start_id=start_id)
+    return reader
+
+async def get_pending_count(cluster, reader):
+    return (await cluster.redis.xpending(reader.stream_key, reader.group))["pending"]
+
+
+def test_setup_creates_the_group_once(run_with_cluster):
+    async def run(cluster):
+        reader = make_reader(cluster, [])
+        await reader.setup()
+        await reader.setup()
+        groups = await cluster.redis.xinfo_groups(reader.stream_key)
+        assert [x["name"] for x in groups] == [reader.group]
+    run_with_cluster(run)
+
+def test_events_are_handled_and_acked(run_with_cluster):
+    async def run(cluster):
+        handled = []
+        reader = make_reader(cluster, handled, stop_after=2)
+        await reader.setup()
+        await events.publish_event(cluster, "stream1", "E1", {"n": 1})
+        await events.publish_event(cluster, "stream1", "E2", {"n": 2})
+        await asyncio.wait_for(reader.read_forever(), 5)
+        assert handled == [("E1", {"n": 1}), ("E2", {"n": 2})]
+        assert await get_pending_count(cluster, reader) == 0
+    run_with_cluster(run)
+
+def test_events_before_the_group_existed_are_skipped(run_with_cluster):
+    async def run(cluster):
+        handled = []
+        await events.publish_event(cluster, "stream1", "OLD", {})
+        reader = make_reader(cluster, handled, stop_after=1)
+        await reader.setup()
+        await events.publish_event(cluster, "stream1", "NEW", {})
+        await asyncio.wait_for(reader.read_forever(), 5)
+        assert handled == [("NEW", {})]
+        #unless read from the start
+        handled = []
+        reader = make_reader(cluster, handled, stop_after=2, consumer="w2", start_id="0")
+        await reader.setup()
+        await asyncio.wait_for(reader.read_forever(), 5)
+        assert [x[0] for x in handled] == ["OLD", "NEW"]
+    run_with_cluster(run)
+
+def test_events_read_but_not_acked_are_handled_again(run_with_cluster):
+    async def run(cluster):
+        reader = make_reader(cluster, [])
+        await reader.setup()
+        await events.publish_event(cluster, "stream1", "E1", {"n": 1})
+        #read by a previous run of the same consumer that died before handling it
+        await cluster.redis.xreadgroup(reader.group, reader.consumer, {reader.stream_key: ">"})
+        assert await get_pending_count(cluster, reader) == 1
+        await events.publish_event(cluster, "stream1", "E2", {"n": 2})
+        handled = []
+        reader = make_reader(cluster, handled, stop_after=2)
+        await asyncio.wait_for(reader.read_forever(), 5)
+        assert handled == [("E1", {"n": 1}), ("E2", {"n": 2})]
+        assert await get_pending_count(cluster, reader) == 0
+    run_with_cluster(run)
+
+def test_events_failing_to_be_handled_are_acked(run_with_cluster):
+    async def run(cluster):
+        reader = make_reader(cluster, [])
+        async def handler(event_type, event_data):
+            reader.shutdown_requested = True
+            raise ValueError("bad event")
+        reader.handler = handler
+        await reader.setup()
+        await events.publish_event(cluster, "stream1", "E1", {})
+        await asyncio.wait_for(reader.read_forever(), 5)
+        assert await get_pending_count(cluster, reader) == 0
+    run_with_cluster(run)
+
+def test_missing_groups_are_recreated(run_with_cluster):
+    async def run(cluster):
+        handled = []
+        reader = make_reader(cluster, handled, stop_after=1)
+        await reader.setup()
+        await reader.delete()
+        assert await cluster.redis.xinfo_groups(reader.stream_key) == []
+        read_task = asyncio.ensure_future(reader.read_forever())
+        while not await cluster.redis.xinfo_groups(reader.stream_key):
+            await asyncio.sleep(0.01)
+        await events.publish_event(cluster, "stream1", "E1", {})
+        await asyncio.wait_for(read_task, 5)
+        assert handled == [("E1", {})]
+    run_with_cluster(run)
+
+def test_delete_consumer_groups_of_a_departed_consumer(run_with_cluster):
+    async def run(cluster):
+        for consumer in ("w1", "w2"):
+            await make_reader(cluster, [], consumer=consumer).setup()
+        await events.delete_consumer_groups(cluster, "stream1", "w1")
+        groups = await cluster.redis.xinfo_groups(events.get_stream_key(cluster, "stream1"))
+        assert [x["name"] for x in groups] == [events.get_consumer_group_name("group1", "w2")]
+        #nothing to do without a stream
+        await events.delete_consumer_groups(cluster, "stream2", "w1")
+    run_with_cluster(run)
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+
+from inferout import exceptions
+from inferout.leases import Lease
+from inferout.models import ModelNamespace, Model, ModelVersion, ModelInstance
+
+
+def make_lease(cluster, holder_id, duration=10):
+    return Lease(cluster=cluster, name="shard-0", holder_id=holder_id, duration=duration)
+
+def make_model_instance(cluster):
+    ns = ModelNamespace(cluster=cluster, id="ns1")
+    model = Model(namespace=ns, id="model1")
+    model_instance = ModelInstance(model_version=ModelVersion(model=model, id=1), id="instance1")
+    model_instance.worker_id = "w1"
+    model_instance.state = "scheduled"
+    model_instance.storage_context = {}
+    model_instance.serving_context = {}
+    return model_instance
+
+
+def test_only_one_holder_at_a_time(run_with_cluster):
+    async def run(cluster):
+        first = make_lease(cluster, "w1")
+        second = make_lease(cluster, "w2")
+        assert await first.acquire()
+        assert first.is_held
+        assert not await second.acquire()
+        assert not second.is_held
+        await first.check()
+        with pytest.raises(exceptions.LeaseLostException):
+            await second.check()
+        await first.release()
+        assert not first.is_held
+        assert await second.acquire()
+    run_with_cluster(run)
+
+def test_fencing_tokens_increase(run_with_cluster):
+    async def run(cluster):
+        first = make_lease(cluster, "w1")
+        second = make_lease(cluster, "w2")
+        assert await first.acquire()
+        first_token = first.token
+        await first.release()
+        assert await second.acquire()
+        assert second.token > first_token
+        await second.release()
+        assert await first.acquire()
+        assert first.token > second.token
+    run_with_cluster(run)
+
+def test_renewed_leases_outlive_their_duration(run_with_cluster):
+    async def run(cluster):
+        lease = make_lease(cluster, "w1", duration=0.3)
+        assert await lease.acquire()
+        for _ in range(4):
+            await asyncio.sleep(0.1)
+            assert await lease.renew()
+        await lease.check()
+    run_with_cluster(run)
+
+def test_expired_leases_are_lost(run_with_cluster):
+    async def run(cluster):
+        first = make_lease(cluster, "w1", duration=0.1)
+        second = make_lease(cluster, "w2")
+        assert await first.acquire()
+        await asyncio.sleep(0.2)
+        assert await second.acquire()
+        #the former holder finds out on renewal
+        assert not await first.renew()
+        assert not first.is_held
+        with pytest.raises(exceptions.LeaseLostException):
+            await first.check()
+        #releasing a lost lease leaves the new holder alone
+        await first.release()
+        await second.check()
+    run_with_cluster(run)
+
+def test_keep_alive_renews_until_released(run_with_cluster):
+    async def run(cluster):
+        lease = make_lease(cluster, "w1", duration=0.3)
+        assert await lease.acquire()
+        keep_alive_task = asyncio.ensure_future(lease.keep_alive())
+        await asyncio.sleep(0.6)
+        await lease.check()
+        await lease.release()
+        await asyncio.wait_for(keep_alive_task, 1)
+    run_with_cluster(run)
+
+def test_fenced_writes_fail_once_the_lease_is_lost(run_with_cluster):
+    async def run(cluster):
+        stale = make_lease(cluster, "w1", duration=0.1)
+        assert await stale.acquire()
+        await asyncio.sleep(0.2)
+        assert await make_lease(cluster, "w2").acquire()
+        model_instance = make_model_instance(cluster)
+        #the former holder hasn't noticed it lost the lease
+        assert stale.is_held
+        with pytest.raises(exceptions.LeaseLostException):
+            await model_instance.save_to_redis(fence=stale)
+        assert not await cluster.redis.exists(model_instance.redis_key)
+    run_with_cluster(run)
+
+def test_fenced_writes_fail_when_the_lease_changes_hands_meanwhile(run_with_cluster):
+    async def run(cluster):
+        lease = make_lease(cluster, "w1")
+        assert await lease.acquire()
+        fence = lease.fence
+        async def fence_then_lose(pipe):
+            await fence(pipe)
+            #taken over between the check and the write
+            await cluster.redis.delete(lease.redis_key)
+            assert await make_lease(cluster, "w2").acquire()
+        lease.fence = fence_then_lose
+        model_instance = make_model_instance(cluster)
+        with pytest.raises(exceptions.LeaseLostException):
+            await model_instance.save_to_redis(fence=lease)
+        assert not await cluster.redis.exists(model_instance.redis_key)
+    run_with_cluster(run)
+
+def test_fenced_writes_go_through_while_held(run_with_cluster):
+    async def run(cluster):
+        lease = make_lease(cluster, "w1")
+        assert await lease.acquire()
+        model_instance = make_model_instance(cluster)
+        assert await model_instance.save_to_redis(fence=lease)
+        assert await cluster.redis.hget(model_instance.redis_key, "state") == "scheduled"
+    run_with_cluster(run)
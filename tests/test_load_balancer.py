@@ -0,0 +1,89 @@
+import types
+
+import pytest
+
+from inferout.load_balancer import LoadBalancer
+
+
+class FakeRoutingTable(object):
+    def __init__(self, workers):
+        self.workers = workers
+
+    def get_worker_data(self, worker_id):
+        return self.workers.get(worker_id)
+
+
+def make_load_balancer(policy, workers, rack="", rack_overload_threshold=32):
+    worker = types.SimpleNamespace(id="self", rack=rack, routing_table=FakeRoutingTable(workers))
+    return LoadBalancer(worker=worker, policy=policy, rack_overload_threshold=rack_overload_threshold)
+
+def make_workers(loads, rack=""):
+    return {worker_id: {"id": worker_id, "rack": rack, "in_flight": load, "queue_depth": 0}
+        for worker_id, load in loads.items()}
+
+def make_instances(worker_ids):
+    return [{"id": "i-" + x, "worker_id": x} for x in worker_ids]
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        make_load_balancer("round_robin", {})
+
+def test_least_outstanding_orders_by_load():
+    workers = make_workers({"a": 5, "b": 0, "c": 2})
+    load_balancer = make_load_balancer("least_outstanding", workers)
+    ordered = load_balancer.order(make_instances(["a", "b", "c"]))
+    assert [x["worker_id"] for x in ordered] == ["b", "c", "a"]
+
+def test_power_of_two_choices_picks_the_lighter_of_two():
+    workers = make_workers({"a": 5, "b": 0, "c": 2})
+    load_balancer = make_load_balancer("power_of_two_choices", workers)
+    for _ in range(50):
+        ordered = [x["worker_id"] for x in load_balancer.order(make_instances(["a", "b", "c"]))]
+        #the most loaded replica never wins a pair, the others follow by load
+        assert ordered[0] != "a"
+        assert sorted(ordered) == ["a", "b", "c"]
+        assert ordered[1:] == [x for x in ["b", "c", "a"] if x != ordered[0]]
+
+def test_random_keeps_every_replica():
+    workers = make_workers({"a": 5, "b": 0})
+    load_balancer = make_load_balancer("random", workers)
+    ordered = load_balancer.order(make_instances(["a", "b"]))
+    assert sorted(x["worker_id"] for x in ordered) == ["a", "b"]
+
+def test_outstanding_requests_add_to_load():
+    workers = make_workers({"a": 0, "b": 1})
+    load_balancer = make_load_balancer("least_outstanding", workers)
+    load_balancer.begin("a")
+    load_balancer.begin("a")
+    assert load_balancer.get_load("a") == 2
+    assert [x["worker_id"] for x in load_balancer.order(make_instances(["a", "b"]))] == ["b", "a"]
+    load_balancer.end("a")
+    load_balancer.end("a")
+    assert "a" not in load_balancer.outstanding
+
+def test_reported_load_overrides_worker_data():
+    workers = make_workers({"a": 0, "b": 1})
+    load_balancer = make_load_balancer("least_outstanding", workers)
+    load_balancer.begin("a")
+    load_balancer.end("a", reported_load=10)
+    assert load_balancer.get_load("a") == 10
+    assert [x["worker_id"] for x in load_balancer.order(make_instances(["a", "b"]))] == ["b", "a"]
+
+def test_same_rack_replicas_go_first():
+    workers = dict(make_workers({"a": 0, "b": 0}, rack="r1"), **make_workers({"c": 3, "d": 0}, rack="r2"))
+    load_balancer = make_load_balancer("least_outstanding", workers, rack="r2")
+    ordered = load_balancer.order(make_instances(["a", "b", "c", "d"]))
+    assert [x["worker_id"] for x in ordered][:2] == ["d", "c"]
+
+def test_overloaded_same_rack_replicas_are_skipped():
+    workers = dict(make_workers({"a": 0}, rack="r1"), **make_workers({"c": 40}, rack="r2"))
+    load_balancer = make_load_balancer("least_outstanding", workers, rack="r2", rack_overload_threshold=32)
+    ordered = load_balancer.order(make_instances(["a", "c"]))
+    assert [x["worker_id"] for x in ordered] == ["a", "c"]
+
+def test_unknown_workers_are_not_same_rack():
+    workers = make_workers({"a": 0}, rack="r1")
+    load_balancer = make_load_balancer("least_outstanding", workers, rack="r2")
+    ordered = load_balancer.order(make_instances(["a", "x"]))
+    assert sorted(x["worker_id"] for x in ordered) == ["a", "x"]
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from inferout.exceptions import ServingProcessError
+from inferout.process_pool import ServingProcessPool
+from inferout.serving_engines import base
+
+
+class ServingEngine(base.ServingEngine):
+    """Takes model_parameters["load_time"] seconds to load nothing, answers with the pid of its process."""
+    def __init__(self) -> None:
+        pass
+
+    def load_model(self, model_parameters: dict, storage_context: dict):
+        time.sleep(model_parameters.get("load_time", 0))
+        return ({"loaded": True}, {})
+
+    def unload_model(self, model_parameters: dict, storage_context: dict, serving_context: dict, worker_serving_context: dict):
+        pass
+
+    def infer(self, model_parameters: dict, storage_context: dict, serving_context: dict, worker_serving_context: dict, data: dict) -> dict:
+        if data.get("exit"):
+            os._exit(1)
+        return {"pid": os.getpid()}
+
+
+def run_with_pool(test, size):
+    async def run():
+        pool = ServingProcessPool(serving_engines={__name__: ServingEngine()}, size=size)
+        pool.start()
+        try:
+            await test(pool)
+        finally:
+            pool.shutdown()
+    asyncio.run(run())
+
+async def load_model(pool, key, load_time=0):
+    return await pool.load_model(key=key, serving_engine=__name__,
+        model_parameters={"load_time": load_time}, storage_context={})
+
+async def get_pid(pool, key):
+    return (await pool.infer(key=key, data={}))["pid"]
+
+
+def test_models_go_to_the_least_loaded_process():
+    async def test(pool):
+        serving_context, footprint = await load_model(pool, "a")
+        assert serving_context == {"loaded": True}
+        assert set(footprint) == {"memory_bytes", "load_time"}
+        await load_model(pool, "b")
+        pid_a, pid_b = await get_pid(pool, "a"), await get_pid(pool, "b")
+        assert pid_a != pid_b
+        assert os.getpid() not in (pid_a, pid_b)
+        await pool.unload_model(key="a")
+        await load_model(pool, "c")
+        assert await get_pid(pool, "c") == pid_a
+        with pytest.raises(KeyError):
+            await pool.infer(key="a", data={})
+    run_with_pool(test, size=2)
+
+def test_crashed_processes_are_restarted_with_their_models():
+    async def test(pool):
+        await load_model(pool, "a")
+        await load_model(pool, "b")
+        pid = await get_pid(pool, "a")
+        with pytest.raises(ServingProcessError):
+            await pool.infer(key="a", data={"exit": True})
+        #both models are loaded again in the new process
+        assert await get_pid(pool, "a") != pid
+        assert await get_pid(pool, "b") == await get_pid(pool, "a")
+    run_with_pool(test, size=1)
+
+def test_inference_is_served_while_a_model_loads():
+    async def test(pool):
+        await load_model(pool, "a")
+        slow_load = asyncio.ensure_future(load_model(pool, "b", load_time=3))
+        await asyncio.sleep(0.2)
+        started_at = time.monotonic()
+        await get_pid(pool, "a")
+        assert time.monotonic() - started_at < 1
+        assert not slow_load.done()
+        await slow_load
+        await get_pid(pool, "b")
+    run_with_pool(test, size=1)
+
+def test_failed_loads_are_reported():
+    async def test(pool):
+        with pytest.raises(ServingProcessError):
+            await pool.load_model(key="a", serving_engine="missing", model_parameters={}, storage_context={})
+        assert pool.assigned_processes == {}
+        await load_model(pool, "a")
+        await get_pid(pool, "a")
+    run_with_pool(test, size=1)
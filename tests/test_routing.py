@@ -0,0 +1,69 @@
+import asyncio
+
+from inferout import routing
+from inferout.cluster import Cluster
+from inferout.routing import RoutingTable
+
+
+class FakeWorker(object):
+    """Hands out the workers data read by a sync, letting events come in meanwhile."""
+    def __init__(self, workers_data, during_read=None):
+        self.id = "self"
+        self.workers_data = workers_data
+        self.during_read = during_read
+
+    async def get_all_workers_data(self):
+        if self.during_read is not None:
+            await self.during_read()
+        return self.workers_data
+
+    async def get_remote_worker_data(self, worker_id):
+        raise KeyError(worker_id)
+
+
+def fake_redis_reads(monkeypatch, instance_state):
+    async def get_namespaces(cluster):
+        return [{"id": "ns1", "settings": {}}]
+    async def get_models(cluster, ns):
+        return [{"id": "m1", "latest_version_id": 1}]
+    async def get_model_instances(cluster, model):
+        return [{"id": "i1", "model_version_id": "1", "worker_id": "w1", "state": instance_state}]
+    monkeypatch.setattr(routing.ModelNamespace, "get_all_as_list", get_namespaces)
+    monkeypatch.setattr(routing.Model, "get_all_as_list", get_models)
+    monkeypatch.setattr(routing.ModelInstance, "get_all_as_list", get_model_instances)
+
+def make_worker_data(worker_id, state="serving"):
+    return {"id": worker_id, "state": state, "serving_endpoint": "http://" + worker_id}
+
+
+def test_sync_reads_redis(monkeypatch):
+    fake_redis_reads(monkeypatch, "serving")
+    async def run():
+        cluster = Cluster(redis=None, redis_key_prefix="test", name="test")
+        routing_table = RoutingTable(cluster=cluster, worker=FakeWorker([make_worker_data("w1"),
+            make_worker_data("w2", state="terminating")]))
+        await routing_table.sync_once()
+        assert [x["id"] for x in routing_table.get_model_instances("ns1", "m1")] == ["i1"]
+        assert set(routing_table.workers) == {"w1"}
+        assert routing_table.sync_buffered_events is None
+    asyncio.run(run())
+
+def test_events_handled_during_sync_are_kept(monkeypatch):
+    #redis is read before the instance went serving and the worker left
+    fake_redis_reads(monkeypatch, "loading")
+    async def run():
+        cluster = Cluster(redis=None, redis_key_prefix="test", name="test")
+        worker = FakeWorker([make_worker_data("w1"), make_worker_data("w2")])
+        routing_table = RoutingTable(cluster=cluster, worker=worker)
+        async def during_read():
+            await routing_table.handle_event("MODEL_INSTANCE_UPDATE", {"namespace_id": "ns1", "model_id": "m1",
+                "model_instance_id": "i1", "model_version_id": 1, "worker_id": "w1", "state": "serving"})
+            await routing_table.handle_event("WORKER_UPDATE", {"worker_id": "w2", "state": "terminating"})
+            await routing_table.handle_event("WORKER_UPDATE", {"worker_id": "w3", "state": "serving",
+                "worker_data": make_worker_data("w3")})
+        worker.during_read = during_read
+        await routing_table.sync_once()
+        assert [x["id"] for x in routing_table.get_model_instances("ns1", "m1")] == ["i1"]
+        assert set(routing_table.workers) == {"w1", "w3"}
+        assert routing_table.sync_buffered_events is None
+    asyncio.run(run())
@@ -0,0 +1,315 @@
+import asyncio
+import json
+import types
+
+from inferout import events
+from inferout import utils
+from inferout.cluster import Cluster
+from inferout.models import NAMESPACE_DEFAULT_SETTINGS, ModelNamespace, Model, ModelVersion, ModelInstance
+from inferout.scheduler import Scheduler
+from inferout.worker import WORKER_KEY
+
+
+def make_worker_data(worker_id, rack="", model_instances_count=0, state="serving", **kwargs):
+    return dict({
+        "id": worker_id,
+        "state": state,
+        "rack": rack,
+        "available_storage_engines": ["local_files"],
+        "available_serving_engines": ["echo"],
+        "model_instances_count": model_instances_count
+        }, **kwargs)
+
+def make_model_version(settings):
+    cluster = Cluster(redis=None, redis_key_prefix="test", name="test")
+    ns = ModelNamespace(cluster=cluster, id="ns1")
+    ns.settings = settings
+    model = Model(namespace=ns, id="model1")
+    return ModelVersion(model=model, id=1)
+
+def make_instances(worker_ids):
+    return [types.SimpleNamespace(worker_id=x) for x in worker_ids]
+
+def select_worker(workers, settings, worker_ids, footprint=None, pending_memory=None):
+    async def run():
+        model_version = make_model_version(settings)
+        model_version.footprint = footprint
+        scheduler = Scheduler(cluster=model_version.cluster, worker=types.SimpleNamespace(id="self"))
+        scheduler.active_workers_map = {x["id"]: x for x in workers}
+        scheduler.pending_memory.update(pending_memory or {})
+        return await scheduler.select_worker(model_version=model_version, model_instances=make_instances(worker_ids))
+    return asyncio.run(run())
+
+
+def test_least_loaded_serving_worker_wins():
+    workers = [
+        make_worker_data("a", model_instances_count=3),
+        make_worker_data("b", model_instances_count=1),
+        make_worker_data("c", model_instances_count=0, state="draining")]
+    assert select_worker(workers, {}, []) == "b"
+
+def test_engines_have_to_be_available():
+    workers = [make_worker_data("a"), make_worker_data("b", available_serving_engines=[])]
+    assert select_worker(workers, {"serving_engine": "echo"}, []) == "a"
+    assert select_worker(workers, {"serving_engine": "torch"}, []) is None
+
+def test_preferred_worker_anti_affinity_spreads_replicas():
+    workers = [make_worker_data("a"), make_worker_data("b", model_instances_count=5)]
+    settings = {"placement": {"worker_anti_affinity": "preferred"}}
+    assert select_worker(workers, settings, ["a"]) == "b"
+    #falls back to a worker already hosting a replica
+    assert select_worker(workers, settings, ["a", "b"]) == "a"
+
+def test_required_worker_anti_affinity():
+    workers = [make_worker_data("a"), make_worker_data("b")]
+    settings = {"placement": {"worker_anti_affinity": "required"}}
+    assert select_worker(workers, settings, ["a"]) == "b"
+    assert select_worker(workers, settings, ["a", "b"]) is None
+
+def test_preferred_rack_spread():
+    workers = [make_worker_data("a", rack="r1"), make_worker_data("b", rack="r1"),
+        make_worker_data("c", rack="r2", model_instances_count=5)]
+    settings = {"placement": {"rack_spread": "preferred"}}
+    assert select_worker(workers, settings, ["a"]) == "c"
+
+def test_required_rack_spread_keeps_skew():
+    workers = [make_worker_data("a", rack="r1"), make_worker_data("b", rack="r2")]
+    settings = {"placement": {"rack_spread": "required", "max_rack_skew": 1}}
+    assert select_worker(workers, settings, ["a"]) == "b"
+    workers = [make_worker_data("a", rack="r1"), make_worker_data("b", rack="r2"),
+        make_worker_data("c", rack="r3", model_instances_count=5)]
+    assert select_worker(workers, settings, ["a", "b"]) == "c"
+    workers = [make_worker_data("a", rack="r1"), make_worker_data("b", rack="r2", state="draining")]
+    #r2 has no serving worker, so r1 is the least used rack left
+    assert select_worker(workers, settings, ["a"]) == "a"
+
+GB = 1024**3
+
+def make_capacity(total, available):
+    return {"memory_total": total*GB, "memory_available": available*GB}
+
+def test_best_fit_worker_wins():
+    workers = [
+        make_worker_data("a", capacity=make_capacity(16, 12), memory_reserved=4*GB),
+        make_worker_data("b", capacity=make_capacity(16, 4), memory_reserved=12*GB),
+        make_worker_data("c", capacity=make_capacity(16, 1), memory_reserved=15*GB)]
+    assert select_worker(workers, {}, [], footprint={"memory_bytes": 3*GB}) == "b"
+
+def test_workers_the_instance_does_not_fit_are_skipped():
+    workers = [make_worker_data("a", capacity=make_capacity(16, 2), memory_reserved=14*GB)]
+    assert select_worker(workers, {}, [], footprint={"memory_bytes": 3*GB}) is None
+    #workers not reporting capacity always fit
+    workers.append(make_worker_data("b"))
+    assert select_worker(workers, {}, [], footprint={"memory_bytes": 3*GB}) == "b"
+
+def test_default_memory_bytes_without_footprint():
+    workers = [make_worker_data("a", capacity=make_capacity(16, 2), memory_reserved=14*GB)]
+    settings = {"resources": {"default_memory_bytes": 3*GB}}
+    assert select_worker(workers, settings, []) is None
+    assert select_worker(workers, {}, []) == "a"
+
+def test_memory_scheduled_this_cycle_is_reserved():
+    workers = [make_worker_data("a", capacity=make_capacity(16, 16))]
+    footprint = {"memory_bytes": 4*GB}
+    assert select_worker(workers, {}, [], footprint=footprint, pending_memory={"a": 10*GB}) == "a"
+    assert select_worker(workers, {}, [], footprint=footprint, pending_memory={"a": 14*GB}) is None
+
+def test_headroom_and_overcommit():
+    workers = [make_worker_data("a", capacity=make_capacity(16, 4), memory_reserved=12*GB)]
+    footprint = {"memory_bytes": 3*GB}
+    assert select_worker(workers, {"resources": {"memory_headroom_ratio": 0.125}}, [], footprint=footprint) is None
+    #overcommitted reservations may exceed what is actually available
+    workers = [make_worker_data("a", capacity=make_capacity(16, 1), memory_reserved=15*GB)]
+    assert select_worker(workers, {}, [], footprint=footprint) is None
+    assert select_worker(workers, {"resources": {"memory_overcommit_ratio": 1.5}}, [], footprint=footprint) == "a"
+
+
+async def setup_model(cluster, settings, versions):
+    ns = ModelNamespace(cluster=cluster, id="ns1")
+    ns.settings = settings
+    await ns.save()
+    model = Model(namespace=ns, id="model1")
+    for _ in range(versions):
+        await model.save()
+    return ns
+
+async def add_model_instance(ns, version_id, worker_id, state):
+    model = Model(namespace=ns, id="model1")
+    model_instance = ModelInstance(model_version=ModelVersion(model=model, id=version_id),
+        id=utils.get_uuid_as_string())
+    model_instance.worker_id = worker_id
+    model_instance.state = state
+    await model_instance.save()
+    return model_instance
+
+async def make_leading_scheduler(cluster, workers):
+    scheduler = Scheduler(cluster=cluster, worker=types.SimpleNamespace(id="self"))
+    scheduler.active_workers_map = {x["id"]: x for x in workers}
+    assert await scheduler.leases[0].acquire()
+    return scheduler
+
+async def schedule(scheduler):
+    """One reconcile of the model, returns its instances as left in redis."""
+    [(model, model_instances)] = await scheduler.load_models([("ns1", "model1")])
+    await scheduler.schedule_model(model, model_instances, max_instances_to_schedule=10)
+    [(model, model_instances)] = await scheduler.load_models([("ns1", "model1")])
+    return model_instances
+
+async def set_serving(model_instances, version_id):
+    for each in model_instances:
+        if each.model_version_id == version_id and each.state == "scheduled":
+            each.state = "serving"
+            await each.save()
+
+def count(model_instances, version_id, *states):
+    return len([x for x in model_instances if x.model_version_id == version_id and x.state in states])
+
+async def get_terminate_events(cluster, worker_id):
+    stream_key = events.get_stream_key(cluster, WORKER_KEY.format(worker_id))
+    return [json.loads(x[1]["event_data"])["model_instance_id"] for x in await cluster.redis.xrange(stream_key)
+        if x[1]["event_type"] == "TERMINATE_MODEL_INSTANCE"]
+
+ROLLOUT_WORKERS = [make_worker_data(x,
+    available_storage_engines=[NAMESPACE_DEFAULT_SETTINGS["storage_engine"]],
+    available_serving_engines=[NAMESPACE_DEFAULT_SETTINGS["serving_engine"]]) for x in ("w1", "w2", "w3", "w4")]
+
+
+def test_rollout_surges_without_going_below_target(run_with_cluster):
+    async def run(cluster):
+        ns = await setup_model(cluster, {"instances_per_model": {"target": 2},
+            "rollout": {"max_surge": 1, "max_unavailable": 0}}, versions=2)
+        for worker_id in ("w1", "w2"):
+            await add_model_instance(ns, 1, worker_id, "serving")
+        scheduler = await make_leading_scheduler(cluster, ROLLOUT_WORKERS)
+
+        model_instances = await schedule(scheduler)
+        assert count(model_instances, 2, "scheduled") == 1
+        assert count(model_instances, 1, "serving") == 2
+        #nothing else happens until the new instance serves
+        model_instances = await schedule(scheduler)
+        assert count(model_instances, 2, "scheduled") == 1
+        assert count(model_instances, 1, "serving") == 2
+
+        await set_serving(model_instances, 2)
+        model_instances = await schedule(scheduler)
+        assert count(model_instances, 2, "serving", "scheduled") == 2
+        assert count(model_instances, 1, "serving") == 1
+        assert count(model_instances, 1, "draining") == 1
+
+        await set_serving(model_instances, 2)
+        model_instances = await schedule(scheduler)
+        assert count(model_instances, 2, "serving") == 2
+        assert count(model_instances, 1, "serving") == 0
+        drained = [x.id for x in model_instances if x.model_version_id == 1]
+        assert sorted((await get_terminate_events(cluster, "w1")) + (await get_terminate_events(cluster, "w2"))) == sorted(drained)
+    run_with_cluster(run)
+
+def test_rollout_with_max_unavailable_replaces_in_place(run_with_cluster):
+    async def run(cluster):
+        ns = await setup_model(cluster, {"instances_per_model": {"target": 2},
+            "rollout": {"max_surge": 0, "max_unavailable": 1}}, versions=2)
+        for worker_id in ("w1", "w2"):
+            await add_model_instance(ns, 1, worker_id, "serving")
+        scheduler = await make_leading_scheduler(cluster, ROLLOUT_WORKERS)
+
+        model_instances = await schedule(scheduler)
+        assert count(model_instances, 1, "serving") == 1
+        assert count(model_instances, 1, "draining") == 1
+        #no surge, the new instance takes the place of the drained one
+        assert count(model_instances, 2, "scheduled") == 1
+
+        await set_serving(model_instances, 2)
+        model_instances = await schedule(scheduler)
+        assert count(model_instances, 1, "serving") == 0
+        assert count(model_instances, 2, "serving", "scheduled") == 2
+    run_with_cluster(run)
+
+def test_instances_not_serving_yet_are_terminated_right_away(run_with_cluster):
+    async def run(cluster):
+        ns = await setup_model(cluster, {"instances_per_model": {"target": 1}}, versions=1)
+        loading = await add_model_instance(ns, 1, "w1", "loading")
+        serving = await add_model_instance(ns, 1, "w2", "serving")
+        scheduler = await make_leading_scheduler(cluster, ROLLOUT_WORKERS)
+        lease = scheduler.leases[0]
+
+        await scheduler.drain_model_instance(loading, lease)
+        assert loading.state == "terminating"
+        await scheduler.drain_model_instance(serving, lease)
+        assert serving.state == "draining"
+        assert await get_terminate_events(cluster, "w1") == [loading.id]
+        assert await get_terminate_events(cluster, "w2") == [serving.id]
+
+        #draining instances aren't replicas anymore, a replacement is placed
+        model_instances = await schedule(scheduler)
+        assert count(model_instances, 1, "scheduled") == 1
+        assert count(model_instances, 1, "draining") == 1
+    run_with_cluster(run)
+
+def test_terminated_instances_are_not_brought_back(run_with_cluster):
+    async def run(cluster):
+        ns = await setup_model(cluster, {"instances_per_model": {"target": 1}}, versions=1)
+        model_instance = await add_model_instance(ns, 1, "w1", "serving")
+        scheduler = await make_leading_scheduler(cluster, ROLLOUT_WORKERS)
+        stale = ModelInstance(model_version=model_instance.model_version, id=model_instance.id)
+        await stale.read()
+        #its worker finished draining it meanwhile
+        model_instance.state = "terminating"
+        await model_instance.save()
+        await scheduler.drain_model_instance(stale, scheduler.leases[0])
+        assert stale.state == "terminating"
+        assert await cluster.redis.hget(model_instance.redis_key, "state") == "terminating"
+    run_with_cluster(run)
+
+def test_instances_on_draining_workers_are_replaced_before_they_are_drained(run_with_cluster):
+    async def run(cluster):
+        ns = await setup_model(cluster, {"instances_per_model": {"target": 2}}, versions=1)
+        handed_off = await add_model_instance(ns, 1, "w1", "serving")
+        await add_model_instance(ns, 1, "w2", "serving")
+        workers = [dict(x, state="draining") if x["id"] == "w1" else x for x in ROLLOUT_WORKERS]
+        scheduler = await make_leading_scheduler(cluster, workers)
+
+        model_instances = await schedule(scheduler)
+        replacements = [x for x in model_instances if x.state == "scheduled"]
+        assert len(replacements) == 1
+        assert replacements[0].worker_id not in ("w1", "w2")
+        assert count(model_instances, 1, "serving") == 2
+        assert await get_terminate_events(cluster, "w1") == []
+
+        await set_serving(model_instances, 1)
+        model_instances = await schedule(scheduler)
+        assert [x.state for x in model_instances if x.id == handed_off.id] == ["draining"]
+        assert await get_terminate_events(cluster, "w1") == [handed_off.id]
+        assert count(model_instances, 1, "serving") == 2
+    run_with_cluster(run)
+
+def test_draining_replicas_do_not_keep_workers_from_new_ones(run_with_cluster):
+    async def run(cluster):
+        ns = await setup_model(cluster, {"instances_per_model": {"target": 2},
+            "placement": {"worker_anti_affinity": "required"}}, versions=1)
+        await add_model_instance(ns, 1, "w1", "draining")
+        await add_model_instance(ns, 1, "w2", "serving")
+        scheduler = await make_leading_scheduler(cluster, ROLLOUT_WORKERS[:2])
+
+        model_instances = await schedule(scheduler)
+        assert [x.worker_id for x in model_instances if x.state == "scheduled"] == ["w1"]
+    run_with_cluster(run)
+
+def test_standbys_read_workers_only_once(run_with_cluster):
+    async def run(cluster):
+        refreshes = []
+        async def get_all_workers_data():
+            refreshes.append(1)
+            return [make_worker_data("w1")]
+        worker = types.SimpleNamespace(id="self", get_all_workers_data=get_all_workers_data)
+        scheduler = Scheduler(cluster=cluster, worker=worker)
+        checks = []
+        async def acquire_free_shards():
+            checks.append(1)
+            scheduler.shutdown_requested = len(checks) == 3
+            scheduler.shard_released_event.set()
+        scheduler.acquire_free_shards = acquire_free_shards
+        await scheduler.schedule_forever()
+        assert len(checks) == 3
+        assert len(refreshes) == 1
+        assert list(scheduler.active_workers_map) == ["w1"]
+    run_with_cluster(run)
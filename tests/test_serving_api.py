@@ -0,0 +1,101 @@
+import asyncio
+import types
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from inferout import serving_api
+from inferout.cluster import Cluster
+from inferout.serving_api import route_to_remote_workers
+
+
+def make_replica_app(status, calls):
+    async def handle(request):
+        calls.append(request.match_info["replica"])
+        if status == 200:
+            return web.json_response({"output_data": request.match_info["replica"]})
+        return web.Response(status=status, text="failed",
+            headers={"Retry-After": "5"} if status == 429 else None)
+    app = web.Application()
+    app.add_routes([web.post('/{replica}/ns1/model1', handle)])
+    return app
+
+def route(statuses):
+    """Routes a request over replicas answering with statuses, returns the response and the replicas tried."""
+    async def run():
+        calls = []
+        servers = [TestServer(make_replica_app(x, calls)) for x in statuses]
+        for server in servers:
+            await server.start_server()
+        instances_data = [{"worker_id": str(x)} for x in range(len(statuses))]
+        async def fetch_worker_data(worker_id):
+            return {"id": worker_id, "serving_endpoint": str(servers[int(worker_id)].make_url("/" + worker_id))}
+        request = types.SimpleNamespace(path_qs="/ns1/model1")
+        async def read():
+            return b"{}"
+        request.read = read
+        try:
+            async with aiohttp.ClientSession() as http_session:
+                worker = types.SimpleNamespace(id="self",
+                    http_session=http_session,
+                    routing_table=types.SimpleNamespace(fetch_worker_data=fetch_worker_data),
+                    load_balancer=types.SimpleNamespace(order=list,
+                        begin=lambda worker_id: None,
+                        end=lambda worker_id, reported_load: None))
+                response = await route_to_remote_workers(request, worker, instances_data)
+        finally:
+            for server in servers:
+                await server.close()
+        return response, calls
+    return asyncio.run(run())
+
+
+def test_first_replica_answering_wins():
+    response, calls = route([200, 200])
+    assert response.status == 200
+    assert calls == ["0"]
+
+def test_failing_replicas_are_skipped():
+    for status in (429, 502, 503, 504):
+        response, calls = route([status, 200])
+        assert response.status == 200
+        assert calls == ["0", "1"]
+
+def test_last_failure_is_returned_when_every_replica_fails():
+    response, calls = route([503, 429])
+    assert calls == ["0", "1"]
+    assert response.status == 429
+    assert response.headers["Retry-After"] == "5"
+    response, calls = route([429, 502])
+    assert response.status == 502
+    assert "Retry-After" not in response.headers
+
+def test_other_errors_are_returned_right_away():
+    response, calls = route([500, 200])
+    assert response.status == 500
+    assert calls == ["0"]
+
+def test_local_inference_response():
+    async def run():
+        async def do_infer(model_instance, data):
+            return {"echo": data}
+        worker = types.SimpleNamespace(id="self",
+            cluster=Cluster(redis=None, redis_key_prefix="test", name="test"),
+            get_load=lambda: 0,
+            do_infer=do_infer,
+            routing_table=types.SimpleNamespace(
+                get_namespace_settings=lambda namespace_id: {},
+                get_model_instances=lambda namespace_id, model_id, version_id: [
+                    {"id": "i1", "model_version_id": 2, "worker_id": "self", "state": "serving"}]))
+        serving_api.context_worker.set(worker)
+        async with TestClient(TestServer(serving_api.app)) as client:
+            response = await client.post("/ns1/model1/2", json={"input_data": {"x": 1}})
+            assert response.status == 200
+            assert await response.json() == {
+                "model_version": "2",
+                "worker_id": "self",
+                "input_data": {"x": 1},
+                "output_data": {"echo": {"x": 1}}
+                }
+    asyncio.run(run())
@@ -0,0 +1,113 @@
+import asyncio
+import time
+import types
+
+from inferout.cluster import Cluster
+from inferout.worker import Worker
+
+
+def make_worker(shutdown_drain_timeout):
+    cluster = Cluster(redis=None, redis_key_prefix="test", name="test")
+    worker = Worker(cluster=cluster, options=types.SimpleNamespace(shutdown_drain_timeout=shutdown_drain_timeout))
+    worker.reported_states = []
+    worker.drained = []
+    worker.deactivated = []
+    async def report_once(send_events=False):
+        worker.reported_states.append(worker.state)
+    async def drain_model_instance(model_instance):
+        worker.drained.append(model_instance.redis_key)
+    async def deactivate_model_instance(model_instance):
+        worker.deactivated.append(model_instance.redis_key)
+        worker.local_model_instances.pop(model_instance.redis_key)
+    worker.report_once = report_once
+    worker.drain_model_instance = drain_model_instance
+    worker.deactivate_model_instance = deactivate_model_instance
+    return worker
+
+def make_reporting_worker(cluster, serving_endpoint):
+    worker = Worker(cluster=cluster, options=types.SimpleNamespace(resources_disk_path="/"))
+    worker.state = "serving"
+    worker.serving_endpoint = serving_endpoint
+    return worker
+
+def add_local_model_instance(worker, redis_key, on_demand=False):
+    namespace = types.SimpleNamespace(settings={"on_demand": {"enabled": on_demand}})
+    model_instance = types.SimpleNamespace(redis_key=redis_key,
+        model=types.SimpleNamespace(namespace=namespace))
+    worker.local_model_instances[redis_key] = model_instance
+    return model_instance
+
+
+def test_hand_off_waits_for_instances_to_be_replaced():
+    async def run():
+        worker = make_worker(shutdown_drain_timeout=10)
+        add_local_model_instance(worker, "i1")
+        add_local_model_instance(worker, "i2")
+        hand_off_task = asyncio.ensure_future(worker.hand_off_model_instances())
+        await asyncio.sleep(0.1)
+        #schedulers are told, instances keep serving until their replacements do
+        assert worker.reported_states == ["draining"]
+        assert not hand_off_task.done()
+        assert worker.drained == []
+        #terminated by schedulers one by one as replacements serve
+        await worker.deactivate_model_instance(worker.local_model_instances["i1"])
+        await asyncio.sleep(0.6)
+        assert not hand_off_task.done()
+        await worker.deactivate_model_instance(worker.local_model_instances["i2"])
+        await asyncio.wait_for(hand_off_task, 2)
+        assert worker.drained == []
+    asyncio.run(run())
+
+def test_instances_left_after_the_timeout_are_drained():
+    async def run():
+        worker = make_worker(shutdown_drain_timeout=0.2)
+        add_local_model_instance(worker, "i1")
+        await asyncio.wait_for(worker.hand_off_model_instances(), 2)
+        assert worker.drained == ["i1"]
+    asyncio.run(run())
+
+def test_on_demand_instances_are_not_handed_off():
+    async def run():
+        worker = make_worker(shutdown_drain_timeout=10)
+        add_local_model_instance(worker, "i1", on_demand=True)
+        await asyncio.wait_for(worker.hand_off_model_instances(), 2)
+        assert worker.deactivated == ["i1"]
+        assert worker.drained == []
+    asyncio.run(run())
+
+def test_no_hand_off_without_drain_timeout():
+    async def run():
+        worker = make_worker(shutdown_drain_timeout=0)
+        add_local_model_instance(worker, "i1")
+        await asyncio.wait_for(worker.hand_off_model_instances(), 2)
+        assert worker.reported_states == ["draining"]
+        assert worker.drained == []
+        assert "i1" in worker.local_model_instances
+    asyncio.run(run())
+
+def test_all_workers_data_is_read_in_one_go(run_with_cluster):
+    async def run(cluster):
+        w1 = make_reporting_worker(cluster, "http://w1:9510")
+        w2 = make_reporting_worker(cluster, "http://w2:9510")
+        await w1.report_once()
+        await w2.report_once()
+        [worker_data] = [x for x in await w1.get_all_workers_data() if x["id"] == w2.id]
+        assert worker_data["serving_endpoint"] == "http://w2:9510"
+        assert worker_data["model_instances_count"] == 0
+        assert worker_data["available_serving_engines"] == []
+        #expired since it was indexed
+        await cluster.redis.delete(cluster.get_redis_key(w2.worker_key))
+        assert [x["id"] for x in await w1.get_all_workers_data()] == [w1.id]
+    run_with_cluster(run)
+
+def test_worker_liveness_does_not_depend_on_local_clocks(run_with_cluster, monkeypatch):
+    async def run(cluster):
+        w1 = make_reporting_worker(cluster, "http://w1:9510")
+        await w1.report_once()
+        #a worker whose clock runs an hour ahead neither drops w1 nor ignores it
+        monkeypatch.setattr(time, "time", lambda: real_time() + 3600)
+        w2 = make_reporting_worker(cluster, "http://w2:9510")
+        await w2.report_once()
+        assert sorted(x["id"] for x in await w2.get_all_workers_data()) == sorted([w1.id, w2.id])
+    real_time = time.time
+    run_with_cluster(run)